@@ -28,9 +28,15 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'numpy': ['numpy'],
+        'ujson': ['ujson'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
+    presence-benchmark = presence_analyzer.benchmarks:run
+    presence-generate = presence_analyzer.generator:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
@@ -0,0 +1,923 @@
+# -*- coding: utf-8 -*-
+"""
+Storage backends of presence data.
+
+Every backend loads a snapshot of presence data which answers the same
+statistics API, see PresenceSnapshot. Snapshots are cached in DataCache per
+path and reloaded when source data changes, either on access or by
+a background DataRefresher. STORAGE_BACKEND selects one of BACKENDS:
+
+    memory  - records parsed into a columnar store with derived indexes,
+    sqlite  - records imported into SQLite database, see database module,
+    shared  - memory layout mapped from segments published by one of worker
+              processes, see shared module,
+    indexed - single users parsed on demand through a sidecar byte range
+              index, see userindex module.
+"""
+
+import os
+import threading
+from datetime import datetime
+from time import sleep
+
+from database import database_path, open_database
+from datadir import directory_signature, list_files, read_directory
+from directory import UserDirectory, build_user_summaries
+from engine import (
+    build_occupancy,
+    build_prefix_index,
+    build_weekday_index,
+    group_weekday_stats,
+    range_weekday_stats,
+    window_stats,
+)
+from ingest import iter_rows, iter_teams, read_tail, source_state
+from main import app
+from metrics import REGISTRY, timed
+import shared
+from sketch import build_sketch_index, sketch_rows, weekday_quantiles
+from snapshot import load_store
+from store import PresenceStore
+from userindex import UserIndex, load_index
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class DataCache(object):
+    """
+    Process-wide cache of parsed presence data.
+
+    Parsed structures are kept per CSV path and reparsed only when the file's
+    inode, size or mtime change. Only one thread reparses at a time, other
+    readers keep getting the previous structure until the new one is ready.
+    """
+
+    def __init__(self, loader):
+        # loader is called with path and previously loaded value (or None)
+        self.loader = loader
+        self._entries = {}
+        self._watched = set()
+        self._reload_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'reloads': 0, 'stale': 0}
+
+    def _count(self, name):
+        """
+        Increments one of the statistics counters.
+        """
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get(self, path):
+        """
+        Returns parsed data for given path, reparsing it when needed.
+
+        Paths watched by a DataRefresher are never reparsed here once they
+        were loaded, the refresher swaps in new data in the background.
+        """
+        entry = self._entries.get(path)
+        if entry is not None and path in self._watched:
+            self._count('hits')
+            return entry[1]
+
+        signature = file_signature(path)
+        if entry is not None and entry[0] == signature:
+            self._count('hits')
+            return entry[1]
+
+        if entry is None:
+            self._reload_lock.acquire()
+        elif not self._reload_lock.acquire(False):
+            # another thread is reparsing, keep serving the old snapshot
+            self._count('stale')
+            return entry[1]
+
+        try:
+            return self._reload(path, signature)
+        finally:
+            self._reload_lock.release()
+
+    def refresh(self, path):
+        """
+        Reparses data of given path if the file has changed.
+        """
+        signature = file_signature(path)
+        with self._reload_lock:
+            return self._reload(path, signature)
+
+    def _reload(self, path, signature):
+        """
+        Loads data unless cached entry matches signature.
+
+        Must be called with reload lock held. New value is fully built before
+        it replaces the old one, so readers never see partial data.
+        """
+        current = self._entries.get(path)
+        if current is not None and current[0] == signature:
+            self._count('hits')
+            return current[1]
+        self._count('misses')
+        with timed('data_load'):
+            value = self.loader(
+                path, current[1] if current is not None else None
+            )
+        self._entries[path] = (signature, value)
+        if current is not None:
+            self._count('reloads')
+            log.info('Reloaded presence data from %s', path)
+        return value
+
+    def watch(self, path):
+        """
+        Marks path as refreshed in the background.
+        """
+        self._watched.add(path)
+
+    def unwatch(self, path):
+        """
+        Makes readers check given path for changes again.
+        """
+        self._watched.discard(path)
+
+    def values(self):
+        """
+        Returns data loaded for all paths.
+        """
+        return [value for dummy, value in self._entries.values()]
+
+    def stats(self):
+        """
+        Returns a copy of hit/miss/reload counters.
+        """
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def clear(self):
+        """
+        Drops all cached entries and resets counters.
+        """
+        with self._reload_lock:
+            self._entries.clear()
+            with self._stats_lock:
+                for name in self._stats:
+                    self._stats[name] = 0
+
+
+class DataRefresher(threading.Thread):
+    """
+    Background thread reloading presence data when the file changes.
+
+    Parsing and building indexes happens in this thread, request threads
+    keep reading the previous snapshot until the new one is swapped in.
+    """
+
+    def __init__(self, cache, path, interval):
+        super(DataRefresher, self).__init__(name='presence-data-refresher')
+        self.daemon = True
+        self.cache = cache
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        Marks the path as watched and starts the thread.
+        """
+        self.cache.watch(self.path)
+        super(DataRefresher, self).start()
+
+    def run(self):
+        """
+        Checks the file every `interval` seconds until stopped.
+        """
+        try:
+            while True:
+                try:
+                    self.refresh()
+                except Exception:  # pylint: disable=broad-except
+                    log.exception('Cannot refresh %s', self.path)
+                if self.stopped.wait(self.interval):
+                    break
+        finally:
+            self.cache.unwatch(self.path)
+
+    def refresh(self):
+        """
+        Reloads data if the file has changed.
+        """
+        return self.cache.refresh(self.path)
+
+    def stop(self):
+        """
+        Stops the thread and waits for it to finish.
+        """
+        self.stopped.set()
+        self.join()
+
+
+class Publisher(DataRefresher):
+    """
+    Background thread publishing presence data to shared memory segments.
+
+    Every process runs one, but only the process holding the publisher lock
+    loads data and writes new generations. When it exits the lock is taken
+    over by another process.
+    """
+
+    def __init__(self, cache, path, interval, directory):
+        super(Publisher, self).__init__(cache, path, interval)
+        self.name = 'presence-data-publisher'
+        self.directory = directory
+        self.lock = None
+
+    def run(self):
+        """
+        Publishes changes every `interval` seconds until stopped.
+        """
+        try:
+            super(Publisher, self).run()
+        finally:
+            if self.lock is not None:
+                shared.unlock(self.lock)
+                self.lock = None
+
+    def refresh(self):
+        """
+        Publishes new generation if this process is the publisher and data
+        has changed.
+        """
+        if self.lock is None:
+            self.lock = shared.try_lock(self.directory)
+            if self.lock is None:
+                return None
+            log.info('Publishing presence data to %s', self.directory)
+        return publish_data(self.directory, self.path)
+
+
+def start_refresher():
+    """
+    Starts background refresher of presence data if DATA_REFRESH is enabled.
+
+    With shared STORAGE_BACKEND a Publisher is started as well. Returns
+    running DataRefresher or None.
+    """
+    global REFRESHER, PUBLISHER  # pylint: disable=global-statement
+    if not app.config.get('DATA_REFRESH'):
+        return None
+    interval = app.config.get('DATA_REFRESH_INTERVAL', 10)
+    if app.config.get('STORAGE_BACKEND') == 'shared':
+        directory = shared_directory()
+        if PUBLISHER is None or not PUBLISHER.is_alive() or \
+                PUBLISHER.directory != directory:
+            if PUBLISHER is not None:
+                PUBLISHER.stop()
+            PUBLISHER = Publisher(DATA_CACHE, data_path(), interval, directory)
+            PUBLISHER.start()
+    path = backend_path()
+    if REFRESHER is not None and REFRESHER.is_alive():
+        if REFRESHER.path == path and REFRESHER.cache is data_cache():
+            return REFRESHER
+        REFRESHER.stop()
+    REFRESHER = DataRefresher(data_cache(), path, interval)
+    REFRESHER.start()
+    return REFRESHER
+
+
+def file_signature(path):
+    """
+    Returns a tuple identifying current version of the file or directory.
+    """
+    if os.path.isdir(path):
+        return directory_signature(path)
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class DataVersion(object):
+    """
+    Version information of data read from a file, like presence snapshots
+    and team mapping.
+    """
+
+    def __init__(self, signature=None):
+        # (inode, size, mtime) of the file, identifies version of data
+        self.signature = signature or (0, 0, 0)
+
+    @property
+    def version(self):
+        """
+        Short string identifying version of data, used in ETags.
+        """
+        inode, size, mtime = self.signature
+        return '{0:x}-{1:x}-{2:x}'.format(inode, size, int(mtime * 1000000))
+
+    @property
+    def modified(self):
+        """
+        Modification time of the source file as UTC datetime.
+        """
+        return datetime.utcfromtimestamp(int(self.signature[2]))
+
+
+class PresenceSnapshot(DataVersion):
+    """
+    Statistics shared by presence snapshots of all storage backends.
+
+    Every backend subclass provides user_ids, weekday_stats and
+    _occupancy, which computes Occupancy for occupancy. Results derived
+    from them are memoized with the snapshot.
+    """
+
+    def __init__(self, signature=None):
+        super(PresenceSnapshot, self).__init__(signature)
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+
+    def memoize(self, key, function, *args):
+        """
+        Returns result of function kept with the snapshot under key.
+
+        Results derived from the snapshot are only recomputed when data
+        changes, at most MEMO_SIZE of them are kept.
+        """
+        with self._memo_lock:
+            if key in self._memo:
+                return self._memo[key]
+        with timed('aggregation'):
+            result = function(*args)
+        with self._memo_lock:
+            if len(self._memo) >= MEMO_SIZE:
+                self._memo.clear()
+            self._memo[key] = result
+        return result
+
+    def group_stats(self, teams=None, first=None, last=None):
+        """
+        Returns dict mapping teams to seven GroupStats, users without team
+        are grouped under None.
+
+        All groups are computed in one reduction of per-user statistics,
+        see memoize. Optional first and last dates (inclusive) limit
+        the range.
+        """
+        return self.memoize(
+            ('groups', teams.version if teams is not None else None,
+             first, last),
+            self._group_stats,
+            teams.teams if teams is not None else {}, first, last,
+        )
+
+    def occupancy(self, first=None, last=None):
+        """
+        Returns Occupancy of all users, see engine.build_occupancy.
+
+        Optional first and last dates (inclusive) limit the range.
+        """
+        return self.memoize(
+            ('occupancy', first, last), self._occupancy, first, last
+        )
+
+    def _group_stats(self, groups, first, last):
+        """
+        Computes group_stats of users mapped to groups.
+        """
+        return group_weekday_stats(
+            (
+                (user_id, self.weekday_stats(user_id, first, last))
+                for user_id in self.user_ids()
+            ),
+            groups,
+        )
+
+
+class TeamMapping(DataVersion):
+    """
+    Mapping of users to teams read from TEAMS_CSV.
+    """
+
+    def __init__(self, teams, signature=None):
+        super(TeamMapping, self).__init__(signature)
+        self.teams = teams
+
+    def names(self):
+        """
+        Returns sorted list of team names.
+        """
+        return sorted(set(self.teams.itervalues()))
+
+
+class PresenceData(PresenceSnapshot):
+    """
+    Parsed presence data together with indexes derived from it.
+
+    Records are kept in a columnar PresenceStore, the dict layout returned
+    by get_data is only materialised on first access. Whole history
+    statistics come from the weekday index, statistics of date windows from
+    cumulative sums in the prefix index and quantiles from sketches, users
+    are listed from the directory.
+    Instances are treated as read-only snapshots, they are shared between
+    request threads.
+    """
+
+    def __init__(self, store, source=None, weekdays=None, signature=None,
+                 prefix=None, sketches=None):
+        # pylint: disable=too-many-arguments
+        super(PresenceData, self).__init__(signature)
+        self.store = store
+        # SourceState of CSV file or parsed files of DATA_DIR
+        self.source = source
+        with timed('aggregation'):
+            if weekdays is None:
+                weekdays = build_weekday_index(store)
+            if prefix is None:
+                prefix = build_prefix_index(store)
+            if sketches is None:
+                sketches = build_sketch_index(store)
+        self.weekdays = weekdays
+        self.prefix = prefix
+        self.sketches = sketches
+        with timed('aggregation'):
+            self.directory = UserDirectory(build_user_summaries(store))
+        self.last_day = store.last_day()
+        self._data = None
+
+    def extend(self, rows, source, signature=None):
+        """
+        Returns new snapshot with rows appended to the source file.
+
+        Only aggregates of users present in rows are recomputed.
+        """
+        store = self.store.merge(rows)
+        user_ids = set(row[0] for row in rows)
+        weekdays = dict(self.weekdays)
+        prefix = dict(self.prefix)
+        sketches = dict(self.sketches)
+        with timed('aggregation'):
+            weekdays.update(build_weekday_index(store, user_ids))
+            prefix.update(build_prefix_index(store, user_ids))
+            sketches.update(build_sketch_index(store, user_ids))
+        return PresenceData(
+            store, source, weekdays, signature, prefix, sketches
+        )
+
+    def __contains__(self, user_id):
+        return user_id in self.store
+
+    @property
+    def data(self):
+        """
+        Presence data in the dict layout, see utils.get_data.
+        """
+        if self._data is None:
+            self._data = self.store.to_dict()
+        return self._data
+
+    def user_ids(self):
+        """
+        Returns sorted list of all user ids.
+        """
+        return self.store.user_ids()
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayStats of given user, Monday first.
+
+        Optional first and last dates (inclusive) limit statistics to that
+        range, they are answered from the prefix index in constant time.
+        """
+        if first is None and last is None:
+            return self.weekdays[user_id]
+        return window_stats(
+            self.prefix[user_id],
+            first.toordinal() if first is not None else None,
+            last.toordinal() if last is not None else None,
+        )
+
+    def _occupancy(self, first, last):
+        """
+        Computes occupancy from the store.
+        """
+        return build_occupancy(
+            self.store,
+            first.toordinal() if first is not None else None,
+            last.toordinal() if last is not None else None,
+        )
+
+    def weekday_quantiles(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayQuantiles of given user, Monday first.
+
+        Whole history is answered from sketch built at load, for a date
+        range a sketch of records within it is built.
+        """
+        if first is None and last is None:
+            return weekday_quantiles(self.sketches[user_id])
+        return weekday_quantiles(sketch_rows(self.store.user_rows(
+            user_id,
+            first.toordinal() if first is not None else None,
+            last.toordinal() if last is not None else None,
+        )))
+
+
+class SQLitePresence(PresenceSnapshot):
+    """
+    Presence data kept in SQLite database.
+
+    Statistics are computed by the database on every call, only the
+    directory of users is kept in memory.
+    """
+
+    def __init__(self, database, signature=None):
+        super(SQLitePresence, self).__init__(signature)
+        self.database = database
+        self._user_ids = database.user_ids()
+        self._users = frozenset(self._user_ids)
+        self.directory = UserDirectory(database.user_summaries())
+        self.last_day = database.last_day()
+        self._data = None
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    @property
+    def data(self):
+        """
+        Presence data in the dict layout, see utils.get_data.
+        """
+        if self._data is None:
+            self._data = self.database.to_dict()
+        return self._data
+
+    def user_ids(self):
+        """
+        Returns sorted list of all user ids.
+        """
+        return list(self._user_ids)
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayStats of given user, Monday first.
+
+        Optional first and last dates (inclusive) limit statistics to that
+        range.
+        """
+        return self.database.weekday_stats(user_id, first, last)
+
+    def _group_stats(self, groups, first, last):
+        """
+        Statistics of all users are read with a single query.
+        """
+        return group_weekday_stats(
+            self.database.users_weekday_stats(first, last).iteritems(),
+            groups,
+        )
+
+    def _occupancy(self, first, last):
+        """
+        Computes occupancy from records grouped by the database.
+        """
+        return self.database.occupancy(first, last)
+
+    def weekday_quantiles(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayQuantiles of given user, Monday first.
+
+        Sketch is built from records read from the database.
+        """
+        return weekday_quantiles(sketch_rows(
+            (day.toordinal(), start, end)
+            for day, start, end in self.database.user_rows(
+                user_id, first, last
+            )
+        ))
+
+
+class IndexedPresence(PresenceSnapshot):
+    """
+    Presence data of CSV file loaded one user at a time.
+
+    Only byte ranges of users from the sidecar index are kept in memory,
+    records of a user are parsed when they're needed and kept in UserIndex
+    LRU cache.
+    """
+
+    def __init__(self, index, signature=None):
+        super(IndexedPresence, self).__init__(signature)
+        self.index = index
+        self.directory = UserDirectory(index.summaries)
+        self.last_day = (
+            datetime.fromordinal(
+                max(summary.last for summary in index.summaries.values())
+            ).date()
+            if index.summaries else None
+        )
+        self._full_store = None
+        self._store_lock = threading.Lock()
+        self._data = None
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    @property
+    def data(self):
+        """
+        Presence data in the dict layout, see utils.get_data.
+        """
+        if self._data is None:
+            self._data = self._store().to_dict()
+        return self._data
+
+    def _store(self):
+        """
+        Returns store of whole CSV file, parsed once per snapshot.
+
+        It's only needed by statistics of all users and the dict layout,
+        views of single users read just their ranges.
+        """
+        with self._store_lock:
+            if self._full_store is None:
+                with open(self.index.csv_path, 'r') as csvfile:
+                    self._full_store = PresenceStore.from_rows(
+                        iter_rows(csvfile)
+                    )
+        return self._full_store
+
+    def user_ids(self):
+        """
+        Returns sorted list of all user ids.
+        """
+        return self.index.user_ids()
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayStats of given user, Monday first.
+
+        Optional first and last dates (inclusive) limit statistics to that
+        range.
+        """
+        return range_weekday_stats(
+            self.index.user_store(user_id), user_id,
+            first.toordinal() if first is not None else None,
+            last.toordinal() if last is not None else None,
+        )
+
+    def weekday_quantiles(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayQuantiles of given user, Monday first.
+        """
+        return weekday_quantiles(sketch_rows(
+            self.index.user_store(user_id).user_rows(
+                user_id,
+                first.toordinal() if first is not None else None,
+                last.toordinal() if last is not None else None,
+            )
+        ))
+
+    def _occupancy(self, first, last):
+        """
+        Computes occupancy from whole CSV file.
+        """
+        return build_occupancy(
+            self._store(),
+            first.toordinal() if first is not None else None,
+            last.toordinal() if last is not None else None,
+        )
+
+
+def data_path():
+    """
+    Returns configured DATA_DIR, or DATA_CSV when it isn't set.
+    """
+    return app.config.get('DATA_DIR') or app.config['DATA_CSV']
+
+
+def backend_path():
+    """
+    Returns path the configured backend loads its data from.
+
+    It's DATA_DIR or DATA_CSV, except for shared backend which loads
+    segment named by the pointer file in SHARED_DIR.
+    """
+    if app.config.get('STORAGE_BACKEND') != 'shared':
+        return data_path()
+    directory = shared_directory()
+    path = shared.pointer_path(directory)
+    if not os.path.exists(path):
+        wait_published(directory)
+    return path
+
+
+def shared_directory():
+    """
+    Returns SHARED_DIR, by default a directory next to the data.
+    """
+    return (
+        app.config.get('SHARED_DIR') or
+        data_path().rstrip(os.sep) + '.shared'
+    )
+
+
+def data_cache():
+    """
+    Returns DataCache of configured STORAGE_BACKEND.
+    """
+    backend = app.config.get('STORAGE_BACKEND') or 'memory'
+    try:
+        return BACKENDS[backend]
+    except KeyError:
+        raise ValueError('Unknown STORAGE_BACKEND: {0}'.format(backend))
+
+
+def load_presence(path, previous=None):
+    """
+    Parses CSV file and builds PresenceData snapshot from it.
+
+    When the file only grew since `previous` snapshot was loaded just the
+    appended lines are parsed and merged into it. With DATA_SNAPSHOT enabled
+    records are loaded from a binary snapshot stored next to the CSV file,
+    which is rebuilt when CSV changes. Directories are loaded with
+    load_directory.
+    """
+    if os.path.isdir(path):
+        return load_directory(path, previous)
+    signature = file_signature(path)
+    if previous is not None and previous.source is not None:
+        tail = read_tail(path, previous.source)
+        if tail is not None:
+            rows, source = tail
+            log.debug('Appending %d rows from %s', len(rows), path)
+            return previous.extend(rows, source, signature)
+        log.info('%s was truncated or rewritten, parsing whole file', path)
+
+    # state has to be taken before parsing, rows appended in the meantime
+    # will be parsed once again by the next tail read
+    source = source_state(path)
+    if app.config.get('DATA_SNAPSHOT'):
+        store = load_store(path)
+    else:
+        with open(path, 'r') as csvfile:
+            store = PresenceStore.from_rows(iter_rows(csvfile))
+    return PresenceData(store, source, signature=signature)
+
+
+def load_directory(path, previous=None):
+    """
+    Loads every CSV file in directory into one PresenceData snapshot.
+
+    Files parsed for `previous` snapshot are reused unless they changed.
+    Changed files are parsed in DATA_WORKERS processes, see datadir module
+    for rules applied to records found in several files.
+    """
+    signature = file_signature(path)
+    files = None
+    if previous is not None and isinstance(previous.source, dict):
+        files = previous.source
+    store, files = read_directory(
+        path, files,
+        use_snapshot=app.config.get('DATA_SNAPSHOT'),
+        workers=app.config.get('DATA_WORKERS'),
+    )
+    return PresenceData(store, files, signature=signature)
+
+
+def load_database(path, previous=None):  # pylint: disable=unused-argument
+    """
+    Imports CSV file or directory into SQLite database and opens it.
+
+    Database is stored at DATA_SQLITE, next to the data by default, and is
+    reused as long as it was built from the current version of data.
+    """
+    # previous database is left to in-flight requests, its connections
+    # are closed once it's garbage collected
+    signature = file_signature(path)
+    database = open_database(
+        app.config.get('DATA_SQLITE') or database_path(path),
+        list_files(path) if os.path.isdir(path) else [path],
+        repr(signature),
+    )
+    return SQLitePresence(database, signature)
+
+
+def load_indexed(path, previous=None):  # pylint: disable=unused-argument
+    """
+    Opens sidecar index of CSV file, building it when it's missing or out
+    of date.
+
+    Index is stored at DATA_INDEX, next to the CSV file by default, at most
+    USER_CACHE_SIZE parsed users are kept in memory.
+    """
+    if os.path.isdir(path):
+        raise ValueError('Indexed storage requires DATA_CSV, not DATA_DIR')
+    signature = file_signature(path)
+    ranges, summaries = load_index(path, app.config.get('DATA_INDEX'))
+    return IndexedPresence(
+        UserIndex(path, ranges, summaries,
+                  app.config.get('USER_CACHE_SIZE', USER_CACHE_SIZE)),
+        signature,
+    )
+
+
+def load_segment(path, previous=None):  # pylint: disable=unused-argument
+    """
+    Maps current shared segment named by the pointer file at path.
+
+    Nothing is parsed or aggregated, columns and indexes are used in place.
+    """
+    segment = shared.current_segment(os.path.dirname(path))
+    if segment is None:
+        raise shared.SegmentError('Nothing published to {0}'.format(path))
+    generation, store, weekdays, prefix, sketches, signature = \
+        shared.read_segment(segment)
+    log.debug('Attached generation %d of presence data', generation)
+    return PresenceData(store, None, weekdays, signature, prefix, sketches)
+
+
+def load_teams(path, previous=None):  # pylint: disable=unused-argument
+    """
+    Reads TeamMapping from CSV file of `user_id,team` lines.
+
+    File which can't be read gives empty mapping.
+    """
+    signature = file_signature(path)
+    try:
+        with open(path, 'r') as csvfile:
+            teams = dict(iter_teams(csvfile))
+    except (IOError, OSError) as error:
+        log.warning('Cannot read teams from %s: %s', path, error)
+        teams = {}
+    return TeamMapping(teams, signature)
+
+
+def publish_data(directory, path):
+    """
+    Loads presence data and publishes it unless current generation in
+    directory was built from the same version of data.
+
+    Returns path of the new segment or None.
+    """
+    presence = DATA_CACHE.refresh(path)
+    current = shared.current_segment(directory)
+    if current is not None and \
+            shared.read_header(current)[7:] == presence.signature:
+        return None
+    return shared.publish(directory, presence)
+
+
+def wait_published(directory, interval=0.1):
+    """
+    Waits until presence data is published to directory.
+
+    The first process to get there publishes it itself, others wait for it.
+    """
+    while shared.current_segment(directory) is None:
+        lock = shared.try_lock(directory)
+        if lock is None:
+            sleep(interval)
+            continue
+        try:
+            if shared.current_segment(directory) is None:
+                publish_data(directory, data_path())
+        finally:
+            shared.unlock(lock)
+
+
+DATA_CACHE = DataCache(load_presence)
+# data caches of storage backends selected by STORAGE_BACKEND
+BACKENDS = {
+    'memory': DATA_CACHE,
+    'sqlite': DataCache(load_database),
+    'shared': DataCache(load_segment),
+    'indexed': DataCache(load_indexed),
+}
+# default number of users kept parsed by indexed backend
+USER_CACHE_SIZE = 64
+TEAMS_CACHE = DataCache(load_teams)
+# number of derived results kept with every snapshot
+MEMO_SIZE = 32
+REFRESHER = None  # pylint: disable=invalid-name
+PUBLISHER = None  # pylint: disable=invalid-name
+
+
+@REGISTRY.register
+def user_index_metrics():
+    """
+    Exposes statistics of users parsed by indexed backend.
+    """
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'users': 0}
+    for presence in BACKENDS['indexed'].values():
+        for name, value in presence.index.stats().items():
+            stats[name] += value
+    return [
+        (
+            'presence_user_index_total', 'counter',
+            'Lookups of users parsed by indexed backend by result.',
+            [((('result', name),), stats[name])
+             for name in ('hits', 'misses', 'evictions')],
+        ),
+        (
+            'presence_user_index_users', 'gauge',
+            'Number of parsed users kept by indexed backend.',
+            [((), stats['users'])],
+        ),
+    ]
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""
+Performance benchmarks.
+
+Run with `bin/presence-benchmark [--sizes 10000,1000000] [--output FILE]`
+to benchmark synthetic data or `bin/presence-benchmark path/to/data.csv`.
+Results can be saved as JSON and compared with `--compare FILE`.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from functools import partial
+
+import backends
+import encoding
+import engine
+import generator
+import main
+import sketch
+import utils
+import views
+from ingest import iter_rows, iter_rows_strptime
+from store import PresenceStore
+
+
+DEFAULT_SIZES = (10000, 1000000, 10000000)
+BASELINE_LIMIT = 1000000
+
+
+def measure(function, repeat=3):
+    """
+    Returns best wall time (in seconds) of calling function `repeat` times.
+    """
+    best = None
+    for dummy in range(repeat):
+        started = time.time()
+        function()
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def count_rows(parser, path):
+    """
+    Parses whole file with given row parser and returns number of rows.
+    """
+    with open(path, 'r') as csvfile:
+        return sum(1 for dummy in parser(csvfile))
+
+
+def bench_parse(path, repeat=3, baseline=True):
+    """
+    Compares rows/second of strptime based and fast CSV parsers.
+    """
+    rows = count_rows(iter_rows, path)
+    results = []
+    parsers = [('fast', iter_rows)]
+    if baseline:
+        parsers.insert(0, ('strptime', iter_rows_strptime))
+    for name, parser in parsers:
+        elapsed = measure(partial(count_rows, parser, path), repeat)
+        results.append({
+            'name': 'parse.{0}'.format(name),
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed else 0,
+        })
+    return results
+
+
+def deep_sizeof(obj, seen=None):
+    """
+    Returns memory used by object and everything it references.
+
+    Objects shared between containers (like cached dates) are counted once.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_sizeof(key, seen) + deep_sizeof(value, seen)
+            for key, value in obj.iteritems()
+        )
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    return size
+
+
+def bench_memory(path):
+    """
+    Compares memory footprint of dict layout and columnar store.
+    """
+    with open(path, 'r') as csvfile:
+        presence_store = PresenceStore.from_rows(iter_rows(csvfile))
+    rows = len(presence_store)
+    return [
+        {
+            'name': 'memory.dict',
+            'rows': rows,
+            'bytes': deep_sizeof(presence_store.to_dict()),
+        },
+        {
+            'name': 'memory.store',
+            'rows': rows,
+            'bytes': presence_store.nbytes(),
+        },
+    ]
+
+
+def bench_aggregate(presence_store, repeat=3):
+    """
+    Compares weekday, prefix sums, quantile sketch and occupancy aggregation
+    of pure Python and NumPy engines, and windowed queries answered from
+    prefix sums.
+    """
+    rows = len(presence_store)
+    results = []
+    engines = [('python', False)]
+    if engine.numpy is not None:
+        engines.append(('numpy', True))
+    for kind, build in (('aggregate', engine.build_weekday_index),
+                        ('prefix', engine.build_prefix_index),
+                        ('sketch', sketch.build_sketch_index),
+                        ('occupancy', engine.build_occupancy)):
+        for name, use_numpy in engines:
+            elapsed = measure(partial(
+                build, presence_store, use_numpy=use_numpy
+            ), repeat)
+            results.append({
+                'name': '{0}.{1}'.format(kind, name),
+                'rows': rows,
+                'seconds': elapsed,
+                'rows_per_second': rows / elapsed if elapsed else 0,
+            })
+
+    index = engine.build_prefix_index(presence_store)
+    last = presence_store.last_day()
+    if last is not None:
+        last = last.toordinal()
+        for weeks in (4, 12):
+            elapsed = measure(lambda: [
+                engine.window_stats(prefix, last - weeks * 7 + 1, last)
+                for prefix in index.itervalues()
+            ], repeat)
+            results.append({
+                'name': 'window.{0}_weeks'.format(weeks),
+                'rows': rows,
+                'users': len(index),
+                'seconds': elapsed,
+            })
+    return results
+
+
+def bench_grouping(presence_store, repeat=3):
+    """
+    Measures grouping helpers of utils applied to every user.
+    """
+    data = presence_store.to_dict()
+    rows = len(presence_store)
+    intervals = [utils.group_by_weekday(items) for items in data.values()]
+    helpers = (
+        ('group_by_weekday', lambda: [
+            utils.group_by_weekday(items) for items in data.values()
+        ]),
+        ('group_by_start_end', lambda: [
+            utils.group_by_start_end(items) for items in data.values()
+        ]),
+        ('mean', lambda: [
+            utils.mean(weekday) for weekdays in intervals
+            for weekday in weekdays
+        ]),
+    )
+    results = []
+    for name, function in helpers:
+        elapsed = measure(function, repeat)
+        results.append({
+            'name': 'grouping.{0}'.format(name),
+            'rows': rows,
+            'seconds': elapsed,
+            'rows_per_second': rows / elapsed if elapsed else 0,
+        })
+    return results
+
+
+def bench_serialization(presence_store, repeat=3):
+    """
+    Compares encoding of weekday tables of every user by installed JSON
+    encoders and precompiled templates, and their gzip compression.
+    """
+    rows = len(presence_store)
+    index = engine.build_weekday_index(presence_store)
+    tables = [
+        views.presence_start_end(weekdays) for weekdays in index.itervalues()
+    ]
+    plain = [list(table) for table in tables]
+    methods = [
+        (name, partial(map, encoder, plain))
+        for name, encoder in sorted(encoding.ENCODERS.items())
+    ]
+    methods.append(('template', partial(map, encoding.encode, tables)))
+    bodies = [encoding.encode(table) for table in tables]
+    methods.append(('gzip', partial(map, encoding.gzip_compress, bodies)))
+    results = []
+    for name, function in methods:
+        results.append({
+            'name': 'serialize.{0}'.format(name),
+            'rows': rows,
+            'users': len(tables),
+            'seconds': measure(function, repeat),
+        })
+    return results
+
+
+def bench_views(path, repeat=3, backend='memory'):
+    """
+    Measures end-to-end latency of /api/v1 views through Flask test client.
+
+    `cold_start` is the first request which has to load data, other views
+    are measured with warm data cache and disabled response cache.
+    """
+    saved = dict(main.app.config)
+    main.app.config.update({
+        'DATA_CSV': path,
+        'DATA_DIR': None,
+        'DATA_SNAPSHOT': False,
+        'DATA_SQLITE': path + '.bench.sqlite',
+        'DATA_INDEX': path + '.bench.idx',
+        'STORAGE_BACKEND': backend,
+        'RESPONSE_CACHE_SIZE': 0,
+    })
+    cache = backends.BACKENDS[backend]
+    prefix = 'view.' if backend == 'memory' else 'view.{0}.'.format(backend)
+    try:
+        cache.clear()
+        for key in ('DATA_SQLITE', 'DATA_INDEX'):
+            if os.path.exists(main.app.config[key]):
+                os.remove(main.app.config[key])
+        client = main.app.test_client()
+        started = time.time()
+        client.get('/api/v1/users')
+        elapsed = time.time() - started
+        results = [{'name': prefix + 'cold_start', 'seconds': elapsed}]
+        presence = cache.get(path)
+        rows = count_rows(iter_rows, path)
+        user_ids = presence.user_ids()
+        user_id = user_ids[len(user_ids) // 2] if user_ids else 0
+        urls = (
+            ('users', '/api/v1/users'),
+            ('users_page', '/api/v1/users?prefix=user%201&limit=50'),
+            ('mean_time_weekday',
+             '/api/v1/mean_time_weekday/{0}'.format(user_id)),
+            ('presence_weekday',
+             '/api/v1/presence_weekday/{0}'.format(user_id)),
+            ('presence_start_end',
+             '/api/v1/presence_start_end/{0}'.format(user_id)),
+            ('company_weekday', '/api/v1/company/weekday'),
+            ('occupancy', '/api/v1/occupancy'),
+        )
+        for name, url in urls:
+            results.append({
+                'name': prefix + name,
+                'seconds': measure(partial(client.get, url), repeat),
+            })
+    finally:
+        cache.clear()
+        for key in ('DATA_SQLITE', 'DATA_INDEX'):
+            if os.path.exists(main.app.config[key]):
+                os.remove(main.app.config[key])
+        main.app.config.clear()
+        main.app.config.update(saved)
+    for result in results:
+        result['rows'] = rows
+    return results
+
+
+def bench_file(path, repeat=3, baseline_limit=BASELINE_LIMIT):
+    """
+    Runs all benchmarks against given CSV file.
+
+    Slow baselines (strptime parser, dict layout) are only measured for
+    files with at most `baseline_limit` rows.
+    """
+    with open(path, 'r') as csvfile:
+        presence_store = PresenceStore.from_rows(iter_rows(csvfile))
+    small = len(presence_store) <= baseline_limit
+    results = bench_parse(path, repeat, baseline=small)
+    if small:
+        results += bench_memory(path) + bench_grouping(presence_store, repeat)
+    results += bench_aggregate(presence_store, repeat)
+    results += bench_serialization(presence_store, repeat)
+    results += bench_views(path, repeat)
+    results += bench_views(path, repeat, backend='sqlite')
+    results += bench_views(path, repeat, backend='indexed')
+    return results
+
+
+def run_suite(sizes, workdir, repeat=3, baseline_limit=BASELINE_LIMIT):
+    """
+    Generates synthetic files of given sizes and benchmarks each of them.
+    """
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = []
+    for rows in sizes:
+        path = os.path.join(workdir, 'presence-{0}.csv'.format(rows))
+        if not os.path.exists(path):
+            generator.generate_rows(path, rows)
+        results += bench_file(path, repeat, baseline_limit)
+    return results
+
+
+def environment():
+    """
+    Describes environment benchmarks were run in.
+    """
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=open(os.devnull, 'w'),
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': engine.numpy.__version__ if engine.numpy else None,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results, previous, stream=sys.stdout):
+    """
+    Writes relative change of timings against previous results.
+    """
+    before = dict(
+        ((result['name'], result['rows']), result['seconds'])
+        for result in previous['results'] if 'seconds' in result
+    )
+    for result in results:
+        key = (result['name'], result['rows'])
+        if 'seconds' not in result or not before.get(key):
+            continue
+        stream.write('{0:<30} {1:>10} rows {2:>+9.1%}\n'.format(
+            result['name'], result['rows'],
+            result['seconds'] / before[key] - 1,
+        ))
+
+
+def report(results, stream=sys.stdout):
+    """
+    Writes benchmark results as a plain text table.
+    """
+    for result in results:
+        line = '{name:<30} {rows:>10} rows'.format(**result)
+        if 'seconds' in result:
+            line += ' {seconds:>10.4f} s'.format(**result)
+        if 'rows_per_second' in result:
+            line += ' {rows_per_second:>14,.0f} rows/s'.format(**result)
+        if 'bytes' in result:
+            line += ' {bytes:>14,} bytes'.format(**result)
+        stream.write(line + '\n')
+
+
+def parse_sizes(value):
+    """
+    Converts comma separated list of row counts to tuple of ints.
+    """
+    return tuple(int(size) for size in value.split(',') if size)
+
+
+def run(argv=None):
+    """
+    Runs benchmark suite on synthetic data or given CSV files.
+    """
+    parser = argparse.ArgumentParser(description='Presence benchmarks.')
+    parser.add_argument('paths', nargs='*', metavar='path',
+                        help='CSV files to benchmark instead of synthetic')
+    parser.add_argument('--sizes', type=parse_sizes, default=DEFAULT_SIZES,
+                        help='comma separated numbers of synthetic rows')
+    parser.add_argument('--workdir', default=os.path.join('var', 'benchmark'),
+                        help='directory for generated files')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline-limit', type=int, default=BASELINE_LIMIT,
+                        help='max rows for strptime and dict baselines')
+    parser.add_argument('--output', help='write JSON results to file')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.paths:
+        results = []
+        for path in args.paths:
+            results += bench_file(path, args.repeat, args.baseline_limit)
+    else:
+        results = run_suite(
+            args.sizes, args.workdir, args.repeat, args.baseline_limit
+        )
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'environment': environment(),
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
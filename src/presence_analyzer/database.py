@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite storage engine.
+
+Presence records are imported into a local SQLite database indexed on
+(user_id, date) and statistics are computed by SQL queries, so only rows
+of the requested user are read. Every thread gets its own connection.
+"""
+
+import datetime
+import os
+import sqlite3
+import threading
+
+from directory import UserSummary
+from engine import MINUTES, WeekdayStats, occupancy_from_changes
+from ingest import iter_rows, time_from_seconds
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+SUFFIX = '.sqlite'
+SCHEMA = """
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE presence (
+    user_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, date)
+);
+"""
+# %w numbers days from Sunday, statistics are indexed from Monday
+WEEKDAY_STATS = """
+SELECT (CAST(strftime('%w', date) AS INTEGER) + 6) % 7 AS weekday,
+       COUNT(*), SUM(end_time - start_time), SUM(start_time), SUM(end_time)
+FROM presence
+WHERE {0}
+GROUP BY weekday
+"""
+USER_SUMMARIES = """
+SELECT user_id, MIN(date), MAX(date), COUNT(*)
+FROM presence
+GROUP BY user_id
+"""
+USERS_WEEKDAY_STATS = """
+SELECT user_id, (CAST(strftime('%w', date) AS INTEGER) + 6) % 7 AS weekday,
+       COUNT(*), SUM(end_time - start_time), SUM(start_time), SUM(end_time)
+FROM presence
+WHERE {0}
+GROUP BY user_id, weekday
+"""
+# records shorter than a minute don't count towards occupancy
+OCCUPANCY_CHANGES = """
+SELECT (CAST(strftime('%w', date) AS INTEGER) + 6) % 7 AS weekday,
+       {0} / 60 AS minute, COUNT(*)
+FROM presence
+WHERE end_time / 60 > start_time / 60 AND {1}
+GROUP BY weekday, minute
+"""
+OCCUPANCY_DATES = """
+SELECT (CAST(strftime('%w', date) AS INTEGER) + 6) % 7 AS weekday,
+       COUNT(DISTINCT date)
+FROM presence
+WHERE {0}
+GROUP BY weekday
+"""
+
+
+def database_path(path):
+    """
+    Returns default path of database built from CSV file or directory.
+    """
+    return path.rstrip(os.sep) + SUFFIX
+
+
+class Database(object):
+    """
+    Read-only access to imported presence records.
+
+    Connections are kept per thread, so threads of the server's pool reuse
+    their connection between requests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self):
+        """
+        Returns connection of the current thread, opening it when needed.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        """
+        Closes connections of all threads.
+        """
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            del self._connections[:]
+        self._local = threading.local()
+
+    def query(self, sql, params=()):
+        """
+        Returns all rows of the query.
+        """
+        return self.connection().execute(sql, params).fetchall()
+
+    def meta(self, key):
+        """
+        Returns value stored in meta table or None.
+        """
+        rows = self.query('SELECT value FROM meta WHERE key = ?', (key,))
+        return rows[0][0] if rows else None
+
+    def __len__(self):
+        return self.query('SELECT COUNT(*) FROM presence')[0][0]
+
+    def user_ids(self):
+        """
+        Returns sorted list of all user ids.
+        """
+        return [row[0] for row in self.query(
+            'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+        )]
+
+    def user_summaries(self):
+        """
+        Returns dict mapping user_id to UserSummary of its records.
+        """
+        return dict(
+            (user_id, UserSummary(
+                parse_date(first).toordinal(),
+                parse_date(last).toordinal(),
+                days,
+            ))
+            for user_id, first, last, days in self.query(USER_SUMMARIES)
+        )
+
+    def last_day(self):
+        """
+        Returns date of the latest record or None if there are no records.
+        """
+        value = self.query('SELECT MAX(date) FROM presence')[0][0]
+        return parse_date(value) if value else None
+
+    def weekday_stats(self, user_id, first=None, last=None):
+        """
+        Returns seven WeekdayStats of given user, Monday first.
+
+        Optional first and last dates (inclusive) limit the range.
+        """
+        condition, params = user_range(user_id, first, last)
+        stats = [WeekdayStats(0, 0, 0, 0)] * 7
+        for row in self.query(WEEKDAY_STATS.format(condition), params):
+            stats[row[0]] = WeekdayStats(*row[1:])
+        return stats
+
+    def users_weekday_stats(self, first=None, last=None):
+        """
+        Returns dict mapping every user with records within optional first
+        and last dates (inclusive) to seven WeekdayStats.
+        """
+        condition, params = date_range(first, last)
+        users = {}
+        for row in self.query(
+                USERS_WEEKDAY_STATS.format(condition or '1'), params):
+            stats = users.setdefault(row[0], [WeekdayStats(0, 0, 0, 0)] * 7)
+            stats[row[1]] = WeekdayStats(*row[2:])
+        return users
+
+    def occupancy(self, first=None, last=None):
+        """
+        Returns Occupancy of records within optional first and last dates
+        (inclusive), see engine.build_occupancy.
+        """
+        condition, params = date_range(first, last)
+        condition = condition or '1'
+        changes = [[0] * (MINUTES + 1) for dummy in range(7)]
+        for column, sign in (('start_time', 1), ('end_time', -1)):
+            for weekday, minute, count in self.query(
+                    OCCUPANCY_CHANGES.format(column, condition), params):
+                changes[weekday][minute] += sign * count
+        dates = [0] * 7
+        for weekday, count in self.query(
+                OCCUPANCY_DATES.format(condition), params):
+            dates[weekday] = count
+        return occupancy_from_changes(changes, dates)
+
+    def user_rows(self, user_id, first=None, last=None):
+        """
+        Yields (date, start, end) records of given user ordered by date.
+
+        Optional first and last dates (inclusive) limit the range.
+        """
+        condition, params = user_range(user_id, first, last)
+        for date, start, end in self.query(
+                'SELECT date, start_time, end_time FROM presence '
+                'WHERE {0} ORDER BY date'.format(condition), params):
+            yield parse_date(date), start, end
+
+    def to_dict(self):
+        """
+        Returns all entries in the dict layout used by get_data.
+        """
+        data = {}
+        for user_id, date, start, end in self.query(
+                'SELECT user_id, date, start_time, end_time FROM presence'):
+            data.setdefault(user_id, {})[parse_date(date)] = {
+                'start': time_from_seconds(start),
+                'end': time_from_seconds(end),
+            }
+        return data
+
+
+def user_range(user_id, first=None, last=None):
+    """
+    Returns (condition, params) selecting records of user within optional
+    first and last dates (inclusive).
+    """
+    condition, params = date_range(first, last)
+    return ' AND '.join(filter(None, ['user_id = ?', condition])), \
+        [user_id] + params
+
+
+def date_range(first=None, last=None):
+    """
+    Returns (condition, params) selecting records within optional first
+    and last dates (inclusive), condition is empty without bounds.
+    """
+    conditions = []
+    params = []
+    if first is not None:
+        conditions.append('date >= ?')
+        params.append(first.isoformat())
+    if last is not None:
+        conditions.append('date <= ?')
+        params.append(last.isoformat())
+    return ' AND '.join(conditions), params
+
+
+def parse_date(value):
+    """
+    Converts ISO date stored in database to datetime.date.
+    """
+    return datetime.date(int(value[:4]), int(value[5:7]), int(value[8:10]))
+
+
+def import_csv(path, csv_paths, signature):
+    """
+    Imports CSV files into a new database at path and returns it.
+
+    Records of later files replace records of the same user and date from
+    earlier ones. Database is built in a temporary file and renamed into
+    place, so open connections keep reading the previous one.
+    """
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        # left behind by failed import
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        # temporary file is discarded on failure anyway
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.executescript(SCHEMA)
+        for csv_path in csv_paths:
+            with open(csv_path, 'r') as csvfile:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+                    (
+                        (user_id, date.isoformat(), start, end)
+                        for user_id, date, start, end in iter_rows(csvfile)
+                    )
+                )
+        connection.execute(
+            'INSERT INTO meta VALUES (?, ?)', ('signature', signature)
+        )
+        connection.commit()
+    finally:
+        connection.close()
+    os.rename(tmp_path, path)
+    log.info('Imported %s into %s', ', '.join(csv_paths), path)
+    return Database(path)
+
+
+def open_database(path, csv_paths, signature):
+    """
+    Returns Database at path, importing CSV files if it's missing or was
+    built from different version of them.
+    """
+    if os.path.exists(path):
+        database = Database(path)
+        try:
+            if database.meta('signature') == signature:
+                return database
+        except sqlite3.DatabaseError as error:
+            log.info('Rebuilding database %s: %s', path, error)
+        database.close()
+    return import_csv(path, csv_paths, signature)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Loading presence data from a directory of CSV exports.
+
+Every `*.csv` file in DATA_DIR is parsed on its own, in a process pool when
+several files have to be parsed. Parsed files are remembered together with
+their (inode, size, mtime) signatures, so on reload only new or changed
+files are parsed again.
+
+When the same user and date appear in several files the record from the file
+which comes later in name order wins, so exports named like `2013-09.csv`
+override older months. Within one file the last row wins.
+"""
+
+import glob
+import multiprocessing
+import os
+from array import array
+from hashlib import md5
+
+from ingest import iter_rows
+from snapshot import load_store
+from store import TYPECODE, PresenceStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+PATTERN = '*.csv'
+
+
+def list_files(path):
+    """
+    Returns sorted paths of CSV files in directory.
+    """
+    return sorted(glob.glob(os.path.join(path, PATTERN)))
+
+
+def file_signatures(path):
+    """
+    Maps every CSV file in directory to its (inode, size, mtime).
+    """
+    signatures = {}
+    for name in list_files(path):
+        try:
+            stat = os.stat(name)
+        except OSError:
+            # removed in the meantime
+            continue
+        signatures[name] = (stat.st_ino, stat.st_size, stat.st_mtime)
+    return signatures
+
+
+def directory_signature(path):
+    """
+    Returns a tuple identifying current contents of the directory.
+
+    It has the same shape as signature of a single file: a digest of names
+    and signatures of all CSV files, their total size and the latest mtime.
+    """
+    signatures = file_signatures(path)
+    digest = int(md5(repr(sorted(signatures.items()))).hexdigest()[:12], 16)
+    return (
+        digest,
+        sum(size for dummy, size, dummy in signatures.itervalues()),
+        max([mtime for dummy, dummy, mtime in signatures.itervalues()] or
+            [os.stat(path).st_mtime]),
+    )
+
+
+def parse_file(task):
+    """
+    Parses one CSV file, returns its store packed for cheap pickling.
+
+    Task is a (path, use_snapshot) tuple, it runs in pool workers.
+    """
+    path, use_snapshot = task
+    if use_snapshot:
+        store = load_store(path)
+    else:
+        with open(path, 'r') as csvfile:
+            store = PresenceStore.from_rows(iter_rows(csvfile))
+    columns = (store.users, store.days, store.starts, store.ends)
+    return [column.tostring() for column in columns], store.offsets
+
+
+def unpack(packed):
+    """
+    Rebuilds PresenceStore returned by parse_file.
+    """
+    data, offsets = packed
+    columns = []
+    for value in data:
+        column = array(TYPECODE)
+        column.fromstring(value)
+        columns.append(column)
+    return PresenceStore(*columns, offsets=offsets)
+
+
+def parse_files(paths, use_snapshot=False, workers=None):
+    """
+    Parses given files and returns list of their stores.
+
+    More than one file is parsed in a pool of `workers` processes (number
+    of CPUs by default), `workers` of 1 disables the pool.
+    """
+    tasks = [(path, use_snapshot) for path in paths]
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    if workers < 2:
+        return [unpack(parse_file(task)) for task in tasks]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return [unpack(packed) for packed in pool.map(parse_file, tasks)]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_directory(path, files=None, use_snapshot=False, workers=None):
+    """
+    Loads all CSV files in directory, returns (store, files).
+
+    `files` maps path of every file to its (signature, store), previously
+    returned mapping can be passed back to reuse unchanged files.
+    """
+    files = files or {}
+    signatures = file_signatures(path)
+    changed = sorted(
+        name for name, signature in signatures.iteritems()
+        if name not in files or files[name][0] != signature
+    )
+    if changed:
+        log.info('Parsing %d of %d files in %s',
+                 len(changed), len(signatures), path)
+    current = dict(
+        (name, files[name]) for name in signatures if name not in changed
+    )
+    for name, store in zip(
+            changed, parse_files(changed, use_snapshot, workers)):
+        current[name] = (signatures[name], store)
+
+    store, conflicts = PresenceStore.combine(
+        [current[name][1] for name in sorted(current)]
+    )
+    if conflicts:
+        log.info('%d records in %s were overridden by later files',
+                 conflicts, path)
+    return store, current
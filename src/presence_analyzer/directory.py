@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Sorted directory of users with summaries of their records.
+
+Every snapshot builds the directory once, when its data is loaded. Users are
+ordered by id, which is also the order of pages and of cursors, so a page
+of all users is sliced directly. Searching bisects a sorted list of
+lower-cased names and ids and visits only users matching the prefix.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date
+
+# first and last day (ordinals) and number of days with records
+UserSummary = namedtuple('UserSummary', ('first', 'last', 'days'))
+
+
+def user_name(user_id):
+    """
+    Returns display name of user.
+    """
+    return 'User {0}'.format(user_id)
+
+
+def build_user_summaries(store):
+    """
+    Returns dict mapping user_id to UserSummary of PresenceStore.
+
+    Records of every user are sorted by day and unique, so only the ends
+    of its slice are read.
+    """
+    summaries = {}
+    for user_id, (begin, end) in store.offsets.iteritems():
+        if begin < end:
+            summaries[user_id] = UserSummary(
+                store.days[begin], store.days[end - 1], end - begin
+            )
+    return summaries
+
+
+class UserDirectory(object):
+    """
+    Users sorted by id together with prefix search index.
+    """
+
+    def __init__(self, summaries):
+        self.user_ids = sorted(summaries)
+        self.entries = [
+            {
+                'user_id': user_id,
+                'name': user_name(user_id),
+                'first_seen': date.fromordinal(
+                    summaries[user_id].first
+                ).isoformat(),
+                'last_seen': date.fromordinal(
+                    summaries[user_id].last
+                ).isoformat(),
+                'days': summaries[user_id].days,
+            }
+            for user_id in self.user_ids
+        ]
+        # users are found by prefix of their name as well as of their id
+        self.keys = sorted(
+            (key, position)
+            for position, entry in enumerate(self.entries)
+            for key in (entry['name'].lower(), str(entry['user_id']))
+        )
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, prefix):
+        """
+        Returns sorted positions of users whose name or id starts with
+        prefix, ignoring case.
+        """
+        prefix = prefix.lower()
+        positions = set()
+        for index in xrange(bisect_left(self.keys, (prefix,)),
+                            len(self.keys)):
+            key, position = self.keys[index]
+            if not key.startswith(prefix):
+                break
+            positions.add(position)
+        return sorted(positions)
+
+    def page(self, prefix=None, offset=0, limit=None, cursor=None):
+        """
+        Returns (entries, total, next_cursor) of one page of users.
+
+        Users are optionally limited to those matching prefix, the page
+        starts after user_id given as cursor and skips `offset` users.
+        `total` counts all matching users and `next_cursor` is the cursor of
+        the following page, None on the last one.
+        """
+        positions = self.search(prefix) if prefix else None
+        total = len(self.entries) if positions is None else len(positions)
+        start = offset
+        if cursor is not None:
+            after = bisect_right(self.user_ids, cursor)
+            start += after if positions is None else \
+                bisect_left(positions, after)
+        stop = total if limit is None else min(total, start + limit)
+        if positions is None:
+            entries = self.entries[start:stop]
+        else:
+            entries = [self.entries[position]
+                       for position in positions[start:stop]]
+        next_cursor = entries[-1]['user_id'] if entries and \
+            stop < total else None
+        return entries, total, next_cursor
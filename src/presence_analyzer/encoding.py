@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+JSON encoding and compression of API responses.
+
+Responses are serialized by ujson when it's installed and by the standard
+json module otherwise, JSON_ENCODER selects one of them explicitly. Tables
+of fixed shape, like the seven weekday rows, are encoded by filling
+a template compiled once instead of walking them with an encoder.
+"""
+
+import json
+import zlib
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None  # pylint: disable=invalid-name
+
+
+def _ujson_dumps(value):
+    """
+    Serializes value with ujson, leaving slashes unescaped like json does.
+    """
+    return ujson.dumps(value, escape_forward_slashes=False)
+
+
+ENCODERS = {'json': json.dumps}
+if ujson is not None:
+    ENCODERS['ujson'] = _ujson_dumps
+# preferred encoders, the first installed one is used by default
+PREFERENCE = ('ujson', 'json')
+
+
+def get_encoder(name=None):
+    """
+    Returns function serializing values to JSON.
+
+    Without a name the fastest installed encoder is returned.
+    """
+    if not name:
+        name = next(name for name in PREFERENCE if name in ENCODERS)
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError('Unknown or missing JSON encoder: {0}'.format(name))
+
+
+class Table(list):
+    """
+    Rows of a table created by TableFormat, encoded by its template.
+    """
+
+    def __init__(self, table_format, rows):
+        super(Table, self).__init__(rows)
+        self.table_format = table_format
+
+
+class TableFormat(object):
+    """
+    Precompiled JSON encoding of tables with fixed labels and row width.
+
+    Every row starts with one of `labels` followed by `width` ints or
+    floats, an optional `header` row comes first. Numbers are formatted by
+    repr, which gives the same representation as json.dumps.
+    """
+
+    def __init__(self, labels, width, header=None):
+        self.labels = tuple(labels)
+        self.width = width
+        self.header = tuple(header) if header else None
+        rows = [
+            '[{0}, {1}]'.format(_escape(json.dumps(label)),
+                                ', '.join(['%r'] * width))
+            for label in self.labels
+        ]
+        if self.header:
+            rows.insert(0, _escape(json.dumps(self.header)))
+        # same separators as json.dumps, so output doesn't depend on encoder
+        self.template = '[{0}]'.format(', '.join(rows))
+        self.rows = len(rows)
+
+    def table(self, values):
+        """
+        Returns Table of labels followed by rows of given values.
+        """
+        rows = [
+            (label,) + tuple(row) for label, row in zip(self.labels, values)
+        ]
+        if self.header:
+            rows.insert(0, self.header)
+        return Table(self, rows)
+
+    def encode(self, table):
+        """
+        Fills the template with numbers of the table.
+
+        Raises TypeError when the table doesn't match the template.
+        """
+        if len(table) != self.rows:
+            raise TypeError('Table has {0} rows instead of {1}'.format(
+                len(table), self.rows
+            ))
+        rows = table[1:] if self.header else table
+        return self.template % tuple([
+            value for row in rows for value in row[1:]
+        ])
+
+
+def _escape(text):
+    """
+    Escapes percent signs of literal template text.
+    """
+    return text.replace('%', '%%')
+
+
+def encode(value, encoder=None):
+    """
+    Serializes value to JSON, tables of known shape use their template.
+
+    Tables are found at the top level and among values of (nested) dicts,
+    so their numbers don't depend on the encoder.
+    """
+    if isinstance(value, Table):
+        try:
+            return value.table_format.encode(value)
+        except TypeError:
+            # table was changed after it had been built
+            pass
+    encoder = encoder or get_encoder()
+    if isinstance(value, dict) and _has_table(value):
+        # same separators as json.dumps
+        return '{{{0}}}'.format(', '.join(
+            '{0}: {1}'.format(_key(key), encode(item, encoder))
+            for key, item in sorted(value.iteritems())
+        ))
+    return encoder(value)
+
+
+def _key(key):
+    """
+    Encodes dict key, other keys than strings become strings like in json.
+    """
+    if not isinstance(key, basestring):
+        key = json.dumps(key)
+    return json.dumps(key)
+
+
+def _has_table(mapping):
+    """
+    Checks whether a Table is among values of dict or of its nested dicts.
+    """
+    return any(
+        isinstance(item, Table) or
+        (isinstance(item, dict) and _has_table(item))
+        for item in mapping.itervalues()
+    )
+
+
+def gzip_compress(body, level=6):
+    """
+    Returns body compressed in gzip format.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+def gzip_stream(chunks, level=6):
+    """
+    Compresses chunks of streamed response in gzip format as they come.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
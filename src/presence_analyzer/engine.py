@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregation engine computing weekday statistics from PresenceStore.
+
+When NumPy is installed statistics are computed with grouped reductions
+(bincount) over store columns, otherwise pure Python loops are used.
+"""
+
+from array import array
+from collections import namedtuple
+
+from store import weekday_from_ordinal
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None  # pylint: disable=invalid-name
+
+
+WeekdayStats = namedtuple('WeekdayStats', 'count presence start end')
+
+# WeekdayStats summed over a group of users, `users` is number of users
+# with at least one record on the weekday
+GroupStats = namedtuple('GroupStats', 'users count presence start end')
+
+# Cumulative sums of one user laid out as rows of seven weekdays, row `k`
+# holds totals of all days before week `k` counted from Monday `base`
+# (an ordinal), there are `weeks` + 1 rows. Only differences of two cells
+# of the same user are meaningful, see window_stats.
+UserPrefix = namedtuple('UserPrefix', 'base weeks count presence start end')
+
+# cumulative sums are kept as C longs
+SUM_TYPECODE = 'l'
+
+MINUTES = 24 * 60
+
+# Occupancy of every weekday: `minutes` are seven lists of MINUTES numbers
+# of users present in that minute summed over all dates, `dates` is number
+# of dates of each weekday with any records.
+Occupancy = namedtuple('Occupancy', 'minutes dates')
+
+
+def as_numpy(column):
+    """
+    Returns NumPy view of store column without copying it.
+    """
+    if isinstance(column, numpy.ndarray):
+        return column
+    if not len(column):
+        return numpy.zeros(0, dtype=numpy.intc)
+    return numpy.frombuffer(column, dtype=numpy.intc)
+
+
+def build_weekday_index(store, user_ids=None, use_numpy=None):
+    """
+    Computes per-weekday aggregates for given users (all by default).
+
+    Returns dict mapping every user_id present in store to a list of seven
+    WeekdayStats (Monday first) holding number of days, total presence time
+    and sums of start and end times in seconds since midnight.
+    """
+    if user_ids is None:
+        user_ids = store.offsets.keys()
+    user_ids = [user_id for user_id in user_ids if user_id in store]
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return _build_weekday_index_numpy(store, user_ids)
+    return _build_weekday_index_python(store, user_ids)
+
+
+def range_weekday_stats(store, user_id, first=None, last=None):
+    """
+    Returns seven WeekdayStats of a single user limited to a date range.
+
+    Bounds are inclusive ordinals (None means unbounded). Only records
+    within the range are visited.
+    """
+    return _sum_weekdays(store.user_rows(user_id, first, last))
+
+
+def build_prefix_index(store, user_ids=None, use_numpy=None):
+    """
+    Computes cumulative per-weekday sums for given users (all by default).
+
+    Returns dict mapping every user_id present in store to UserPrefix,
+    statistics of any date window are then answered by window_stats with
+    two lookups per weekday.
+    """
+    if user_ids is None:
+        user_ids = store.offsets.keys()
+    user_ids = [user_id for user_id in user_ids if user_id in store]
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return _build_prefix_index_numpy(store, user_ids)
+    return _build_prefix_index_python(store, user_ids)
+
+
+def window_stats(prefix, first=None, last=None):
+    """
+    Returns seven WeekdayStats of days from first to last from UserPrefix.
+
+    Both bounds are inclusive ordinals, None means unbounded.
+    """
+    stats = []
+    for weekday in range(7):
+        # first week in which this weekday is not before `first`
+        low = 0 if first is None else clamp(
+            -((prefix.base + weekday - first) // 7), 0, prefix.weeks
+        )
+        # first week in which this weekday is after `last`
+        high = prefix.weeks if last is None else clamp(
+            (last - prefix.base - weekday) // 7 + 1, low, prefix.weeks
+        )
+        low, high = low * 7 + weekday, high * 7 + weekday
+        stats.append(WeekdayStats(
+            prefix.count[high] - prefix.count[low],
+            prefix.presence[high] - prefix.presence[low],
+            prefix.start[high] - prefix.start[low],
+            prefix.end[high] - prefix.end[low],
+        ))
+    return stats
+
+
+def group_weekday_stats(user_stats, groups):
+    """
+    Sums weekday statistics of users by group.
+
+    `user_stats` yields (user_id, seven WeekdayStats) pairs, `groups` maps
+    user_id to its group, users missing from it fall into group None.
+    Returns dict mapping every group with any records to seven GroupStats.
+    """
+    sums = {}
+    for user_id, weekdays in user_stats:
+        if not any(stats.count for stats in weekdays):
+            continue
+        group = sums.setdefault(
+            groups.get(user_id), [[0] * 5 for dummy in range(7)]
+        )
+        for total, stats in zip(group, weekdays):
+            if stats.count:
+                total[0] += 1
+                total[1] += stats.count
+                total[2] += stats.presence
+                total[3] += stats.start
+                total[4] += stats.end
+    return dict(
+        (name, [GroupStats(*total) for total in group])
+        for name, group in sums.iteritems()
+    )
+
+
+def merge_group_stats(groups):
+    """
+    Sums lists of seven GroupStats of disjoint groups.
+    """
+    total = [GroupStats(0, 0, 0, 0, 0)] * 7
+    for weekdays in groups:
+        total = [
+            GroupStats(*[a + b for a, b in zip(left, right)])
+            for left, right in zip(total, weekdays)
+        ]
+    return total
+
+
+def build_occupancy(store, first=None, last=None, use_numpy=None):
+    """
+    Counts users present in every minute of every weekday.
+
+    Every record adds one at the minute it starts and subtracts one at the
+    minute it ends in a difference array of its weekday, prefix sums of the
+    arrays give Occupancy. Optional first and last ordinals (inclusive)
+    limit records to a date range.
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return _build_occupancy_numpy(store, first, last)
+    changes = [[0] * (MINUTES + 1) for dummy in range(7)]
+    dates = [set() for dummy in range(7)]
+    for user_id in store.user_ids():
+        for day, start, end in store.user_rows(user_id, first, last):
+            weekday = weekday_from_ordinal(day)
+            dates[weekday].add(day)
+            if end // 60 > start // 60:
+                changes[weekday][start // 60] += 1
+                changes[weekday][end // 60] -= 1
+    return occupancy_from_changes(changes, [len(days) for days in dates])
+
+
+def occupancy_from_changes(changes, dates):
+    """
+    Builds Occupancy from seven difference arrays of MINUTES + 1 items.
+    """
+    minutes = []
+    for weekday in changes:
+        present = 0
+        counts = [0] * MINUTES
+        for minute in xrange(MINUTES):
+            present += weekday[minute]
+            counts[minute] = present
+        minutes.append(counts)
+    return Occupancy(minutes, list(dates))
+
+
+def _build_occupancy_numpy(store, first, last):
+    """
+    NumPy implementation of build_occupancy.
+    """
+    days = as_numpy(store.days).astype(numpy.int64)
+    starts = as_numpy(store.starts) // 60
+    ends = as_numpy(store.ends) // 60
+    if first is not None or last is not None:
+        selected = numpy.ones(len(days), dtype=bool)
+        if first is not None:
+            selected &= days >= first
+        if last is not None:
+            selected &= days <= last
+        days, starts, ends = days[selected], starts[selected], ends[selected]
+    keys = (days + 6) % 7 * (MINUTES + 1)
+    valid = ends > starts
+    size = 7 * (MINUTES + 1)
+    changes = (
+        numpy.bincount((keys + starts)[valid], minlength=size) -
+        numpy.bincount((keys + ends)[valid], minlength=size)
+    )
+    minutes = changes.reshape(7, MINUTES + 1).cumsum(axis=1)[:, :MINUTES]
+    dates = numpy.bincount((numpy.unique(days) + 6) % 7, minlength=7)
+    return Occupancy(minutes.tolist(), dates.tolist())
+
+
+def clamp(value, lower, upper):
+    """
+    Limits value to given range.
+    """
+    return max(lower, min(upper, value))
+
+
+def _build_prefix_index_python(store, user_ids):
+    """
+    Pure Python implementation of build_prefix_index.
+    """
+    index = {}
+    for user_id in user_ids:
+        begin, end = store.user_slice(user_id)
+        base = store.days[begin] - weekday_from_ordinal(store.days[begin])
+        weeks = (store.days[end - 1] - base) // 7 + 1
+        size = (weeks + 1) * 7
+        columns = [array(SUM_TYPECODE, [0]) * size for dummy in range(4)]
+        count, presence, starts, ends = columns
+        for day, start, finish in store.user_rows(user_id):
+            # same weekday in the row after record's week
+            cell = day - base + 7
+            count[cell] += 1
+            presence[cell] += finish - start
+            starts[cell] += start
+            ends[cell] += finish
+        for column in columns:
+            for i in xrange(7, size):
+                column[i] += column[i - 7]
+        index[user_id] = UserPrefix(base, weeks, *columns)
+    return index
+
+
+def _build_prefix_index_numpy(store, user_ids):
+    """
+    NumPy implementation of build_prefix_index.
+
+    Records of all users are scattered into one table of weekly rows with
+    bincount and accumulated with a single cumsum. Rows of a user carry
+    totals of users before it, they cancel out in window_stats.
+    """
+    if not user_ids:
+        return {}
+    ordered = sorted(user_ids)
+    slices = [store.user_slice(user_id) for user_id in ordered]
+    days = as_numpy(store.days).astype(numpy.int64)
+    firsts = days[[begin for begin, dummy in slices]]
+    lasts = days[[end - 1 for dummy, end in slices]]
+    bases = firsts - (firsts + 6) % 7
+    weeks = (lasts - bases) // 7 + 1
+    # first row of every user in the table
+    rows = numpy.concatenate([[0], numpy.cumsum(weeks + 1)])
+
+    if len(ordered) == len(store.offsets):
+        selected = slice(None)
+    else:
+        selected = numpy.concatenate([
+            numpy.arange(begin, end, dtype=numpy.intp)
+            for begin, end in slices
+        ])
+    positions = numpy.repeat(
+        numpy.arange(len(ordered)), [end - begin for begin, end in slices]
+    )
+    days = days[selected]
+    starts = as_numpy(store.starts)[selected].astype(numpy.int64)
+    ends = as_numpy(store.ends)[selected].astype(numpy.int64)
+    cells = (rows[positions] + 1) * 7 + (days - bases[positions])
+
+    size = int(rows[-1]) * 7
+    columns = [
+        numpy.bincount(cells, weights=weights, minlength=size)
+        .astype(numpy.int64).reshape(-1, 7).cumsum(axis=0)
+        .ravel().astype(SUM_TYPECODE)
+        for weights in (None, ends - starts, starts, ends)
+    ]
+    index = {}
+    for position, user_id in enumerate(ordered):
+        low, high = rows[position] * 7, rows[position + 1] * 7
+        index[user_id] = UserPrefix(
+            int(bases[position]), int(weeks[position]), *[
+                array(SUM_TYPECODE, column[low:high].tostring())
+                for column in columns
+            ]
+        )
+    return index
+
+
+def _sum_weekdays(rows):
+    """
+    Sums (day, start, end) rows into seven WeekdayStats.
+    """
+    sums = [[0, 0, 0, 0] for dummy in range(7)]
+    for day, start, end in rows:
+        weekday = sums[weekday_from_ordinal(day)]
+        weekday[0] += 1
+        weekday[1] += end - start
+        weekday[2] += start
+        weekday[3] += end
+    return [WeekdayStats(*weekday) for weekday in sums]
+
+
+def _build_weekday_index_python(store, user_ids):
+    """
+    Pure Python implementation of build_weekday_index.
+    """
+    return dict(
+        (user_id, _sum_weekdays(store.user_rows(user_id)))
+        for user_id in user_ids
+    )
+
+
+def _build_weekday_index_numpy(store, user_ids):
+    """
+    NumPy implementation of build_weekday_index.
+
+    Every record gets a group key `user_position * 7 + weekday` and all sums
+    are computed with a single bincount per column.
+    """
+    if len(user_ids) == len(store.offsets):
+        rows = slice(None)
+    else:
+        rows = numpy.concatenate([
+            numpy.arange(*store.user_slice(user_id), dtype=numpy.intp)
+            for user_id in user_ids
+        ] or [numpy.zeros(0, dtype=numpy.intp)])
+    users = as_numpy(store.users)[rows]
+    days = as_numpy(store.days)[rows].astype(numpy.int64)
+    starts = as_numpy(store.starts)[rows].astype(numpy.int64)
+    ends = as_numpy(store.ends)[rows].astype(numpy.int64)
+
+    ordered = sorted(user_ids)
+    positions = numpy.searchsorted(numpy.array(ordered, dtype=numpy.int64),
+                                   users)
+    keys = positions * 7 + (days + 6) % 7
+    size = len(ordered) * 7
+    counts = numpy.bincount(keys, minlength=size)
+    presence = numpy.bincount(keys, weights=ends - starts, minlength=size)
+    start_sums = numpy.bincount(keys, weights=starts, minlength=size)
+    end_sums = numpy.bincount(keys, weights=ends, minlength=size)
+
+    columns = zip(
+        counts.tolist(),
+        presence.astype(numpy.int64).tolist(),
+        start_sums.astype(numpy.int64).tolist(),
+        end_sums.astype(numpy.int64).tolist(),
+    )
+    return dict(
+        (user_id, [
+            WeekdayStats(*column)
+            for column in columns[position * 7:position * 7 + 7]
+        ])
+        for position, user_id in enumerate(ordered)
+    )
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic presence data generator.
+
+Run with `bin/presence-generate --users 100 --days 365 output.csv`.
+"""
+
+import argparse
+import datetime
+import random
+import sys
+
+
+def clamp(value, lower, upper):
+    """
+    Limits value to given range.
+    """
+    return max(lower, min(upper, value))
+
+
+def format_time(seconds):
+    """
+    Formats seconds since midnight as HH:MM:SS.
+    """
+    minutes, second = divmod(int(seconds), 60)
+    hour, minute = divmod(minutes, 60)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hour, minute, second)
+
+
+def malformed_line(generator, user_id, date):
+    """
+    Returns one of typical broken lines.
+    """
+    return generator.choice([
+        'user_id,date,start,end',
+        '{0},{1}'.format(user_id, date),
+        '{0},{1},25:61:00,17:00:00'.format(user_id, date),
+        '{0},{1},09:00:00'.format(user_id, date),
+        'x{0},{1},09:00:00,17:00:00'.format(user_id, date),
+    ])
+
+
+def generate(stream, users=100, days=365, missing=0.1, malformed=0.0,
+             rows=None, start=datetime.date(2013, 1, 1), seed=0):
+    """
+    Writes realistic presence CSV to stream and returns number of rows.
+
+    Rows are grouped by user and ordered by date like in real exports.
+    Weekends are mostly skipped, other days are skipped with `missing`
+    probability and `malformed` is a probability of inserting a broken
+    line. Generation stops after `rows` valid rows, if given.
+    """
+    generator = random.Random(seed)
+    written = 0
+    for user_id in xrange(10, 10 + users):
+        arrival = generator.gauss(9 * 3600, 1800)
+        for offset in xrange(days):
+            date = start + datetime.timedelta(days=offset)
+            weekend = date.weekday() >= 5
+            if generator.random() < (0.97 if weekend else missing):
+                continue
+            if malformed and generator.random() < malformed:
+                stream.write(malformed_line(generator, user_id, date) + '\n')
+            begin = clamp(generator.gauss(arrival, 2700), 0, 86000)
+            end = clamp(begin + generator.gauss(8 * 3600, 3600), begin, 86399)
+            stream.write('{0},{1},{2},{3}\n'.format(
+                user_id, date, format_time(begin), format_time(end)
+            ))
+            written += 1
+            if rows is not None and written >= rows:
+                return written
+    return written
+
+
+def generate_rows(path, rows, users=None, seed=0):
+    """
+    Writes file with exactly `rows` valid rows, returns its path.
+
+    Number of users defaults to one per 250 rows (about a year of data).
+    """
+    users = users or max(1, rows // 250)
+    # about 0.65 of days have a row with default `missing`, count with 0.6
+    # so that enough days are generated to reach `rows`
+    days = int(rows / (users * 0.6)) + 7
+    with open(path, 'w') as csvfile:
+        generate(csvfile, users=users, days=days, rows=rows, seed=seed)
+    return path
+
+
+def run(argv=None):
+    """
+    Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description='Generate presence CSV.')
+    parser.add_argument('output', help='output file, - for stdout')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--rows', type=int, help='stop after that many rows')
+    parser.add_argument('--missing', type=float, default=0.1,
+                        help='probability of missing workday')
+    parser.add_argument('--malformed', type=float, default=0.0,
+                        help='probability of malformed line')
+    parser.add_argument('--start', default='2013-01-01',
+                        help='first day, YYYY-MM-DD')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    start = datetime.datetime.strptime(args.start, '%Y-%m-%d').date()
+    stream = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        written = generate(
+            stream, users=args.users, days=args.days, missing=args.missing,
+            malformed=args.malformed, rows=args.rows, start=start,
+            seed=args.seed,
+        )
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    sys.stderr.write('Wrote {0} rows\n'.format(written))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Fast parsing of presence CSV exports.
+
+Lines have fixed layout `user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS`, so fields
+are sliced and converted to integers instead of going through
+datetime.strptime. Times are represented as seconds since midnight.
+"""
+
+import csv
+import datetime
+import os
+import zlib
+from collections import namedtuple
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+# bounds of user ids, which are stored in C int columns
+MIN_USER_ID = -2 ** 31
+MAX_USER_ID = 2 ** 31 - 1
+
+
+def parse_date(value):
+    """
+    Converts `YYYY-MM-DD` string to datetime.date.
+    """
+    if len(value) != 10 or value[4] != '-' or value[7] != '-':
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    return datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+
+
+def parse_user_id(value):
+    """
+    Converts user id to int, it has to fit C int columns of the store.
+    """
+    user_id = int(value)
+    if not MIN_USER_ID <= user_id <= MAX_USER_ID:
+        raise ValueError('User id out of range: {0!r}'.format(value))
+    return user_id
+
+
+def parse_time(value):
+    """
+    Converts `HH:MM:SS` string to amount of seconds since midnight.
+    """
+    if len(value) != 8 or value[2] != ':' or value[5] != ':':
+        time = datetime.datetime.strptime(value, '%H:%M:%S').time()
+        return time.hour * 3600 + time.minute * 60 + time.second
+    hour, minute, second = int(value[0:2]), int(value[3:5]), int(value[6:8])
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError('Time out of range: {0!r}'.format(value))
+    return hour * 3600 + minute * 60 + second
+
+
+def iter_rows(lines):
+    """
+    Yields (user_id, date, start, end) tuples for every valid line.
+
+    Dates are datetime.date objects shared between rows through a small
+    cache, start and end are seconds since midnight. Header, footer and
+    malformed lines are skipped.
+    """
+    dates = {}
+    times = {}
+    for i, line in enumerate(lines):
+        try:
+            row = parse_line(line, dates, times)
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+        if row is not None:
+            yield row
+
+
+def parse_line(line, dates, times):
+    """
+    Returns (user_id, date, start, end) of line, see iter_rows.
+
+    Parsed dates and times are cached in given dicts. Header and footer
+    lines give None, malformed lines raise ValueError or TypeError.
+    """
+    fields = split_fields(line)
+    if len(fields) != 4:
+        # ignore header and footer lines
+        return None
+
+    user_id, date, start, end = fields
+    user_id = parse_user_id(user_id)
+    if date not in dates:
+        dates[date] = parse_date(date)
+    if start not in times:
+        times[start] = parse_time(start)
+    if end not in times:
+        times[end] = parse_time(end)
+    return user_id, dates[date], times[start], times[end]
+
+
+def split_fields(line):
+    """
+    Splits CSV line into fields.
+
+    Plain lines are split on commas, lines with quoted fields go through
+    csv module.
+    """
+    if '"' in line:
+        return next(csv.reader([line]), [])
+    return line.rstrip('\r\n').split(',')
+
+
+def iter_rows_strptime(lines):
+    """
+    Reference parser using datetime.strptime, yields same rows as iter_rows.
+
+    It is kept to verify and benchmark the fast path.
+    """
+    for i, line in enumerate(lines):
+        fields = split_fields(line)
+        if len(fields) != 4:
+            continue
+
+        try:
+            user_id = parse_user_id(fields[0])
+            date = datetime.datetime.strptime(fields[1], '%Y-%m-%d').date()
+            start = datetime.datetime.strptime(fields[2], '%H:%M:%S').time()
+            end = datetime.datetime.strptime(fields[3], '%H:%M:%S').time()
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+
+        yield (
+            user_id,
+            date,
+            start.hour * 3600 + start.minute * 60 + start.second,
+            end.hour * 3600 + end.minute * 60 + end.second,
+        )
+
+
+def iter_teams(lines):
+    """
+    Yields (user_id, team) tuples of `user_id,team` lines mapping users
+    to teams. Header and malformed lines are skipped.
+    """
+    for i, fields in enumerate(csv.reader(lines)):
+        if len(fields) != 2 or not fields[1].strip():
+            continue
+        try:
+            user_id = int(fields[0])
+            team = fields[1].strip().decode('utf-8')
+        except (ValueError, UnicodeDecodeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            continue
+        yield user_id, team
+
+
+def time_from_seconds(seconds):
+    """
+    Converts seconds since midnight to a (cached) datetime.time object.
+    """
+    try:
+        return _TIMES[seconds]
+    except KeyError:
+        minutes, second = divmod(seconds, 60)
+        hour, minute = divmod(minutes, 60)
+        time = _TIMES[seconds] = datetime.time(hour, minute, second)
+        return time
+
+
+_TIMES = {}
+
+
+# number of leading bytes used to detect rewritten files
+HEAD_BYTES = 4096
+# how far back from the end of file to look for last line break
+TAIL_BYTES = 4096
+
+# Describes which part of append-only CSV file was already parsed.
+# `offset` points right after last complete line, `head_length` and
+# `head_checksum` describe beginning of the file to detect rewritten files.
+SourceState = namedtuple(
+    'SourceState', 'inode size offset head_length head_checksum'
+)
+
+
+def source_state(path):
+    """
+    Returns SourceState of the whole CSV file.
+    """
+    with open(path, 'rb') as csvfile:
+        stat = os.fstat(csvfile.fileno())
+        head = csvfile.read(HEAD_BYTES)
+        tail_start = max(0, stat.st_size - TAIL_BYTES)
+        csvfile.seek(tail_start)
+        tail = csvfile.read(stat.st_size - tail_start)
+    return SourceState(
+        stat.st_ino, stat.st_size, tail_start + tail.rfind('\n') + 1,
+        len(head), zlib.crc32(head),
+    )
+
+
+def read_tail(path, state):
+    """
+    Parses lines appended to CSV file since given SourceState.
+
+    Returns (rows, state) tuple or None when file was truncated or rewritten
+    and has to be parsed from scratch. Unterminated last line is parsed too,
+    but it will be parsed again once it's complete.
+    """
+    with open(path, 'rb') as csvfile:
+        stat = os.fstat(csvfile.fileno())
+        if stat.st_ino != state.inode or stat.st_size < state.size:
+            return None
+        head = csvfile.read(state.head_length)
+        if zlib.crc32(head) != state.head_checksum:
+            return None
+        csvfile.seek(state.offset)
+        chunk = csvfile.read(stat.st_size - state.offset)
+
+    rows = list(iter_rows(chunk.splitlines(True)))
+    return rows, state._replace(
+        size=state.offset + len(chunk),
+        offset=state.offset + chunk.rfind('\n') + 1,
+    )
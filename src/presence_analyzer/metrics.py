@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Request and hot-path instrumentation exposed in Prometheus text format.
+"""
+
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from timeit import default_timer
+
+from flask import request
+from werkzeug.wsgi import ClosingIterator
+
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+ENDPOINT_KEY = 'presence_analyzer.endpoint'
+
+
+def format_labels(names, values, extra=()):
+    """
+    Formats label set as `{name="value",...}`.
+    """
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, escape(value)) for name, value in pairs
+    ) + '}'
+
+
+def escape(value):
+    """
+    Escapes label value.
+    """
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n'
+    )
+
+
+def format_value(value):
+    """
+    Formats sample value.
+    """
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Counter(object):
+    """
+    Monotonically increasing value per label set.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        """
+        Increments value of given label set.
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        """
+        Yields exposition lines of all label sets.
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '{0}{1} {2}'.format(
+                self.name, format_labels(self.labelnames, labels),
+                format_value(value),
+            )
+
+
+class Histogram(object):
+    """
+    Distribution of observed durations per label set.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        """
+        Records one observation.
+        """
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # per bucket counts (last one is +Inf), sum
+                entry = self._values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+            entry[0][position] += 1
+            entry[1] += value
+
+    def samples(self):
+        """
+        Yields exposition lines of all label sets.
+        """
+        with self._lock:
+            values = sorted(
+                (labels, list(counts), total)
+                for labels, (counts, total) in self._values.items()
+            )
+        bounds = [repr(bound) for bound in self.buckets] + ['+Inf']
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(
+                    self.name,
+                    format_labels(self.labelnames, labels, [('le', bound)]),
+                    cumulative,
+                )
+            label_set = format_labels(self.labelnames, labels)
+            yield '{0}_sum{1} {2!r}'.format(self.name, label_set, total)
+            yield '{0}_count{1} {2}'.format(self.name, label_set, cumulative)
+
+
+class Registry(object):
+    """
+    Collection of metrics and callbacks rendered together.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        """
+        Registers metric object and returns it.
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def register(self, collector):
+        """
+        Registers callable returning (name, kind, help, [(labels, value)]).
+
+        It's used for values kept elsewhere, like cache statistics.
+        """
+        self.collectors.append(collector)
+        return collector
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(
+                metric.name, metric.documentation
+            ))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        for collector in self.collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append('# HELP {0} {1}'.format(name, documentation))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for labels, value in samples:
+                    lines.append('{0}{1} {2}'.format(
+                        name, format_labels(
+                            [label for label, dummy in labels],
+                            [label_value for dummy, label_value in labels],
+                        ),
+                        format_value(value),
+                    ))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REQUEST_DURATION = REGISTRY.add(Histogram(
+    'presence_request_duration_seconds',
+    'Time spent handling requests.',
+    ('endpoint',),
+))
+REQUESTS = REGISTRY.add(Counter(
+    'presence_requests_total',
+    'Number of handled requests.',
+    ('endpoint', 'status'),
+))
+PHASE_DURATION = REGISTRY.add(Histogram(
+    'presence_phase_duration_seconds',
+    'Time spent in data loading, aggregation and serialization.',
+    ('phase',),
+))
+
+
+@contextmanager
+def timed(phase):
+    """
+    Records duration of the block in PHASE_DURATION histogram.
+    """
+    started = default_timer()
+    try:
+        yield
+    finally:
+        PHASE_DURATION.observe((phase,), default_timer() - started)
+
+
+class MetricsMiddleware(object):
+    """
+    WSGI middleware recording latency and count of requests per endpoint.
+
+    Latency covers the whole response, including streamed bodies.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        started = default_timer()
+        status = []
+
+        def _start_response(status_line, headers, exc_info=None):
+            """
+            Remembers response status code.
+            """
+            status.append(status_line.split(' ', 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        def finished():
+            """
+            Records the request once its body was sent.
+            """
+            endpoint = environ.get(ENDPOINT_KEY) or 'unmatched'
+            REQUEST_DURATION.observe(
+                (endpoint,), default_timer() - started
+            )
+            REQUESTS.inc((endpoint, status[0] if status else '500'))
+
+        try:
+            app_iter = self.app(environ, _start_response)
+        except Exception:
+            finished()
+            raise
+        return ClosingIterator(app_iter, finished)
+
+
+def install(app):
+    """
+    Wraps Flask application's WSGI callable with MetricsMiddleware.
+    """
+    if 'presence_metrics' in app.extensions:
+        return app
+    app.extensions['presence_metrics'] = True
+
+    @app.before_request
+    def remember_endpoint():  # pylint: disable=unused-variable
+        """
+        Exposes matched endpoint to the middleware.
+        """
+        request.environ[ENDPOINT_KEY] = request.endpoint
+
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+    return app
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+On-demand profiling of single requests.
+
+With PROFILING_ENABLED set, requests coming from PROFILING_ALLOWED addresses
+with `X-Profile` header or `profile` query parameter are run under cProfile.
+Value `save` writes .prof file to PROFILING_DIR and returns the regular
+response, any other value returns top functions by cumulative time.
+"""
+
+import cProfile
+import os
+import pstats
+import re
+import time
+from cStringIO import StringIO
+from urlparse import parse_qs
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+PROFILING_KEY = 'presence_analyzer.profiling'
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware running selected requests under cProfile.
+    """
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def requested_mode(self, environ):
+        """
+        Returns 'save', 'stats' or None if request shouldn't be profiled.
+        """
+        config = self.app.config
+        if not config.get('PROFILING_ENABLED'):
+            return None
+        value = environ.get('HTTP_X_PROFILE') or parse_qs(
+            environ.get('QUERY_STRING', '')
+        ).get('profile', [None])[0]
+        if not value:
+            return None
+        allowed = config.get('PROFILING_ALLOWED', ('127.0.0.1',))
+        if environ.get('REMOTE_ADDR') not in allowed:
+            log.warning(
+                'Profiling request from %s refused', environ.get('REMOTE_ADDR')
+            )
+            return None
+        return 'save' if value == 'save' else 'stats'
+
+    def __call__(self, environ, start_response):
+        mode = self.requested_mode(environ)
+        if mode is None:
+            return self.wsgi_app(environ, start_response)
+
+        environ[PROFILING_KEY] = mode
+        response = {}
+        body = []
+
+        def _start_response(status, headers, exc_info=None):
+            """
+            Captures response status and headers.
+            """
+            response['status'] = status
+            response['headers'] = headers
+            return body.append
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            app_iter = self.wsgi_app(environ, _start_response)
+            try:
+                # streamed bodies are generated under the profiler too
+                body.extend(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        finally:
+            profiler.disable()
+
+        if mode == 'save':
+            path = self.save(profiler, environ)
+            start_response(
+                response['status'],
+                response['headers'] + [('X-Profile-File', path)],
+            )
+            return body
+
+        report = self.report(profiler)
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; charset=utf-8'),
+            ('Content-Length', str(len(report))),
+        ])
+        return [report]
+
+    def save(self, profiler, environ):
+        """
+        Dumps profile to PROFILING_DIR and returns path of the file.
+        """
+        directory = self.app.config.get('PROFILING_DIR') or 'var/log'
+        name = re.sub(
+            r'[^A-Za-z0-9]+', '_', environ.get('PATH_INFO', '')
+        ).strip('_') or 'root'
+        path = os.path.join(directory, '{0}-{1}.prof'.format(
+            name, int(time.time() * 1000)
+        ))
+        profiler.dump_stats(path)
+        log.info('Saved profile of %s to %s', environ.get('PATH_INFO'), path)
+        return path
+
+    def report(self, profiler):
+        """
+        Returns top functions by cumulative time as text.
+        """
+        stream = StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(
+            self.app.config.get('PROFILING_LIMIT', 30)
+        )
+        return stream.getvalue()
+
+
+def install(app):
+    """
+    Wraps Flask application's WSGI callable with ProfilingMiddleware.
+    """
+    if 'presence_profiling' not in app.extensions:
+        app.wsgi_app = ProfilingMiddleware(app, app.wsgi_app)
+        app.extensions['presence_profiling'] = True
+    return app
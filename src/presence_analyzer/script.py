@@ -27,9 +27,14 @@ del _buildout_path
 
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
-    from presence_analyzer import app
+    from presence_analyzer import app, metrics, profiling
+    from presence_analyzer.backends import start_refresher
+    app.config['PROFILING_DIR'] = abspath('var', 'log')
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    profiling.install(app)
+    metrics.install(app)
+    start_refresher()
     return app
 
 
@@ -78,6 +83,45 @@ def _serve(action, debug=False, dry_run=False):
     paste.script.command.run()
 
 
+# bin/flask-ctl snapshot
+def make_snapshot(debug=False):
+    """Compile DATA_CSV or files in DATA_DIR into binary snapshots."""
+    from presence_analyzer import app
+    from presence_analyzer.datadir import list_files
+    from presence_analyzer.snapshot import build_snapshot, snapshot_path
+    app.config.from_pyfile(abspath(DEBUG_CFG if debug else DEPLOY_CFG))
+    if app.config.get('DATA_DIR'):
+        csv_paths = list_files(app.config['DATA_DIR'])
+    else:
+        csv_paths = [app.config['DATA_CSV']]
+    for csv_path in csv_paths:
+        store = build_snapshot(csv_path)
+        print 'Wrote {0} records of {1} users to {2}'.format(
+            len(store), len(store.offsets), snapshot_path(csv_path)
+        )
+
+
+# bin/flask-ctl publish
+def make_publish(debug=False):
+    """Publish presence data to a new shared memory segment generation."""
+    from presence_analyzer import app, shared
+    from presence_analyzer.backends import data_path, publish_data
+    from presence_analyzer.backends import shared_directory
+    app.config.from_pyfile(abspath(DEBUG_CFG if debug else DEPLOY_CFG))
+    directory = shared_directory()
+    lock = shared.try_lock(directory)
+    if lock is None:
+        print 'Publisher of {0} is running, it publishes changes'.format(
+            directory
+        )
+        return
+    try:
+        path = publish_data(directory, data_path())
+    finally:
+        shared.unlock(lock)
+    print 'Published {0}'.format(path) if path else 'Already up to date'
+
+
 # bin/flask-ctl ...
 def run():
     action_shell = werkzeug.script.make_shell(make_shell, make_shell.__doc__)
@@ -110,4 +154,14 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl snapshot [--debug]
+    def action_snapshot(debug=False):
+        """Compile presence data into binary snapshots for fast startup."""
+        make_snapshot(debug=debug)
+
+    # bin/flask-ctl publish [--debug]
+    def action_publish(debug=False):
+        """Publish presence data for workers using shared backend."""
+        make_publish(debug=debug)
+
     werkzeug.script.run()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data shared by worker processes through memory-mapped segments.
+
+The process holding the publisher lock loads presence data and writes it,
+together with weekday and prefix indexes, to a segment file in SHARED_DIR.
+Other processes map the segment instead of parsing data themselves, columns
+are used in place so its pages are shared through the page cache. Every
+reload is written as a new generation and the `current` pointer is replaced
+atomically. Workers switch to it on their next refresh while the previous
+mapping stays valid for requests in flight.
+
+Segment layout (native byte order, every section padded to 8 bytes):
+
+    header                      - magic, format version, generation,
+                                  number of users, records and prefix cells,
+                                  signature of source data,
+    user_ids, begins, ends      - int per user, slices of record columns,
+    bases, weeks, rows          - long per user, layout of prefix sums,
+    users, days, starts, ends   - int record columns,
+    weekdays                    - long WeekdayStats fields, 7 * 4 per user,
+    count, presence, start, end - long prefix sums, `cells` each,
+    sketches                    - unsigned short quantile sketch counts,
+                                  sketch.CELLS per user.
+"""
+
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+
+from engine import UserPrefix, WeekdayStats
+from sketch import CELLS
+from store import PresenceStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+MAGIC = 'PRESHARE'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('=8sIIqqqqqqd')
+POINTER = 'current'
+LOCK = 'publisher.lock'
+PREFIX = 'presence-'
+SUFFIX = '.seg'
+# generations kept on disk, older ones are removed on publish
+KEEP = 2
+# (array typecode, ctypes type) of int, long and sketch sections
+INT = ('i', ctypes.c_int)
+LONG = ('l', ctypes.c_long)
+SKETCH = ('H', ctypes.c_ushort)
+
+
+class SegmentError(Exception):
+    """
+    Segment file is missing or invalid.
+    """
+
+
+def pointer_path(directory):
+    """
+    Returns path of the file naming current segment.
+    """
+    return os.path.join(directory, POINTER)
+
+
+def _aligned(size):
+    """
+    Rounds size up to multiple of 8 bytes.
+    """
+    return (size + 7) & ~7
+
+
+def _layout(user_count, record_count, cell_count):
+    """
+    Returns (type, count) of every section following the header.
+    """
+    return (
+        [(INT, user_count)] * 3 + [(LONG, user_count)] * 3 +
+        [(INT, record_count)] * 4 + [(LONG, user_count * 28)] +
+        [(LONG, cell_count)] * 4 + [(SKETCH, user_count * CELLS)]
+    )
+
+
+def write_segment(path, generation, presence):
+    """
+    Atomically writes store and indexes of PresenceData to a segment file.
+    """
+    store = presence.store
+    user_ids = store.user_ids()
+    slices = [store.offsets[user_id] for user_id in user_ids]
+    prefixes = [presence.prefix[user_id] for user_id in user_ids]
+    rows = []
+    cell_count = 0
+    for prefix in prefixes:
+        rows.append(cell_count // 7)
+        cell_count += (prefix.weeks + 1) * 7
+    weekdays = array(LONG[0])
+    for user_id in user_ids:
+        for stats in presence.weekdays[user_id]:
+            weekdays.extend(stats)
+    sums = [array(LONG[0]) for dummy in range(4)]
+    for prefix in prefixes:
+        for column, values in zip(sums, prefix[2:]):
+            column.extend(values)
+    sketches = array(SKETCH[0])
+    for user_id in user_ids:
+        sketches.extend(presence.sketches[user_id])
+    sections = [
+        user_ids,
+        [begin for begin, dummy in slices],
+        [end for dummy, end in slices],
+        [prefix.base for prefix in prefixes],
+        [prefix.weeks for prefix in prefixes],
+        rows,
+        store.users, store.days, store.starts, store.ends,
+        weekdays,
+    ] + sums + [sketches]
+
+    inode, size, mtime = presence.signature
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, generation,
+        len(user_ids), len(store), cell_count, inode, size, mtime,
+    )
+    layout = _layout(len(user_ids), len(store), cell_count)
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.segment-', delete=False) as segfile:
+        try:
+            segfile.write(header)
+            for ((typecode, dummy), dummy), values in zip(layout, sections):
+                if not isinstance(values, array) or \
+                        values.typecode != typecode:
+                    values = array(typecode, values)
+                data = values.tostring()
+                segfile.write(data)
+                segfile.write('\0' * (_aligned(len(data)) - len(data)))
+        except Exception:
+            os.unlink(segfile.name)
+            raise
+    os.rename(segfile.name, path)
+
+
+def read_header(path):
+    """
+    Returns unpacked header of segment file.
+    """
+    try:
+        with open(path, 'rb') as segfile:
+            data = segfile.read(HEADER.size)
+    except (IOError, OSError) as error:
+        raise SegmentError('Cannot read {0}: {1}'.format(path, error))
+    if len(data) < HEADER.size:
+        raise SegmentError('Truncated segment {0}'.format(path))
+    header = HEADER.unpack(data)
+    if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+        raise SegmentError('Unsupported segment {0}'.format(path))
+    return header
+
+
+def read_segment(path):
+    """
+    Maps segment file, returns (generation, store, weekdays, prefix,
+    sketches, signature) without copying its columns.
+    """
+    header = read_header(path)
+    generation, user_count, record_count, cell_count = header[3:7]
+    try:
+        with open(path, 'rb') as segfile:
+            # private mapping, columns are never written to
+            mapped = mmap.mmap(segfile.fileno(), 0, access=mmap.ACCESS_COPY)
+    except (IOError, OSError, ValueError) as error:
+        raise SegmentError('Cannot map {0}: {1}'.format(path, error))
+
+    layout = _layout(user_count, record_count, cell_count)
+    size = HEADER.size + sum(
+        _aligned(ctypes.sizeof(ctype) * count)
+        for (dummy, ctype), count in layout
+    )
+    if len(mapped) != size:
+        raise SegmentError('Truncated segment {0}'.format(path))
+    sections = []
+    offsets = []
+    offset = HEADER.size
+    for (dummy, ctype), count in layout:
+        # arrays keep reference to the mapping, it's unmapped with them
+        sections.append((ctype * count).from_buffer(mapped, offset))
+        offsets.append(offset)
+        offset += _aligned(ctypes.sizeof(ctype) * count)
+
+    user_ids, begins, ends, bases, weeks, rows = [
+        list(section) for section in sections[:6]
+    ]
+    store = PresenceStore(
+        *sections[6:10], offsets=dict(zip(user_ids, zip(begins, ends)))
+    )
+    flat = sections[10]
+    weekdays = dict(
+        (user_id, [
+            WeekdayStats(*flat[cell:cell + 4])
+            for cell in xrange(position * 28, position * 28 + 28, 4)
+        ])
+        for position, user_id in enumerate(user_ids)
+    )
+    prefix = {}
+    itemsize = ctypes.sizeof(ctypes.c_long)
+    for position, user_id in enumerate(user_ids):
+        cells = (weeks[position] + 1) * 7
+        prefix[user_id] = UserPrefix(bases[position], weeks[position], *[
+            (ctypes.c_long * cells).from_buffer(
+                mapped, start + rows[position] * 7 * itemsize
+            )
+            for start in offsets[11:15]
+        ])
+    sketches = dict(
+        (user_id, (ctypes.c_ushort * CELLS).from_buffer(
+            mapped, offsets[15] + position * CELLS * ctypes.sizeof(
+                ctypes.c_ushort
+            )
+        ))
+        for position, user_id in enumerate(user_ids)
+    )
+    return (generation, store, weekdays, prefix, sketches,
+            tuple(header[7:]))
+
+
+def current_segment(directory):
+    """
+    Returns path of current segment or None when nothing was published.
+    """
+    try:
+        with open(pointer_path(directory)) as pointer:
+            name = pointer.read().strip()
+    except IOError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise
+    return os.path.join(directory, name)
+
+
+def publish(directory, presence):
+    """
+    Writes PresenceData as a new generation and makes it current.
+
+    Returns path of the new segment.
+    """
+    _makedirs(directory)
+    current = current_segment(directory)
+    generation = read_header(current)[3] + 1 if current else 1
+    name = '{0}{1:08d}{2}'.format(PREFIX, generation, SUFFIX)
+    path = os.path.join(directory, name)
+    write_segment(path, generation, presence)
+
+    with tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.pointer-', delete=False) as pointer:
+        pointer.write(name)
+    os.rename(pointer.name, pointer_path(directory))
+    log.info('Published generation %d of presence data to %s',
+             generation, path)
+
+    # processes still mapping removed files keep their pages
+    segments = sorted(
+        old for old in os.listdir(directory)
+        if old.startswith(PREFIX) and old.endswith(SUFFIX)
+    )
+    for old in segments[:-KEEP]:
+        os.remove(os.path.join(directory, old))
+    return path
+
+
+def _makedirs(directory):
+    """
+    Creates directory unless it already exists.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def try_lock(directory, blocking=False):
+    """
+    Acquires the publisher lock, returns its descriptor or None when it's
+    held by another process.
+    """
+    _makedirs(directory)
+    descriptor = os.open(
+        os.path.join(directory, LOCK), os.O_RDWR | os.O_CREAT, 0o644
+    )
+    try:
+        fcntl.flock(
+            descriptor, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB)
+        )
+    except IOError as error:
+        os.close(descriptor)
+        if error.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return descriptor
+
+
+def unlock(descriptor):
+    """
+    Releases the publisher lock.
+    """
+    fcntl.flock(descriptor, fcntl.LOCK_UN)
+    os.close(descriptor)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Quantile sketches of start, end and presence times.
+
+Times are bounded to a day, so every user gets fixed-bin histograms of
+start time, end time and presence duration per weekday. Sketches are built
+once when data is loaded, quantiles are read from cumulative counts with
+accuracy of BIN_SECONDS without sorting any records.
+"""
+
+from array import array
+from collections import namedtuple
+
+from engine import as_numpy, numpy
+from store import weekday_from_ordinal
+
+
+BIN_SECONDS = 300
+BINS = 24 * 60 * 60 // BIN_SECONDS
+FIELDS = ('start', 'end', 'presence')
+# counts of one user ordered by weekday, field and bin
+CELLS = 7 * len(FIELDS) * BINS
+# a bin can't get more than one record per week
+TYPECODE = 'H'
+QUANTILES = (0.1, 0.5, 0.9)
+
+# every field holds values of requested quantiles, in seconds
+WeekdayQuantiles = namedtuple('WeekdayQuantiles', FIELDS)
+
+
+def time_bin(seconds):
+    """
+    Returns histogram bin of time or duration in seconds.
+    """
+    return max(0, min(BINS - 1, seconds // BIN_SECONDS))
+
+
+def sketch_rows(rows):
+    """
+    Builds sketch of (day, start, end) rows.
+    """
+    sketch = array(TYPECODE, [0]) * CELLS
+    for day, start, end in rows:
+        cell = weekday_from_ordinal(day) * len(FIELDS) * BINS
+        sketch[cell + time_bin(start)] += 1
+        sketch[cell + BINS + time_bin(end)] += 1
+        sketch[cell + 2 * BINS + time_bin(end - start)] += 1
+    return sketch
+
+
+def build_sketch_index(store, user_ids=None, use_numpy=None):
+    """
+    Builds sketches of given users (all by default).
+
+    Returns dict mapping every user_id present in store to its sketch.
+    """
+    if user_ids is None:
+        user_ids = store.offsets.keys()
+    user_ids = [user_id for user_id in user_ids if user_id in store]
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return _build_sketch_index_numpy(store, user_ids)
+    return dict(
+        (user_id, sketch_rows(store.user_rows(user_id)))
+        for user_id in user_ids
+    )
+
+
+def _build_sketch_index_numpy(store, user_ids):
+    """
+    NumPy implementation of build_sketch_index.
+
+    Every record falls into three cells of its user's sketch, counts of all
+    users are computed with a single bincount.
+    """
+    if not user_ids:
+        return {}
+    ordered = sorted(user_ids)
+    slices = [store.user_slice(user_id) for user_id in ordered]
+    if len(ordered) == len(store.offsets):
+        rows = slice(None)
+    else:
+        rows = numpy.concatenate([
+            numpy.arange(begin, end, dtype=numpy.intp)
+            for begin, end in slices
+        ])
+    positions = numpy.repeat(
+        numpy.arange(len(ordered)), [end - begin for begin, end in slices]
+    )
+    days = as_numpy(store.days)[rows].astype(numpy.int64)
+    starts = as_numpy(store.starts)[rows].astype(numpy.int64)
+    ends = as_numpy(store.ends)[rows].astype(numpy.int64)
+    cells = positions * CELLS + (days + 6) % 7 * len(FIELDS) * BINS
+    keys = numpy.concatenate([
+        cells + field * BINS +
+        numpy.clip(values // BIN_SECONDS, 0, BINS - 1)
+        for field, values in enumerate((starts, ends, ends - starts))
+    ])
+    counts = numpy.bincount(keys, minlength=len(ordered) * CELLS)
+    counts = counts.astype(numpy.uint16)
+    return dict(
+        (user_id, array(
+            TYPECODE,
+            counts[position * CELLS:(position + 1) * CELLS].tostring(),
+        ))
+        for position, user_id in enumerate(ordered)
+    )
+
+
+def weekday_quantiles(sketch, quantiles=QUANTILES):
+    """
+    Returns seven WeekdayQuantiles of sketch, Monday first.
+
+    Quantiles have to be given in ascending order. Values are interpolated
+    within bins, days without records give zeros.
+    """
+    return [
+        WeekdayQuantiles(*[
+            histogram_quantiles(sketch[cell:cell + BINS], quantiles)
+            for cell in range(
+                weekday * len(FIELDS) * BINS,
+                (weekday + 1) * len(FIELDS) * BINS,
+                BINS,
+            )
+        ])
+        for weekday in range(7)
+    ]
+
+
+def histogram_quantiles(counts, quantiles):
+    """
+    Returns tuple of ascending quantiles (in seconds) of one histogram.
+    """
+    total = sum(counts)
+    if not total:
+        return (0,) * len(quantiles)
+    targets = [quantile * total for quantile in quantiles]
+    values = []
+    cumulative = 0
+    last = 0
+    for position, count in enumerate(counts):
+        if not count:
+            continue
+        last = position
+        while targets and targets[0] <= cumulative + count:
+            values.append(int(round(
+                (position + (targets.pop(0) - cumulative) / float(count)) *
+                BIN_SECONDS
+            )))
+        cumulative += count
+    # float rounding may leave the top quantile past the last record
+    values += [(last + 1) * BIN_SECONDS] * len(targets)
+    return tuple(values)
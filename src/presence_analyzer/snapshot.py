@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Binary snapshots of PresenceStore for fast cold start.
+
+Snapshot file consists of a fixed size header followed by little-endian
+32-bit integer columns:
+
+    header       - magic, format version, source CSV size and mtime,
+                   number of users and number of records,
+    user_ids     - sorted user ids,
+    begins, ends - slice of every user in record columns,
+    users, days, starts, ends - PresenceStore record columns.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from ingest import iter_rows
+from store import PresenceStore, TYPECODE
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+MAGIC = 'PRESENCE'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIqdqq')
+ITEMSIZE = 4
+SUFFIX = '.snap'
+
+
+class SnapshotError(Exception):
+    """
+    Snapshot file is missing, invalid or out of date.
+    """
+
+
+def snapshot_path(csv_path):
+    """
+    Returns path of snapshot stored next to given CSV file.
+    """
+    return csv_path + SUFFIX
+
+
+def source_signature(csv_path):
+    """
+    Returns (size, mtime) of CSV file recorded in snapshot header.
+    """
+    stat = os.stat(csv_path)
+    return stat.st_size, stat.st_mtime
+
+
+def _to_bytes(column):
+    """
+    Returns little-endian bytes of an int column.
+    """
+    column = array(TYPECODE, column)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tostring()
+
+
+def write_snapshot(store, path, source):
+    """
+    Atomically writes PresenceStore to a snapshot file.
+
+    `source` is (size, mtime) of the CSV file store was parsed from.
+    """
+    user_ids = store.user_ids()
+    slices = [store.offsets[user_id] for user_id in user_ids]
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, source[0], source[1],
+        len(user_ids), len(store),
+    )
+    columns = (
+        user_ids,
+        [begin for begin, dummy in slices],
+        [end for dummy, end in slices],
+        store.users, store.days, store.starts, store.ends,
+    )
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.snapshot-', delete=False) as snapfile:
+        try:
+            snapfile.write(header)
+            for column in columns:
+                snapfile.write(_to_bytes(column))
+        except Exception:
+            os.unlink(snapfile.name)
+            raise
+    os.rename(snapfile.name, path)
+
+
+def read_snapshot(path, source=None):
+    """
+    Memory-maps snapshot file and returns PresenceStore stored in it.
+
+    When `source` (size, mtime) is given SnapshotError is raised if it
+    doesn't match CSV file recorded in the header.
+    """
+    try:
+        with open(path, 'rb') as snapfile:
+            mapped = mmap.mmap(snapfile.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError) as error:
+        raise SnapshotError('Cannot map {0}: {1}'.format(path, error))
+
+    try:
+        if len(mapped) < HEADER.size:
+            raise SnapshotError('Truncated snapshot {0}'.format(path))
+        magic, version, dummy, size, mtime, user_count, record_count = \
+            HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise SnapshotError('Unsupported snapshot {0}'.format(path))
+        if source is not None and (size, mtime) != tuple(source):
+            raise SnapshotError('Snapshot {0} is out of date'.format(path))
+        counts = [user_count] * 3 + [record_count] * 4
+        if len(mapped) != HEADER.size + sum(counts) * ITEMSIZE:
+            raise SnapshotError('Truncated snapshot {0}'.format(path))
+
+        columns = []
+        offset = HEADER.size
+        for count in counts:
+            column = array(TYPECODE)
+            column.fromstring(mapped[offset:offset + count * ITEMSIZE])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset += count * ITEMSIZE
+    finally:
+        mapped.close()
+
+    user_ids, begins, ends = columns[:3]
+    offsets = dict(zip(user_ids, zip(begins, ends)))
+    return PresenceStore(*columns[3:], offsets=offsets)
+
+
+def build_snapshot(csv_path):
+    """
+    Parses CSV file and writes its snapshot, returns the store.
+    """
+    source = source_signature(csv_path)
+    with open(csv_path, 'r') as csvfile:
+        store = PresenceStore.from_rows(iter_rows(csvfile))
+    write_snapshot(store, snapshot_path(csv_path), source)
+    return store
+
+
+def load_store(csv_path):
+    """
+    Returns PresenceStore of CSV file, using its snapshot when up to date.
+
+    Missing or outdated snapshot is rebuilt from CSV file.
+    """
+    path = snapshot_path(csv_path)
+    try:
+        return read_snapshot(path, source_signature(csv_path))
+    except SnapshotError as error:
+        log.info('Rebuilding snapshot: %s', error)
+    try:
+        return build_snapshot(csv_path)
+    except (IOError, OSError):
+        log.warning('Cannot write snapshot %s', path, exc_info=True)
+        with open(csv_path, 'r') as csvfile:
+            return PresenceStore.from_rows(iter_rows(csvfile))
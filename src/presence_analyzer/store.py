@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Compact columnar storage of presence records.
+"""
+
+import datetime
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+
+from ingest import time_from_seconds
+
+
+# all columns are stored as C ints
+TYPECODE = 'i'
+
+
+def weekday_from_ordinal(ordinal):
+    """
+    Returns weekday (Monday is 0) of proleptic Gregorian ordinal.
+    """
+    return (ordinal + 6) % 7
+
+
+class PresenceStore(object):
+    """
+    Presence records kept in four parallel arrays.
+
+    Records are sorted by user_id and then by date, so every user occupies
+    a contiguous slice described by the `offsets` index:
+
+    users  - user_id of every record,
+    days   - date as proleptic Gregorian ordinal,
+    starts - start time in seconds since midnight,
+    ends   - end time in seconds since midnight.
+    """
+
+    def __init__(self, users, days, starts, ends, offsets=None):
+        self.users = users
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.offsets = build_offsets(users) if offsets is None else offsets
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, date, start, end) rows.
+
+        When there are several rows for the same user and date the last one
+        wins, just like with the dict layout.
+        """
+        records = [
+            (user_id, date.toordinal(), start, end)
+            for user_id, date, start, end in rows
+        ]
+        # stable sort keeps duplicates in file order
+        records.sort(key=itemgetter(0, 1))
+        columns = (
+            array(TYPECODE), array(TYPECODE),
+            array(TYPECODE), array(TYPECODE),
+        )
+        last = len(records) - 1
+        for i, record in enumerate(records):
+            if i < last and records[i + 1][:2] == record[:2]:
+                continue
+            for column, value in zip(columns, record):
+                column.append(value)
+        return cls(*columns)
+
+    def merge(self, rows):
+        """
+        Returns new store with (user_id, date, start, end) rows added.
+
+        Added rows replace existing records of the same user and date.
+        Records of users not present in rows are copied slice by slice.
+        """
+        added = PresenceStore.from_rows(rows)
+        if not len(added):
+            return self
+        return PresenceStore.combine([self, added])[0]
+
+    @classmethod
+    def combine(cls, stores):
+        """
+        Merges several stores into one, returns (store, conflicts).
+
+        Records of the same user and date in later stores replace those of
+        earlier ones, `conflicts` is the number of replaced records. When
+        user's records in different stores don't overlap in time (e.g. one
+        store per month) they are copied slice by slice.
+        """
+        columns = (
+            array(TYPECODE), array(TYPECODE),
+            array(TYPECODE), array(TYPECODE),
+        )
+        offsets = {}
+        conflicts = 0
+        user_ids = set()
+        for store in stores:
+            user_ids.update(store.offsets)
+        for user_id in sorted(user_ids):
+            begin = len(columns[0])
+            spans = []
+            for store in stores:
+                if user_id in store:
+                    first, last = store.user_slice(user_id)
+                    spans.append(
+                        (store.days[first], store.days[last - 1], store)
+                    )
+            spans.sort(key=itemgetter(0, 1))
+            if all(spans[i][1] < spans[i + 1][0]
+                   for i in xrange(len(spans) - 1)):
+                for dummy, dummy, store in spans:
+                    store._copy_user(user_id, columns)
+            else:
+                records = {}
+                for store in stores:
+                    for day, start, end in store.user_rows(user_id):
+                        conflicts += day in records
+                        records[day] = (start, end)
+                for day in sorted(records):
+                    start, end = records[day]
+                    for column, value in zip(
+                            columns, (user_id, day, start, end)):
+                        column.append(value)
+            offsets[user_id] = (begin, len(columns[0]))
+        return cls(*columns, offsets=offsets), conflicts
+
+    def _copy_user(self, user_id, columns):
+        """
+        Appends records of given user to another store's columns.
+        """
+        begin, end = self.user_slice(user_id)
+        sources = (self.users, self.days, self.starts, self.ends)
+        for column, source in zip(columns, sources):
+            column.extend(source[begin:end])
+
+    def __len__(self):
+        return len(self.users)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def user_ids(self):
+        """
+        Returns sorted list of all user ids.
+        """
+        return sorted(self.offsets)
+
+    def last_day(self):
+        """
+        Returns date of the latest record or None if store is empty.
+        """
+        if not self.offsets:
+            return None
+        return datetime.date.fromordinal(max(
+            self.days[end - 1] for dummy, end in self.offsets.itervalues()
+        ))
+
+    def user_slice(self, user_id):
+        """
+        Returns (begin, end) positions of user's records.
+        """
+        return self.offsets.get(user_id, (0, 0))
+
+    def date_range(self, user_id, first=None, last=None):
+        """
+        Returns (begin, end) positions of user's records from first to last.
+
+        Both bounds are inclusive ordinals, None means unbounded. Dates of
+        every user are sorted, so bounds are found with binary search.
+        """
+        begin, end = self.user_slice(user_id)
+        if first is not None:
+            begin = bisect_left(self.days, first, begin, end)
+        if last is not None:
+            end = bisect_right(self.days, last, begin, end)
+        return begin, max(begin, end)
+
+    def user_rows(self, user_id, first=None, last=None):
+        """
+        Yields (day, start, end) records of given user ordered by date.
+
+        Optional first and last ordinals limit records to that date range.
+        """
+        begin, end = self.date_range(user_id, first, last)
+        for i in xrange(begin, end):
+            yield self.days[i], self.starts[i], self.ends[i]
+
+    def user_items(self, user_id):
+        """
+        Returns entries of given user in the dict layout used by get_data.
+        """
+        return dict(
+            (datetime.date.fromordinal(day), {
+                'start': time_from_seconds(start),
+                'end': time_from_seconds(end),
+            })
+            for day, start, end in self.user_rows(user_id)
+        )
+
+    def to_dict(self):
+        """
+        Returns all entries in the dict layout used by get_data.
+        """
+        return dict(
+            (user_id, self.user_items(user_id)) for user_id in self.offsets
+        )
+
+    def nbytes(self):
+        """
+        Returns approximate memory used by columns and offsets index.
+        """
+        # columns may also be ctypes arrays mapped from shared segment
+        itemsize = array(TYPECODE).itemsize
+        return (
+            len(self) * 4 * itemsize +
+            sys.getsizeof(self.offsets) +
+            len(self.offsets) * sys.getsizeof((0, 0))
+        )
+
+
+def build_offsets(users):
+    """
+    Maps every user_id to (begin, end) slice of sorted users column.
+    """
+    offsets = {}
+    begin = 0
+    count = len(users)
+    for i in xrange(1, count + 1):
+        if i == count or users[i] != users[begin]:
+            offsets[users[begin]] = (begin, i)
+            begin = i
+    return offsets
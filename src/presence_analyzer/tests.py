@@ -3,12 +3,35 @@
 Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
+import array
 import datetime
+import gzip
 import json
+import logging
 import os.path
+import shutil
+import tempfile
+import threading
+from cStringIO import StringIO
+import time
 import unittest
 
+import backends
+import database
+import datadir
+import directory
+import encoding
+import engine
+import generator
+import ingest
 import main
+import metrics
+import profiling
+import shared
+import sketch
+import snapshot
+import store
+import userindex
 import utils
 import views
 
@@ -16,6 +39,9 @@ import views
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'sample_data.csv'
+)
 
 
 # pylint: disable=maybe-no-member, too-many-public-methods
@@ -55,7 +81,44 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(resp.content_type, 'application/json')
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
-        self.assertDictEqual(data[0], {'user_id': 10, 'name': 'User 10'})
+        self.assertDictEqual(data[0], {
+            'user_id': 10, 'name': 'User 10', 'first_seen': '2013-09-10',
+            'last_seen': '2013-09-12', 'days': 3,
+        })
+
+    def test_api_users_pages(self):
+        """
+        Test paginated and searched users listing.
+        """
+        resp = self.client.get('/api/v1/users?limit=1')
+        data = json.loads(resp.data)
+        self.assertEqual(data['total'], 2)
+        self.assertEqual([user['user_id'] for user in data['users']], [10])
+        self.assertEqual(data['next'], 10)
+        resp = self.client.get('/api/v1/users?limit=1&cursor=10')
+        data = json.loads(resp.data)
+        self.assertEqual(data['users'][0]['last_seen'], '2013-09-13')
+        self.assertEqual(data['users'][0]['days'], 6)
+        self.assertIsNone(data['next'])
+        resp = self.client.get('/api/v1/users?offset=1')
+        data = json.loads(resp.data)
+        self.assertEqual([user['user_id'] for user in data['users']], [11])
+        self.assertIsNone(data['next'])
+
+        for prefix, expected in (('11', [11]), ('user 1', [10, 11]),
+                                 ('USER 10', [10]), ('2', [])):
+            resp = self.client.get(
+                '/api/v1/users?prefix={0}'.format(prefix)
+            )
+            data = json.loads(resp.data)
+            self.assertEqual(
+                [user['user_id'] for user in data['users']], expected
+            )
+            self.assertEqual(data['total'], len(expected))
+
+        for query in ('limit=x', 'limit=0', 'offset=-1', 'cursor='):
+            resp = self.client.get('/api/v1/users?{0}'.format(query))
+            self.assertEqual(resp.status_code, 400)
 
     def test_mean_time_weekend(self):
         """
@@ -98,6 +161,63 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(data[0], expected_list[0])
         self.assertEqual(data[-1], expected_list[-1])
 
+    def test_date_range(self):
+        """
+        Test limiting statistics to a date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-06&to=2013-09-11'
+        )
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data, [
+            ['Weekday', 'Presence (s)'],
+            ['Mon', 24123],
+            ['Tue', 16564],
+            ['Wed', 25321],
+            ['Thu', 0],
+            ['Fri', 0],
+            ['Sat', 0],
+            ['Sun', 0]
+        ])
+        resp = self.client.get('/api/v1/mean_time_weekday/10?from=2013-09-12')
+        self.assertEqual(json.loads(resp.data)[1:4], [
+            ['Tue', 0], ['Wed', 0], ['Thu', 23705.0]
+        ])
+        resp = self.client.get('/api/v2/stats?user_id=11&to=2013-09-05')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            data['users'][0]['presence_weekday'][4], ['Thu', 22999]
+        )
+        resp = self.client.get('/api/v1/presence_start_end/11?from=2013-13-01')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_rolling_weeks(self):
+        """
+        Test rolling window of weeks ending at the latest day.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/11?weeks=1')
+        self.assertEqual(json.loads(resp.data), [
+            ['Weekday', 'Presence (s)'],
+            ['Mon', 24123],
+            ['Tue', 16564],
+            ['Wed', 25321],
+            ['Thu', 22969],
+            ['Fri', 6426],
+            ['Sat', 0],
+            ['Sun', 0]
+        ])
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?weeks=1&to=2013-09-10'
+        )
+        self.assertEqual(json.loads(resp.data)[4:], [
+            ['Thu', 22999], ['Fri', 0], ['Sat', 0], ['Sun', 0]
+        ])
+        for query in ('weeks=0', 'weeks=x', 'weeks=2&from=2013-09-01',
+                      'weeks=200000', 'weeks=999999999999'):
+            resp = self.client.get('/api/v1/presence_weekday/11?' + query)
+            self.assertEqual(resp.status_code, 400)
+
     def test_presence_start_end(self):
         """
         Test start and end time of given user grouped by weekday.
@@ -118,170 +238,2327 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(data[0], expected_list[0])
         self.assertEqual(data[-1], expected_list[-1])
 
+    def test_median(self):
+        """
+        Test medians of start, end and presence time.
+        """
+        resp = self.client.get('/api/v1/presence_start_end/10?stat=median')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[:3], [
+            ['Mon', 0, 0], ['Tue', 34650, 64650], ['Wed', 33450, 58050],
+        ])
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10?stat=median&to=2013-09-10'
+        )
+        self.assertEqual(json.loads(resp.data)[1:3], [
+            ['Tue', 30150], ['Wed', 0],
+        ])
+        resp = self.client.get('/api/v1/mean_time_weekday/10?stat=mode')
+        self.assertEqual(resp.status_code, 400)
 
-class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
+    def test_presence_quantiles(self):
+        """
+        Test percentiles of given user grouped by weekday.
+        """
+        resp = self.client.get('/api/v1/presence_quantiles/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['quantiles'], [0.1, 0.5, 0.9])
+        self.assertEqual(data['start'][1], ['Tue', 34530, 34650, 34770])
+        self.assertEqual(data['presence'][1], ['Tue', 30030, 30150, 30270])
+        self.assertEqual(data['end'][0], ['Mon', 0, 0, 0])
+        resp = self.client.get(
+            '/api/v1/presence_quantiles/11?from=2013-09-10&to=2013-09-10'
+        )
+        data = json.loads(resp.data)
+        self.assertEqual(data['start'][1], ['Tue', 33330, 33450, 33570])
+        self.assertEqual(data['start'][3], ['Thu', 0, 0, 0])
+        resp = self.client.get('/api/v1/presence_quantiles/99')
+        self.assertEqual(resp.status_code, 404)
 
-    """
-    Utility functions tests.
-    """
+    def write_teams(self, content):
+        """
+        Configures TEAMS_CSV file with given content.
+        """
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, content)
+        os.close(handle)
+        main.app.config['TEAMS_CSV'] = path
+        self.addCleanup(os.remove, path)
+        self.addCleanup(main.app.config.pop, 'TEAMS_CSV')
 
-    def setUp(self):
+    def test_teams_unreadable(self):
         """
-        Before each test, set up a environment.
+        Test that missing or undecodable team mapping doesn't break views.
         """
-        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        main.app.config['TEAMS_CSV'] = os.path.join(
+            tempfile.gettempdir(), 'missing-teams.csv'
+        )
+        self.addCleanup(main.app.config.pop, 'TEAMS_CSV', None)
+        for url in ('/api/v1/users', '/api/v1/presence_weekday/10',
+                    '/api/v1/company/weekday'):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(json.loads(self.client.get('/api/v1/teams').data), [])
 
-    def tearDown(self):
+        self.write_teams(b'10,Alpha\n11,Be\xfft\xe4\n')
+        resp = self.client.get('/api/v1/teams')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data), [{'team': 'Alpha', 'users': 1}]
+        )
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 200)
+
+    def test_teams_missing_cached(self):
         """
-        Get rid of unused objects after each test.
+        Test that missing team mapping is reported once until it reappears.
         """
-        pass
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        utils.log.addHandler(handler)
+        self.addCleanup(utils.log.removeHandler, handler)
+        self.write_teams(b'10,Alpha\n')
+        path = main.app.config['TEAMS_CSV']
+        self.assertEqual(utils.get_teams().teams, {10: 'Alpha'})
 
-    def test_get_data(self):
+        os.remove(path)
+        teams = utils.get_teams()
+        self.assertEqual(teams.teams, {})
+        for dummy in range(3):
+            self.assertEqual(self.client.get('/api/v1/teams').status_code, 200)
+            self.assertIs(utils.get_teams(), teams)
+        self.assertEqual(len(records), 1)
+
+        with open(path, 'w') as csvfile:
+            csvfile.write(b'10,Beta\n')
+        self.assertEqual(utils.get_teams().teams, {10: 'Beta'})
+        self.assertNotIn(path, utils.MISSING_TEAMS)
+
+    def test_company_weekday(self):
         """
-        Test parsing of CSV file.
+        Test statistics of all users and of teams grouped by weekday.
         """
-        data = utils.get_data()
-        self.assertIsInstance(data, dict)
-        self.assertItemsEqual(data.keys(), [10, 11])
-        sample_date = datetime.date(2013, 9, 10)
-        self.assertIn(sample_date, data[10])
-        self.assertItemsEqual(data[10][sample_date].keys(), ['start', 'end'])
+        resp = self.client.get('/api/v1/company/weekday')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], [
+            'Weekday', 'Mean presence (s)', 'Mean start (s)',
+            'Mean end (s)', 'Users', 'Days',
+        ])
+        self.assertEqual(data[2], ['Tue', 23305.5, 34167.5, 57473.0, 2, 2])
+        self.assertEqual(data[7], ['Sun', 0, 0, 0, 0, 0])
+        self.assertEqual(json.loads(self.client.get('/api/v1/teams').data), [])
+        resp = self.client.get('/api/v1/company/weekday?team=Alpha')
+        self.assertEqual(resp.status_code, 404)
+
+        self.write_teams(b'user_id,team\n10,Alpha\n11,Beta\n12,Gamma\n')
+        self.assertEqual(json.loads(self.client.get('/api/v1/teams').data), [
+            {'team': 'Alpha', 'users': 1},
+            {'team': 'Beta', 'users': 1},
+            {'team': 'Gamma', 'users': 1},
+        ])
+        resp = self.client.get('/api/v1/company/weekday?team=Alpha')
         self.assertEqual(
-            data[10][sample_date]['start'],
-            datetime.time(9, 39, 5)
+            json.loads(resp.data)[2], ['Tue', 30047.0, 34745.0, 64792.0, 1, 1]
         )
+        resp = self.client.get('/api/v1/teams/weekday?to=2013-09-10')
+        data = json.loads(resp.data)
+        self.assertItemsEqual(data.keys(), ['Alpha', 'Beta', 'Gamma'])
+        self.assertEqual(data['Beta'][1], ['Mon', 24123.0, 33134.0,
+                                           57257.0, 1, 1])
+        self.assertEqual(data['Beta'][4][4:], [1, 1])
+        self.assertEqual(data['Beta'][5][4:], [0, 0])
+        self.assertEqual(data['Gamma'][2], ['Tue', 0, 0, 0, 0, 0])
 
-    def test_group_by_weekday(self):
+    def test_company_compare(self):
         """
-        Test group by weekend.
+        Test comparison of user with company and team averages.
         """
-        excepted_result = [[], [0], [17088], [10800], [], [], []]
-        days = {
-            datetime.date(2013, 9, 10): {
-                'end': datetime.time(0, 0, 0),
-                'start': datetime.time(0, 0, 0),
-            },
-            datetime.date(2013, 9, 11): {
-                'end': datetime.time(17, 6, 28),
-                'start': datetime.time(12, 21, 40),
-            },
-            datetime.date(2013, 9, 12): {
-                'end': datetime.time(23, 59, 59),
-                'start': datetime.time(20, 59, 59),
-            }
-        }
-        data = utils.group_by_weekday(days)
-        self.assertEqual(data, excepted_result)
-        self.assertTrue(
-            datetime.datetime.strptime(
-                str(datetime.date(2013, 9, 12)), '%Y-%m-%d'
+        resp = self.client.get('/api/v1/company/compare/10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], ['Weekday', 'User', 'Company'])
+        self.assertEqual(data[2], ['Tue', 30047.0, 23305.5])
+        self.write_teams(b'10,Alpha\n')
+        data = json.loads(self.client.get('/api/v1/company/compare/10').data)
+        self.assertEqual(data[0], ['Weekday', 'User', 'Team', 'Company'])
+        self.assertEqual(data[2], ['Tue', 30047.0, 30047.0, 23305.5])
+        resp = self.client.get('/api/v1/company/compare/99')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_occupancy(self):
+        """
+        Test mean number of users present by time of day and weekday.
+        """
+        resp = self.client.get('/api/v1/occupancy?bucket=60')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 25)
+        self.assertEqual(data[0], [
+            'Time', 'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'
+        ])
+        self.assertEqual(data[10], ['09:00', 0.8, 1.03, 1.47, 0.27, 0, 0, 0])
+        self.assertEqual(data[11][2], 2.0)
+        self.assertEqual(data[14][2], 1.92)
+        self.assertEqual(data[18][2], 0.98)
+        resp = self.client.get('/api/v1/occupancy?to=2013-09-06')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 97)
+        self.assertEqual(data[41], ['10:00', 0, 0, 0, 1.0, 0, 0, 0])
+        for bucket in ('7', 'x'):
+            resp = self.client.get('/api/v1/occupancy?bucket=' + bucket)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_api_stats(self):
+        """
+        Test batch statistics of selected users.
+        """
+        resp = self.client.get(
+            '/api/v2/stats?user_id=11,99&user_id=10'
+            '&metric=presence_weekday,mean_time_weekday'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        data = json.loads(resp.data)
+        self.assertEqual(
+            data['metrics'], ['presence_weekday', 'mean_time_weekday']
+        )
+        self.assertEqual(data['missing'], [99])
+        self.assertEqual([user['user_id'] for user in data['users']], [11, 10])
+        for user in data['users']:
+            self.assertItemsEqual(
+                user.keys(),
+                ['user_id', 'presence_weekday', 'mean_time_weekday']
             )
+            for metric in data['metrics']:
+                single = self.client.get(
+                    '/api/v1/{0}/{1}'.format(metric, user['user_id'])
+                )
+                self.assertEqual(user[metric], json.loads(single.data))
+
+    def test_api_stats_all(self):
+        """
+        Test batch statistics of all users.
+        """
+        resp = self.client.post('/api/v2/stats')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['metrics'], [
+            'mean_time_weekday', 'presence_start_end', 'presence_weekday'
+        ])
+        self.assertEqual(data['missing'], [])
+        self.assertEqual([user['user_id'] for user in data['users']], [10, 11])
+        self.assertEqual(
+            data['users'][1]['presence_start_end'],
+            json.loads(self.client.get('/api/v1/presence_start_end/11').data)
         )
 
-    def test_group_by_start_end(self):
+    def test_api_stats_invalid(self):
         """
-        Test group by start, end.
+        Test batch statistics with invalid parameters.
         """
-        excepted_result = {
-            0: {'end': [], 'start': []},
-            1: {'end': [79254, 61588],'start': [41580, 44500]},
-            2: {'end': [47188, 75988],'start': [19300, 44500]},
-            3: {'end': [79199, 86399],'start': [28169, 75599]},
-            4: {'end': [], 'start': []},
-            5: {'end': [], 'start': []},
-            6: {'end': [], 'start': []}
-        }
-        days = {
-            datetime.date(2013, 9, 10): {
-                'end': datetime.time(22, 0, 54),
-                'start': datetime.time(11, 33, 0),
-            },
-            datetime.date(2013, 9, 17): {
-                'end': datetime.time(17, 6, 28),
-                'start': datetime.time(12, 21, 40),
-            },
-            datetime.date(2013, 9, 11): {
-                'end': datetime.time(13, 6, 28),
-                'start': datetime.time(5, 21, 40),
-            },
-            datetime.date(2013, 9, 18): {
-                'end': datetime.time(21, 6, 28),
-                'start': datetime.time(12, 21, 40),
-            },
-            datetime.date(2013, 9, 12): {
-                'end': datetime.time(21, 59, 59),
-                'start': datetime.time(7, 49, 29),
-            },
-            datetime.date(2013, 9, 19): {
-                'end': datetime.time(23, 59, 59),
-                'start': datetime.time(20, 59, 59),
-            }
-        }
-        data = utils.group_by_start_end(days)
-        self.assertEqual(data, excepted_result)
+        resp = self.client.get('/api/v2/stats?user_id=abc')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v2/stats?metric=unknown')
+        self.assertEqual(resp.status_code, 400)
 
-    def test_seconds_since_midnight(self):
+
+class PresenceAnalyzerSQLiteViewsTestCase(PresenceAnalyzerViewsTestCase):
+
+    """
+    Views tests run against SQLite storage backend.
+    """
+
+    def setUp(self):
         """
-        Test calculates amount of seconds since midnight.
+        Before each test, switch to SQLite backend with temporary database.
         """
-        sample_date = datetime.time(18, 17, 4)
-        date = (
-            utils.seconds_since_midnight(
-                datetime.time(23, 11, 0)
-            ),
-            utils.seconds_since_midnight(
-                datetime.time(0, 0, 0)
-            ),
-            utils.seconds_since_midnight(
-                datetime.time(5, 54, 43)
-            ),
-        )
-        self.assertLess(sample_date.hour, 24)
-        self.assertGreater(sample_date.hour, -1)
-        self.assertLess(sample_date.minute, 60)
-        self.assertGreater(sample_date.minute, -1)
-        self.assertLess(sample_date.second, 60)
-        self.assertGreater(sample_date.second, -1)
-        self.assertEqual(date[0], 83460)
-        self.assertEqual(date[1], 0)
-        self.assertEqual(date[2], 21283)
+        super(PresenceAnalyzerSQLiteViewsTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        main.app.config.update({
+            'STORAGE_BACKEND': 'sqlite',
+            'DATA_SQLITE': os.path.join(self.tmpdir, 'data.sqlite'),
+        })
+        # responses of the other backend would be served from cache
+        utils.RESPONSE_CACHE.clear()
 
-    def test_interval(self):
+    def tearDown(self):
         """
-        Test interval between two datetime.time objects.
+        Get rid of the database after each test.
         """
-        date = (
-            utils.interval(
-                datetime.time(8, 31, 6),
-                datetime.time(15, 15, 27),
-            ),
-            utils.interval(
-                datetime.time(0, 0, 0),
-                datetime.time(0, 0, 0),
-            ),
-            utils.interval(
-                datetime.time(5, 30, 5),
-                datetime.time(10, 15, 53),
-            ),
+        main.app.config.update({
+            'STORAGE_BACKEND': 'memory', 'DATA_SQLITE': None,
+        })
+        backends.BACKENDS['sqlite'].clear()
+        utils.RESPONSE_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_backend(self):
+        """
+        Test that SQLite backend is actually used.
+        """
+        self.assertIsInstance(utils.get_presence(), backends.SQLitePresence)
+        self.assertTrue(os.path.exists(main.app.config['DATA_SQLITE']))
+
+
+class PresenceAnalyzerIndexedViewsTestCase(PresenceAnalyzerViewsTestCase):
+
+    """
+    Views tests run against users loaded through the sidecar index.
+    """
+
+    def setUp(self):
+        """
+        Before each test, switch to indexed backend with temporary index.
+        """
+        super(PresenceAnalyzerIndexedViewsTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        main.app.config.update({
+            'STORAGE_BACKEND': 'indexed',
+            'DATA_INDEX': os.path.join(self.tmpdir, 'data.idx'),
+        })
+        utils.RESPONSE_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of the index after each test.
+        """
+        main.app.config.update({
+            'STORAGE_BACKEND': 'memory', 'DATA_INDEX': None,
+        })
+        backends.BACKENDS['indexed'].clear()
+        utils.RESPONSE_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_backend(self):
+        """
+        Test that users are loaded through the index.
+        """
+        presence = utils.get_presence()
+        self.assertIsInstance(presence, backends.IndexedPresence)
+        self.assertTrue(os.path.exists(main.app.config['DATA_INDEX']))
+        self.assertEqual(presence.last_day, datetime.date(2013, 9, 13))
+        self.assertIs(presence.data, presence.data)
+        self.assertIs(presence._store(), presence._store())
+
+    def test_user_index_metrics(self):
+        """
+        Test that parsed users cache is exposed as metrics.
+        """
+        self.client.get('/api/v1/presence_weekday/10')
+        self.client.get('/api/v1/mean_time_weekday/10')
+        metrics = dict(
+            (name, samples) for name, dummy, dummy, samples
+            in backends.user_index_metrics()
         )
-        self.assertEqual(date[0], 24261)
-        self.assertEqual(date[1], 0)
-        self.assertEqual(date[2], 17148)
+        self.assertEqual(dict(metrics['presence_user_index_total']), {
+            (('result', 'hits'),): 1,
+            (('result', 'misses'),): 1,
+            (('result', 'evictions'),): 0,
+        })
+        self.assertEqual(metrics['presence_user_index_users'], [((), 1)])
 
-    def test_mean(self):
+
+class PresenceAnalyzerSharedViewsTestCase(PresenceAnalyzerViewsTestCase):
+
+    """
+    Views tests run against data mapped from a shared segment.
+    """
+
+    def setUp(self):
         """
-        Test calculates arithmetic mean.
+        Before each test, switch to shared backend with temporary directory.
         """
-        date = (
-            utils.mean([24261, 32533, 34323, 32453, 54154, 32412, 31123]),
-            utils.mean([0]),
-            utils.mean([-12332, -3213, -3213, -32131, -32131])
+        super(PresenceAnalyzerSharedViewsTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        main.app.config.update({
+            'STORAGE_BACKEND': 'shared',
+            'SHARED_DIR': self.tmpdir,
+        })
+        utils.RESPONSE_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of segments after each test.
+        """
+        main.app.config.update({
+            'STORAGE_BACKEND': 'memory', 'SHARED_DIR': None,
+        })
+        backends.BACKENDS['shared'].clear()
+        utils.RESPONSE_CACHE.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_backend(self):
+        """
+        Test that columns are mapped from the segment.
+        """
+        presence = utils.get_presence()
+        self.assertNotIsInstance(presence.store.days, array.array)
+        self.assertEqual(
+            shared.current_segment(self.tmpdir),
+            os.path.join(self.tmpdir, 'presence-00000001.seg'),
+        )
+
+
+class PresenceAnalyzerConditionalTestCase(unittest.TestCase):
+
+    """
+    Conditional GET tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to a temporary file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        os.utime(self.csv_path, (1381000000, 1381000000))
+        main.app.config.update({
+            'DATA_CSV': self.csv_path,
+            'CACHE_MAX_AGE': 30,
+        })
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+        main.app.config.pop('CACHE_MAX_AGE')
+
+    def test_validators(self):
+        """
+        Test that responses carry ETag, Last-Modified and Cache-Control.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.headers['ETag'])
+        self.assertEqual(
+            resp.headers['Last-Modified'], 'Sat, 05 Oct 2013 19:06:40 GMT'
+        )
+        self.assertEqual(resp.headers['Cache-Control'], 'max-age=30')
+        other = self.client.get('/api/v1/mean_time_weekday/11')
+        self.assertNotEqual(resp.headers['ETag'], other.headers['ETag'])
+
+    def test_if_none_match(self):
+        """
+        Test that matching ETag is answered with 304 until data changes.
+        """
+        etag = self.client.get('/api/v1/users').headers['ETag']
+        resp = self.client.get(
+            '/api/v1/users', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,08:00:00,16:00:00\n')
+        resp = self.client.get(
+            '/api/v1/users', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_if_modified_since(self):
+        """
+        Test that If-Modified-Since is answered with 304 for fresh data.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11',
+            headers={'If-Modified-Since': 'Sat, 05 Oct 2013 19:06:40 GMT'},
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11',
+            headers={'If-Modified-Since': 'Sat, 05 Oct 2013 19:06:39 GMT'},
+        )
+        self.assertEqual(resp.status_code, 200)
+
+    def test_teams_conditional(self):
+        """
+        Test that validators change with team mapping.
+        """
+        teams_path = os.path.join(self.tmpdir, 'teams.csv')
+        with open(teams_path, 'w') as csvfile:
+            csvfile.write('10,Alpha\n')
+        main.app.config['TEAMS_CSV'] = teams_path
+        self.addCleanup(main.app.config.pop, 'TEAMS_CSV')
+        etag = self.client.get('/api/v1/teams').headers['ETag']
+        with open(teams_path, 'a') as csvfile:
+            csvfile.write('11,Alpha\n')
+        os.utime(teams_path, (1381000001, 1381000001))
+        resp = self.client.get(
+            '/api/v1/teams', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(
+            json.loads(resp.data), [{'team': 'Alpha', 'users': 2}]
+        )
+
+    def test_teams_validators(self):
+        """
+        Test that only views using teams depend on team mapping.
+        """
+        users = self.client.get('/api/v1/users').headers['ETag']
+        teams = self.client.get('/api/v1/teams').headers['ETag']
+        teams_path = os.path.join(self.tmpdir, 'teams.csv')
+        with open(teams_path, 'w') as csvfile:
+            csvfile.write('10,Alpha\n')
+        main.app.config['TEAMS_CSV'] = teams_path
+        self.addCleanup(main.app.config.pop, 'TEAMS_CSV')
+        self.assertEqual(self.client.get('/api/v1/users').headers['ETag'],
+                         users)
+        self.assertNotEqual(
+            self.client.get('/api/v1/teams').headers['ETag'], teams
+        )
+
+    def test_stats_conditional(self):
+        """
+        Test conditional GET of batch statistics.
+        """
+        etag = self.client.get('/api/v2/stats').headers['ETag']
+        resp = self.client.get(
+            '/api/v2/stats', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(
+            '/api/v2/stats?user_id=10', headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+
+
+class PresenceAnalyzerResponseCacheTestCase(unittest.TestCase):
+
+    """
+    Response cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.client = main.app.test_client()
+        utils.RESPONSE_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of cached responses after each test.
+        """
+        main.app.config.pop('RESPONSE_CACHE_EXCLUDE', None)
+        utils.RESPONSE_CACHE.clear()
+
+    def test_view_cached(self):
+        """
+        Test that repeated requests are served from cache.
+        """
+        first = self.client.get('/api/v1/mean_time_weekday/10')
+        second = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(first.data, second.data)
+        stats = utils.RESPONSE_CACHE.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['bytes'], len(first.data))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_gzip_counted_once(self):
+        """
+        Test that compressed responses count one hit or miss per request.
+        """
+        self.addCleanup(main.app.config.pop, 'GZIP_MIN_SIZE', None)
+        for min_size in (1024, 0):
+            main.app.config['GZIP_MIN_SIZE'] = min_size
+            utils.RESPONSE_CACHE.clear()
+            for dummy in range(10):
+                resp = self.client.get(
+                    '/api/v1/mean_time_weekday/10',
+                    headers={'Accept-Encoding': 'gzip'},
+                )
+                self.assertEqual(resp.status_code, 200)
+            stats = utils.RESPONSE_CACHE.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (9, 1))
+
+    def test_excluded_endpoint(self):
+        """
+        Test that endpoints can opt out of caching.
+        """
+        main.app.config.update({
+            'RESPONSE_CACHE_EXCLUDE': ['mean_time_weekday_view'],
+        })
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(utils.RESPONSE_CACHE.stats()['entries'], 0)
+
+    def test_lru_eviction(self):
+        """
+        Test that least recently used entries are evicted above the limit.
+        """
+        cache = utils.ResponseCache()
+        cache.set('a', 1, b'x' * 4, 10)
+        cache.set('b', 1, b'y' * 4, 10)
+        self.assertEqual(cache.get('a', 1), b'xxxx')
+        cache.set('c', 1, b'z' * 4, 10)
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1), b'xxxx')
+        self.assertEqual(cache.size, 8)
+        cache.set('d', 1, b'w' * 11, 10)
+        self.assertIsNone(cache.get('d', 1))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_version_invalidation(self):
+        """
+        Test that entries are dropped when data version changes.
+        """
+        cache = utils.ResponseCache()
+        cache.set('a', 1, b'x', 10)
+        self.assertIsNone(cache.get('a', 2))
+        self.assertEqual(cache.stats()['entries'], 0)
+
+
+class PresenceAnalyzerEncodingTestCase(unittest.TestCase):
+
+    """
+    Response encoding and compression tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        self.client = main.app.test_client()
+        utils.RESPONSE_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Restore default configuration after each test.
+        """
+        for name in ('JSON_ENCODER', 'GZIP_LEVEL', 'GZIP_MIN_SIZE'):
+            main.app.config.pop(name, None)
+        utils.RESPONSE_CACHE.clear()
+
+    def test_table_format(self):
+        """
+        Test that precompiled tables encode the same as json module.
+        """
+        table_format = encoding.TableFormat(
+            ['Mon', '%x'], 2, header=('Day', 'A', 'B')
+        )
+        table = table_format.table([(1, 2.5), (0, 1e20)])
+        self.assertEqual(
+            table, [('Day', 'A', 'B'), ('Mon', 1, 2.5), ('%x', 0, 1e20)]
+        )
+        self.assertEqual(encoding.encode(table), json.dumps(table))
+        self.assertEqual(
+            json.loads(encoding.encode(table)), json.loads(json.dumps(table))
+        )
+        table.append(('Tue', 1, 2))
+        self.assertEqual(
+            json.loads(encoding.encode(table, json.dumps)),
+            json.loads(json.dumps(table)),
+        )
+        table[1:] = [('Mon', 1), ('%x', 2)]
+        self.assertEqual(
+            json.loads(encoding.encode(table, json.dumps)),
+            json.loads(json.dumps(table)),
+        )
+
+    def test_get_encoder(self):
+        """
+        Test selection of JSON encoder.
+        """
+        self.assertIs(encoding.get_encoder('json'), json.dumps)
+        self.assertIn(encoding.get_encoder(), encoding.ENCODERS.values())
+        with self.assertRaises(ValueError):
+            encoding.get_encoder('missing')
+
+    def test_nested_tables(self):
+        """
+        Test that tables nested in dicts are encoded by their templates.
+        """
+        table_format = encoding.TableFormat(['Mon'], 1)
+        document = {
+            'b': {'c': table_format.table([(29061.343117408906,)])},
+            'a': table_format.table([(1,)]),
+            1: [0.5],
+        }
+        encoded = []
+
+        def encoder(value):
+            """
+            Records values encoded by the encoder.
+            """
+            encoded.append(value)
+            return json.dumps(value)
+
+        body = encoding.encode(document, encoder)
+        self.assertEqual(body, json.dumps(document, sort_keys=True))
+        self.assertEqual(encoded, [[0.5]])
+        self.assertEqual(
+            encoding.encode({'a': [1]}, encoder), json.dumps({'a': [1]})
+        )
+
+    def test_encoders_parity(self):
+        """
+        Test that every installed encoder gives the same documents.
+        """
+        main.app.config['DATA_CSV'] = SAMPLE_DATA_CSV
+        self.addCleanup(main.app.config.update, {'DATA_CSV': TEST_DATA_CSV})
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        os.write(handle, b'10,Alpha\n11,Beta\n12,Alpha\n')
+        os.close(handle)
+        main.app.config['TEAMS_CSV'] = path
+        self.addCleanup(os.remove, path)
+        self.addCleanup(main.app.config.pop, 'TEAMS_CSV')
+        urls = (
+            '/api/v1/users', '/api/v1/presence_start_end/10',
+            '/api/v2/stats?user_id=10,11,99', '/api/v1/teams/weekday',
+        )
+        for url in urls:
+            documents = []
+            for name in encoding.ENCODERS:
+                main.app.config['JSON_ENCODER'] = name
+                utils.RESPONSE_CACHE.clear()
+                documents.append(json.loads(self.client.get(url).data))
+            self.assertEqual(documents[0], documents[-1])
+
+    def test_gzip(self):
+        """
+        Test that large responses are compressed for clients accepting it.
+        """
+        plain = self.client.get('/api/v1/presence_start_end/10')
+        main.app.config['GZIP_MIN_SIZE'] = len(plain.data)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        for dummy in range(2):
+            resp = self.client.get(
+                '/api/v1/presence_start_end/10',
+                headers={'Accept-Encoding': 'gzip, deflate'},
+            )
+            self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(
+                gzip.GzipFile(fileobj=StringIO(resp.data)).read(), plain.data
+            )
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+        self.assertEqual(utils.RESPONSE_CACHE.stats()['entries'], 2)
+
+        small = self.client.get(
+            '/api/v1/mean_time_weekday/10',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+        self.assertNotIn('Content-Encoding', small.headers)
+        refused = self.client.get(
+            '/api/v1/presence_start_end/10',
+            headers={'Accept-Encoding': 'gzip;q=0'},
+        )
+        self.assertNotIn('Content-Encoding', refused.headers)
+
+        main.app.config['GZIP_LEVEL'] = 0
+        resp = self.client.get(
+            '/api/v1/presence_start_end/10',
+            headers={'Accept-Encoding': 'gzip'},
+        )
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertNotIn('Vary', resp.headers)
+
+    def test_gzip_stream(self):
+        """
+        Test that streamed batch statistics are compressed.
+        """
+        plain = self.client.get('/api/v2/stats')
+        resp = self.client.get(
+            '/api/v2/stats', headers={'Accept-Encoding': 'gzip'}
+        )
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            gzip.GzipFile(fileobj=StringIO(resp.data)).read(), plain.data
+        )
+
+
+class PresenceAnalyzerMetricsTestCase(unittest.TestCase):
+
+    """
+    Instrumentation tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        metrics.install(main.app)
+        self.client = main.app.test_client()
+
+    def test_histogram(self):
+        """
+        Test histogram exposition format.
+        """
+        histogram = metrics.Histogram(
+            'test_seconds', 'Test.', ('endpoint',), buckets=(0.1, 1.0)
+        )
+        histogram.observe(('a',), 0.05)
+        histogram.observe(('a',), 0.5)
+        histogram.observe(('a',), 5)
+        self.assertEqual(list(histogram.samples()), [
+            'test_seconds_bucket{endpoint="a",le="0.1"} 1',
+            'test_seconds_bucket{endpoint="a",le="1.0"} 2',
+            'test_seconds_bucket{endpoint="a",le="+Inf"} 3',
+            'test_seconds_sum{endpoint="a"} 5.55',
+            'test_seconds_count{endpoint="a"} 3',
+        ])
+
+    def test_counter(self):
+        """
+        Test counter exposition format.
+        """
+        counter = metrics.Counter('test_total', 'Test.', ('name',))
+        counter.inc(('a"b',))
+        counter.inc(('a"b',), 2)
+        self.assertEqual(list(counter.samples()), [
+            'test_total{name="a\\"b"} 3',
+        ])
+
+    def test_metrics_view(self):
+        """
+        Test that requests and phases are exposed at /metrics.
+        """
+        # buffered responses are closed, which finishes measurement
+        self.client.get('/api/v1/presence_weekday/10', buffered=True)
+        self.client.get('/api/v1/presence_weekday/99', buffered=True)
+        resp = self.client.get('/metrics')
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        lines = resp.data.splitlines()
+        self.assertIn(
+            '# TYPE presence_request_duration_seconds histogram', lines
+        )
+        self.assertTrue([
+            line for line in lines if line.startswith(
+                'presence_requests_total{endpoint="presence_weekday_view",'
+                'status="404"}'
+            )
+        ])
+        self.assertTrue([
+            line for line in lines if line.startswith(
+                'presence_phase_duration_seconds_count{phase="serialization"}'
+            )
+        ])
+        self.assertTrue([
+            line for line in lines
+            if line.startswith('presence_data_cache_total{result="hits"}')
+        ])
+
+
+class PresenceAnalyzerProfilingTestCase(unittest.TestCase):
+
+    """
+    Request profiling tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, enable profiling.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'PROFILING_ENABLED': True,
+            'PROFILING_DIR': self.tmpdir,
+        })
+        profiling.install(main.app)
+        self.client = main.app.test_client()
+
+    def tearDown(self):
+        """
+        Disable profiling and remove saved profiles.
+        """
+        main.app.config.update({'PROFILING_ENABLED': False})
+        shutil.rmtree(self.tmpdir)
+
+    def test_stats(self):
+        """
+        Test that profiled request returns top functions.
+        """
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10', headers={'X-Profile': '1'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn(b'cumulative', resp.data)
+        self.assertIn(b'mean_time_weekday_view', resp.data)
+
+    def test_save(self):
+        """
+        Test that profile can be saved to a file.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10?profile=save')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual(len(json.loads(resp.data)), 7)
+        path = resp.headers['X-Profile-File']
+        self.assertEqual(os.path.dirname(path), self.tmpdir)
+        self.assertTrue(os.path.exists(path))
+
+    def test_not_profiled(self):
+        """
+        Test that profiling is disabled by default and for other clients.
+        """
+        resp = self.client.get(
+            '/api/v1/mean_time_weekday/10', headers={'X-Profile': '1'},
+            environ_base={'REMOTE_ADDR': '10.0.0.1'},
+        )
+        self.assertEqual(resp.content_type, 'application/json')
+        main.app.config.update({'PROFILING_ENABLED': False})
+        resp = self.client.get('/api/v1/mean_time_weekday/10?profile=1')
+        self.assertEqual(resp.content_type, 'application/json')
+
+
+class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
+
+    """
+    Utility functions tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        pass
+
+    def test_get_data(self):
+        """
+        Test parsing of CSV file.
+        """
+        data = utils.get_data()
+        self.assertIsInstance(data, dict)
+        self.assertItemsEqual(data.keys(), [10, 11])
+        sample_date = datetime.date(2013, 9, 10)
+        self.assertIn(sample_date, data[10])
+        self.assertItemsEqual(data[10][sample_date].keys(), ['start', 'end'])
+        self.assertEqual(
+            data[10][sample_date]['start'],
+            datetime.time(9, 39, 5)
+        )
+
+    def test_group_by_weekday(self):
+        """
+        Test group by weekend.
+        """
+        excepted_result = [[], [0], [17088], [10800], [], [], []]
+        days = {
+            datetime.date(2013, 9, 10): {
+                'end': datetime.time(0, 0, 0),
+                'start': datetime.time(0, 0, 0),
+            },
+            datetime.date(2013, 9, 11): {
+                'end': datetime.time(17, 6, 28),
+                'start': datetime.time(12, 21, 40),
+            },
+            datetime.date(2013, 9, 12): {
+                'end': datetime.time(23, 59, 59),
+                'start': datetime.time(20, 59, 59),
+            }
+        }
+        data = utils.group_by_weekday(days)
+        self.assertEqual(data, excepted_result)
+        self.assertTrue(
+            datetime.datetime.strptime(
+                str(datetime.date(2013, 9, 12)), '%Y-%m-%d'
+            )
+        )
+
+    def test_group_by_start_end(self):
+        """
+        Test group by start, end.
+        """
+        excepted_result = {
+            0: {'end': [], 'start': []},
+            1: {'end': [79254, 61588],'start': [41580, 44500]},
+            2: {'end': [47188, 75988],'start': [19300, 44500]},
+            3: {'end': [79199, 86399],'start': [28169, 75599]},
+            4: {'end': [], 'start': []},
+            5: {'end': [], 'start': []},
+            6: {'end': [], 'start': []}
+        }
+        days = {
+            datetime.date(2013, 9, 10): {
+                'end': datetime.time(22, 0, 54),
+                'start': datetime.time(11, 33, 0),
+            },
+            datetime.date(2013, 9, 17): {
+                'end': datetime.time(17, 6, 28),
+                'start': datetime.time(12, 21, 40),
+            },
+            datetime.date(2013, 9, 11): {
+                'end': datetime.time(13, 6, 28),
+                'start': datetime.time(5, 21, 40),
+            },
+            datetime.date(2013, 9, 18): {
+                'end': datetime.time(21, 6, 28),
+                'start': datetime.time(12, 21, 40),
+            },
+            datetime.date(2013, 9, 12): {
+                'end': datetime.time(21, 59, 59),
+                'start': datetime.time(7, 49, 29),
+            },
+            datetime.date(2013, 9, 19): {
+                'end': datetime.time(23, 59, 59),
+                'start': datetime.time(20, 59, 59),
+            }
+        }
+        data = utils.group_by_start_end(days)
+        self.assertEqual(data, excepted_result)
+
+    def test_seconds_since_midnight(self):
+        """
+        Test calculates amount of seconds since midnight.
+        """
+        sample_date = datetime.time(18, 17, 4)
+        date = (
+            utils.seconds_since_midnight(
+                datetime.time(23, 11, 0)
+            ),
+            utils.seconds_since_midnight(
+                datetime.time(0, 0, 0)
+            ),
+            utils.seconds_since_midnight(
+                datetime.time(5, 54, 43)
+            ),
+        )
+        self.assertLess(sample_date.hour, 24)
+        self.assertGreater(sample_date.hour, -1)
+        self.assertLess(sample_date.minute, 60)
+        self.assertGreater(sample_date.minute, -1)
+        self.assertLess(sample_date.second, 60)
+        self.assertGreater(sample_date.second, -1)
+        self.assertEqual(date[0], 83460)
+        self.assertEqual(date[1], 0)
+        self.assertEqual(date[2], 21283)
+
+    def test_interval(self):
+        """
+        Test interval between two datetime.time objects.
+        """
+        date = (
+            utils.interval(
+                datetime.time(8, 31, 6),
+                datetime.time(15, 15, 27),
+            ),
+            utils.interval(
+                datetime.time(0, 0, 0),
+                datetime.time(0, 0, 0),
+            ),
+            utils.interval(
+                datetime.time(5, 30, 5),
+                datetime.time(10, 15, 53),
+            ),
+        )
+        self.assertEqual(date[0], 24261)
+        self.assertEqual(date[1], 0)
+        self.assertEqual(date[2], 17148)
+
+    def test_mean(self):
+        """
+        Test calculates arithmetic mean.
+        """
+        date = (
+            utils.mean([24261, 32533, 34323, 32453, 54154, 32412, 31123]),
+            utils.mean([0]),
+            utils.mean([-12332, -3213, -3213, -32131, -32131])
         )
         self.assertEqual(date[0], 34465.57142857143)
         self.assertEqual(date[1], 0)
         self.assertEqual(date[2], -16604)
 
+    def test_average(self):
+        """
+        Test calculates arithmetic mean from precomputed sum.
+        """
+        self.assertEqual(utils.average(30, 4), 7.5)
+        self.assertEqual(utils.average(0, 0), 0)
+        self.assertEqual(utils.average(-10, 2), -5)
+
+    def test_weekday_index(self):
+        """
+        Test precomputed weekday index against grouping helpers.
+        """
+        for path in (TEST_DATA_CSV, SAMPLE_DATA_CSV):
+            presence = backends.load_presence(path)
+            data = presence.data
+            index = engine.build_weekday_index(presence.store)
+            self.assertItemsEqual(index.keys(), data.keys())
+            for user_id, items in data.iteritems():
+                intervals = utils.group_by_weekday(items)
+                start_end = utils.group_by_start_end(items)
+                for weekday, stats in enumerate(index[user_id]):
+                    self.assertEqual(stats.count, len(intervals[weekday]))
+                    self.assertEqual(stats.presence, sum(intervals[weekday]))
+                    self.assertEqual(
+                        stats.start, sum(start_end[weekday]['start'])
+                    )
+                    self.assertEqual(
+                        stats.end, sum(start_end[weekday]['end'])
+                    )
+
+
+class PresenceAnalyzerIngestTestCase(unittest.TestCase):
+
+    """
+    Fast CSV parser tests.
+    """
+
+    def test_parse_date(self):
+        """
+        Test parsing of fixed width dates.
+        """
+        self.assertEqual(
+            ingest.parse_date('2013-09-10'), datetime.date(2013, 9, 10)
+        )
+        self.assertEqual(
+            ingest.parse_date('2013-9-1'), datetime.date(2013, 9, 1)
+        )
+        self.assertRaises(ValueError, ingest.parse_date, '2013-02-30')
+
+    def test_parse_time(self):
+        """
+        Test parsing of fixed width times.
+        """
+        self.assertEqual(ingest.parse_time('09:39:05'), 34745)
+        self.assertEqual(ingest.parse_time('00:00:00'), 0)
+        self.assertEqual(ingest.parse_time('9:39:05'), 34745)
+        self.assertRaises(ValueError, ingest.parse_time, '24:00:00')
+        self.assertRaises(ValueError, ingest.parse_time, '12:60:00')
+        self.assertRaises(ValueError, ingest.parse_time, 'ab:cd:ef')
+
+    def test_user_id_range(self):
+        """
+        Test that user ids not fitting the store are skipped.
+        """
+        lines = [
+            '3000000000,2013-09-10,09:00:00,10:00:00\n',
+            '-3000000000,2013-09-10,09:00:00,10:00:00\n',
+            '10,2013-09-10,09:00:00,10:00:00\n',
+        ]
+        expected = [(10, datetime.date(2013, 9, 10), 32400, 36000)]
+        self.assertEqual(list(ingest.iter_rows(lines)), expected)
+        self.assertEqual(list(ingest.iter_rows_strptime(lines)), expected)
+        presence_store = store.PresenceStore.from_rows(
+            ingest.iter_rows(lines)
+        )
+        self.assertEqual(presence_store.user_ids(), [10])
+        self.assertEqual(ingest.parse_user_id(str(2 ** 31 - 1)), 2 ** 31 - 1)
+        self.assertRaises(ValueError, ingest.parse_user_id, str(2 ** 31))
+
+    def test_iter_rows_skips_invalid_lines(self):
+        """
+        Test that header and malformed lines are skipped.
+        """
+        lines = [
+            'user_id,date,start,end\n',
+            '10,2013-09-10,09:39:05,17:59:52\r\n',
+            '10,2013-09-11,25:00:00,17:59:52\n',
+            'garbage\n',
+            '11,2013-09-10,09:00:00,10:00:00',
+        ]
+        self.assertEqual(list(ingest.iter_rows(lines)), [
+            (10, datetime.date(2013, 9, 10), 34745, 64792),
+            (11, datetime.date(2013, 9, 10), 32400, 36000),
+        ])
+
+    def test_iter_rows_quoted_fields(self):
+        """
+        Test that quoted fields are parsed like plain ones.
+        """
+        lines = [
+            '"user_id","date","start","end"\n',
+            '"10","2013-09-10","09:00:00","10:00:00"\r\n',
+            '11,"2013-09-10",09:00:00,"10:00:00"\n',
+            '"1,2",2013-09-10,09:00:00,10:00:00\n',
+        ]
+        expected = [
+            (10, datetime.date(2013, 9, 10), 32400, 36000),
+            (11, datetime.date(2013, 9, 10), 32400, 36000),
+        ]
+        self.assertEqual(list(ingest.iter_rows(lines)), expected)
+        self.assertEqual(list(ingest.iter_rows_strptime(lines)), expected)
+
+    def test_iter_rows_matches_strptime(self):
+        """
+        Test that fast parser gives same rows as strptime based one.
+        """
+        for path in (TEST_DATA_CSV, SAMPLE_DATA_CSV):
+            with open(path) as csvfile:
+                fast = list(ingest.iter_rows(csvfile))
+            with open(path) as csvfile:
+                reference = list(ingest.iter_rows_strptime(csvfile))
+            self.assertEqual(fast, reference)
+
+    def test_time_from_seconds(self):
+        """
+        Test conversion of seconds since midnight to time objects.
+        """
+        self.assertEqual(
+            ingest.time_from_seconds(34745), datetime.time(9, 39, 5)
+        )
+        self.assertIs(
+            ingest.time_from_seconds(34745), ingest.time_from_seconds(34745)
+        )
+
+
+class PresenceAnalyzerGeneratorTestCase(unittest.TestCase):
+
+    """
+    Synthetic data generator tests.
+    """
+
+    def test_generate(self):
+        """
+        Test that generated data can be parsed back.
+        """
+        stream = StringIO()
+        written = generator.generate(
+            stream, users=3, days=60, missing=0.2, malformed=0.1, seed=1
+        )
+        lines = stream.getvalue().splitlines(True)
+        rows = list(ingest.iter_rows(lines))
+        self.assertEqual(len(rows), written)
+        self.assertGreater(len(lines), written)
+        self.assertEqual(rows, sorted(rows))
+        self.assertEqual(set(row[0] for row in rows), set([10, 11, 12]))
+        for dummy, date, start, end in rows:
+            self.assertLessEqual(start, end)
+            self.assertLess(date, datetime.date(2013, 3, 2))
+
+    def test_generate_rows(self):
+        """
+        Test generating file with exact number of rows.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = generator.generate_rows(
+                os.path.join(tmpdir, 'data.csv'), 1000
+            )
+            with open(path) as csvfile:
+                self.assertEqual(len(list(ingest.iter_rows(csvfile))), 1000)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+
+    """
+    Columnar store tests.
+    """
+
+    def test_from_rows(self):
+        """
+        Test that records are sorted and deduplicated.
+        """
+        presence_store = store.PresenceStore.from_rows([
+            (11, datetime.date(2013, 9, 11), 100, 200),
+            (10, datetime.date(2013, 9, 10), 300, 400),
+            (11, datetime.date(2013, 9, 10), 500, 600),
+            (11, datetime.date(2013, 9, 11), 700, 800),
+        ])
+        ordinal = datetime.date(2013, 9, 10).toordinal()
+        self.assertEqual(len(presence_store), 3)
+        self.assertEqual(list(presence_store.users), [10, 11, 11])
+        self.assertEqual(
+            list(presence_store.days), [ordinal, ordinal, ordinal + 1]
+        )
+        self.assertEqual(list(presence_store.starts), [300, 500, 700])
+        self.assertEqual(list(presence_store.ends), [400, 600, 800])
+        self.assertEqual(presence_store.offsets, {10: (0, 1), 11: (1, 3)})
+        self.assertEqual(presence_store.user_ids(), [10, 11])
+        self.assertIn(11, presence_store)
+        self.assertNotIn(12, presence_store)
+        self.assertEqual(list(presence_store.user_rows(12)), [])
+
+    def test_date_range(self):
+        """
+        Test finding records within a date range.
+        """
+        with open(TEST_DATA_CSV) as csvfile:
+            presence_store = store.PresenceStore.from_rows(
+                ingest.iter_rows(csvfile)
+            )
+        first, last = presence_store.user_slice(11)
+        self.assertEqual(presence_store.date_range(11), (first, last))
+        day = datetime.date(2013, 9, 10).toordinal()
+        self.assertEqual(
+            [row[0] for row in presence_store.user_rows(11, day, day + 1)],
+            [day, day + 1]
+        )
+        self.assertEqual(
+            presence_store.date_range(11, day + 100), (last, last)
+        )
+        self.assertEqual(
+            presence_store.date_range(11, day, day - 1), (first + 2,) * 2
+        )
+        self.assertEqual(presence_store.date_range(99, day), (0, 0))
+
+    def test_merge(self):
+        """
+        Test that merged rows are added and replace existing records.
+        """
+        presence_store = store.PresenceStore.from_rows([
+            (10, datetime.date(2013, 9, 10), 300, 400),
+            (11, datetime.date(2013, 9, 10), 500, 600),
+            (13, datetime.date(2013, 9, 10), 500, 600),
+        ])
+        merged = presence_store.merge([
+            (11, datetime.date(2013, 9, 11), 700, 800),
+            (11, datetime.date(2013, 9, 10), 100, 200),
+            (12, datetime.date(2013, 9, 10), 900, 1000),
+        ])
+        ordinal = datetime.date(2013, 9, 10).toordinal()
+        self.assertEqual(list(merged.users), [10, 11, 11, 12, 13])
+        self.assertEqual(list(merged.starts), [300, 100, 700, 900, 500])
+        self.assertEqual(list(merged.user_rows(11)), [
+            (ordinal, 100, 200), (ordinal + 1, 700, 800),
+        ])
+        self.assertEqual(
+            merged.offsets, store.build_offsets(merged.users)
+        )
+        self.assertIs(presence_store.merge([]), presence_store)
+
+    def test_combine(self):
+        """
+        Test combining stores, later stores win on conflicts.
+        """
+        september = store.PresenceStore.from_rows([
+            (10, datetime.date(2013, 9, 10), 100, 200),
+            (11, datetime.date(2013, 9, 30), 300, 400),
+        ])
+        october = store.PresenceStore.from_rows([
+            (10, datetime.date(2013, 10, 1), 500, 600),
+            (11, datetime.date(2013, 9, 30), 700, 800),
+            (11, datetime.date(2013, 10, 1), 900, 1000),
+        ])
+        combined, conflicts = store.PresenceStore.combine(
+            [october, september]
+        )
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(list(combined.starts), [100, 500, 300, 900])
+        combined, conflicts = store.PresenceStore.combine(
+            [september, october]
+        )
+        self.assertEqual(conflicts, 1)
+        self.assertEqual(list(combined.users), [10, 10, 11, 11])
+        self.assertEqual(list(combined.starts), [100, 500, 700, 900])
+        self.assertEqual(
+            combined.offsets, store.build_offsets(combined.users)
+        )
+        self.assertEqual(len(store.PresenceStore.combine([])[0]), 0)
+
+    def test_to_dict(self):
+        """
+        Test that store gives same dict layout as the strptime parser.
+        """
+        for path in (TEST_DATA_CSV, SAMPLE_DATA_CSV):
+            expected = {}
+            with open(path) as csvfile:
+                for user_id, date, start, end in ingest.iter_rows_strptime(
+                        csvfile):
+                    expected.setdefault(user_id, {})[date] = {
+                        'start': ingest.time_from_seconds(start),
+                        'end': ingest.time_from_seconds(end),
+                    }
+            with open(path) as csvfile:
+                presence_store = store.PresenceStore.from_rows(
+                    ingest.iter_rows(csvfile)
+                )
+            self.assertEqual(presence_store.to_dict(), expected)
+
+    def test_weekday_from_ordinal(self):
+        """
+        Test weekday calculation from date ordinals.
+        """
+        for day in range(1, 15):
+            date = datetime.date(2013, 9, day)
+            self.assertEqual(
+                store.weekday_from_ordinal(date.toordinal()), date.weekday()
+            )
+
+
+class PresenceAnalyzerEngineTestCase(unittest.TestCase):
+
+    """
+    Aggregation engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, load sample data.
+        """
+        self.store = backends.load_presence(SAMPLE_DATA_CSV).store
+
+    @unittest.skipIf(engine.numpy is None, 'NumPy is not installed')
+    def test_numpy_parity(self):
+        """
+        Test that NumPy and pure Python engines give same results.
+        """
+        self.assertEqual(
+            engine.build_weekday_index(self.store, use_numpy=True),
+            engine.build_weekday_index(self.store, use_numpy=False),
+        )
+        user_ids = [10, 11, 12345]
+        self.assertEqual(
+            engine.build_weekday_index(self.store, user_ids, use_numpy=True),
+            engine.build_weekday_index(self.store, user_ids, use_numpy=False),
+        )
+
+    def test_weekday_index_user(self):
+        """
+        Test weekday index of single user against grouping helpers.
+        """
+        items = self.store.user_items(11)
+        intervals = utils.group_by_weekday(items)
+        start_end = utils.group_by_start_end(items)
+        for use_numpy in (False, engine.numpy is not None):
+            stats = engine.build_weekday_index(
+                self.store, [11], use_numpy
+            )[11]
+            self.assertEqual(
+                [day.count for day in stats], [len(i) for i in intervals]
+            )
+            self.assertEqual(
+                [day.presence for day in stats], [sum(i) for i in intervals]
+            )
+            self.assertEqual(
+                [utils.average(day.start, day.count) for day in stats],
+                [utils.mean(start_end[i]['start']) for i in range(7)]
+            )
+            self.assertEqual(
+                [utils.average(day.end, day.count) for day in stats],
+                [utils.mean(start_end[i]['end']) for i in range(7)]
+            )
+
+    def test_window_stats(self):
+        """
+        Test prefix sums against scanning records in the window.
+        """
+        first, last = self.store.user_slice(11)
+        days = self.store.days[first:last]
+        windows = [
+            (None, None), (None, days[5]), (days[3], None),
+            (days[0] - 30, days[-1] + 30), (days[10], days[10]),
+            (days[7] + 1, days[40] - 1), (days[20], days[10]),
+        ]
+        for use_numpy in (False, engine.numpy is not None):
+            index = engine.build_prefix_index(
+                self.store, [11, 12345], use_numpy
+            )
+            self.assertEqual(index.keys(), [11])
+            for window in windows:
+                self.assertEqual(
+                    engine.window_stats(index[11], *window),
+                    engine.range_weekday_stats(self.store, 11, *window),
+                )
+
+    @unittest.skipIf(engine.numpy is None, 'NumPy is not installed')
+    def test_prefix_numpy_parity(self):
+        """
+        Test that NumPy and pure Python prefix sums give same results.
+
+        Cells of NumPy index also carry totals of preceding users, so only
+        windows are compared.
+        """
+        with_numpy = engine.build_prefix_index(self.store, use_numpy=True)
+        without = engine.build_prefix_index(self.store, use_numpy=False)
+        self.assertEqual(sorted(with_numpy), sorted(without))
+        day = datetime.date(2013, 6, 1).toordinal()
+        for user_id in without:
+            for window in ((None, None), (day, None), (day - 90, day)):
+                self.assertEqual(
+                    engine.window_stats(with_numpy[user_id], *window),
+                    engine.window_stats(without[user_id], *window),
+                )
+
+    def test_group_weekday_stats(self):
+        """
+        Test reduction of user statistics by group.
+        """
+        groups = dict(
+            (user_id, 'team {0}'.format(user_id % 3))
+            for user_id in self.store.user_ids()[::2]
+        )
+        index = engine.build_weekday_index(self.store)
+        grouped = engine.group_weekday_stats(index.iteritems(), groups)
+        self.assertItemsEqual(
+            grouped.keys(), [None, 'team 0', 'team 1', 'team 2']
+        )
+        for name, weekdays in grouped.iteritems():
+            members = [
+                stats for user_id, stats in index.iteritems()
+                if groups.get(user_id) == name
+            ]
+            for weekday, total in enumerate(weekdays):
+                self.assertEqual(total.users, sum(
+                    1 for stats in members if stats[weekday].count
+                ))
+                self.assertEqual(total.presence, sum(
+                    stats[weekday].presence for stats in members
+                ))
+        total = engine.merge_group_stats(grouped.values())
+        self.assertEqual(
+            [stats[1:] for stats in total],
+            [tuple(sum(column) for column in zip(*weekday))
+             for weekday in zip(*index.values())],
+        )
+        self.assertEqual(engine.group_weekday_stats([(1, [
+            engine.WeekdayStats(0, 0, 0, 0)
+        ] * 7)], {}), {})
+
+    def test_occupancy(self):
+        """
+        Test that occupancy matches expanding every record to minutes.
+        """
+        day = datetime.date(2013, 6, 1).toordinal()
+        engines = [False]
+        if engine.numpy is not None:
+            engines.append(True)
+        for first, last in ((None, None), (day - 90, day)):
+            minutes = [[0] * engine.MINUTES for dummy in range(7)]
+            dates = [set() for dummy in range(7)]
+            for user_id in self.store.user_ids():
+                for row_day, start, end in self.store.user_rows(
+                        user_id, first, last):
+                    weekday = store.weekday_from_ordinal(row_day)
+                    dates[weekday].add(row_day)
+                    for minute in range(start // 60, end // 60):
+                        minutes[weekday][minute] += 1
+            for use_numpy in engines:
+                self.assertEqual(
+                    engine.build_occupancy(
+                        self.store, first, last, use_numpy=use_numpy
+                    ),
+                    (minutes, [len(weekday) for weekday in dates]),
+                )
+
+    def test_empty_store(self):
+        """
+        Test aggregation of store without records.
+        """
+        empty = store.PresenceStore.from_rows([])
+        self.assertEqual(engine.build_weekday_index(empty), {})
+        self.assertEqual(
+            engine.build_weekday_index(empty, use_numpy=False), {}
+        )
+        self.assertEqual(engine.build_prefix_index(empty), {})
+        self.assertEqual(
+            engine.build_prefix_index(empty, use_numpy=False), {}
+        )
+
+
+class PresenceAnalyzerSketchTestCase(unittest.TestCase):
+
+    """
+    Quantile sketches tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, load sample data.
+        """
+        with open(SAMPLE_DATA_CSV) as csvfile:
+            self.store = store.PresenceStore.from_rows(
+                ingest.iter_rows(csvfile)
+            )
+
+    def test_accuracy(self):
+        """
+        Test that quantiles are within a bin of exact percentiles.
+        """
+        index = sketch.build_sketch_index(self.store, use_numpy=False)
+        for user_id in self.store.user_ids():
+            quantiles = sketch.weekday_quantiles(index[user_id])
+            values = [[] for dummy in range(7)]
+            for day, start, end in self.store.user_rows(user_id):
+                values[store.weekday_from_ordinal(day)].append(start)
+            for weekday, starts in enumerate(values):
+                if not starts:
+                    self.assertEqual(quantiles[weekday].start, (0, 0, 0))
+                    continue
+                starts.sort()
+                for quantile, value in zip(
+                        sketch.QUANTILES, quantiles[weekday].start):
+                    # records around rank quantile * count
+                    rank = int(quantile * len(starts))
+                    self.assertGreaterEqual(
+                        value,
+                        starts[max(0, rank - 1)] - sketch.BIN_SECONDS,
+                    )
+                    self.assertLessEqual(
+                        value,
+                        starts[min(len(starts) - 1, rank)] +
+                        sketch.BIN_SECONDS,
+                    )
+
+    def test_histogram_quantiles(self):
+        """
+        Test interpolation within bins.
+        """
+        counts = [0] * sketch.BINS
+        counts[2] = 1
+        counts[4] = 3
+        self.assertEqual(
+            sketch.histogram_quantiles(counts, (0.0, 0.25, 0.5, 1.0)),
+            (600, 900, 1300, 1500),
+        )
+        self.assertEqual(
+            sketch.histogram_quantiles([0] * sketch.BINS, (0.5,)), (0,)
+        )
+        self.assertEqual(sketch.time_bin(-5), 0)
+        self.assertEqual(sketch.time_bin(90000), sketch.BINS - 1)
+
+    @unittest.skipIf(engine.numpy is None, 'NumPy is not installed')
+    def test_numpy_parity(self):
+        """
+        Test that NumPy and pure Python sketches are identical.
+        """
+        user_ids = self.store.user_ids()[::3]
+        for selected in (None, user_ids):
+            python = sketch.build_sketch_index(
+                self.store, selected, use_numpy=False
+            )
+            numpy = sketch.build_sketch_index(
+                self.store, selected, use_numpy=True
+            )
+            self.assertEqual(python, numpy)
+
+    def test_extend(self):
+        """
+        Test that sketches of users with appended rows are rebuilt.
+        """
+        presence = backends.PresenceData(self.store)
+        day = datetime.date(2013, 9, 10)
+        extended = presence.extend([(10, day, 3600, 7200)], None)
+        self.assertEqual(
+            extended.sketches[10],
+            sketch.sketch_rows(extended.store.user_rows(10)),
+        )
+        self.assertIs(extended.sketches[11], presence.sketches[11])
+        self.assertEqual(
+            extended.weekday_quantiles(10, day, day)[1].start,
+            (3630, 3750, 3870),
+        )
+
+
+class PresenceAnalyzerDataCacheTestCase(unittest.TestCase):
+
+    """
+    Parsed data cache tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to a temporary file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        backends.DATA_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+        backends.DATA_CACHE.clear()
+
+    def test_get_data_cached(self):
+        """
+        Test that unchanged file is parsed only once.
+        """
+        first = utils.get_data()
+        second = utils.get_data()
+        self.assertIs(first, second)
+        self.assertEqual(
+            backends.DATA_CACHE.stats(),
+            {'hits': 1, 'misses': 1, 'reloads': 0, 'stale': 0}
+        )
+
+    def test_get_data_reloaded(self):
+        """
+        Test that changed file is parsed again.
+        """
+        first = utils.get_data()
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,08:00:00,16:00:00\n')
+        second = utils.get_data()
+        self.assertIsNot(first, second)
+        self.assertNotIn(12, first)
+        self.assertIn(12, second)
+        self.assertEqual(backends.DATA_CACHE.stats()['reloads'], 1)
+
+    def test_get_data_stale_during_reload(self):
+        """
+        Test that readers get the old snapshot while other thread reparses.
+        """
+        first = utils.get_data()
+        os.utime(self.csv_path, (0, 0))
+        # pylint: disable=protected-access
+        with backends.DATA_CACHE._reload_lock:
+            self.assertIs(utils.get_data(), first)
+        self.assertEqual(backends.DATA_CACHE.stats()['stale'], 1)
+        self.assertIsNot(utils.get_data(), first)
+
+    def test_tail_append(self):
+        """
+        Test that appended lines are merged into previous snapshot.
+        """
+        first = utils.get_presence()
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write(
+                '\n12,2013-09-13,08:00:00,16:00:00'
+                '\n10,2013-09-10,08:00:00,16:00:00\n'
+                '11,2013-09-16,08:00:00,1'
+            )
+        tail = ingest.read_tail(self.csv_path, first.source)
+        self.assertIsNotNone(tail)
+        rows, source = tail
+        # unterminated last line of test data is parsed again
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(source.size, os.path.getsize(self.csv_path))
+
+        second = utils.get_presence()
+        reference = backends.load_presence(self.csv_path)
+        self.assertEqual(second.data, reference.data)
+        self.assertEqual(second.weekdays, reference.weekdays)
+        self.assertEqual(second.source.offset, reference.source.offset)
+        self.assertEqual(
+            second.data[10][datetime.date(2013, 9, 10)]['start'],
+            datetime.time(8, 0, 0)
+        )
+
+        # complete unterminated line
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('7:00:00\n')
+        third = utils.get_presence()
+        self.assertEqual(
+            third.data[11][datetime.date(2013, 9, 16)]['end'],
+            datetime.time(17, 0, 0)
+        )
+        self.assertEqual(
+            third.data, backends.load_presence(self.csv_path).data
+        )
+
+    def test_tail_rewrite(self):
+        """
+        Test that truncated and rewritten files are parsed from scratch.
+        """
+        source = utils.get_presence().source
+        with open(self.csv_path, 'r+') as csvfile:
+            csvfile.truncate(source.size - 10)
+        self.assertIsNone(ingest.read_tail(self.csv_path, source))
+
+        with open(self.csv_path, 'w') as csvfile:
+            csvfile.write('12,2013-09-13,08:00:00,16:00:00\n' * 20)
+        self.assertIsNone(ingest.read_tail(self.csv_path, source))
+        self.assertItemsEqual(utils.get_data().keys(), [12])
+
+    def test_refresher(self):
+        """
+        Test that background refresher swaps in new data.
+        """
+        main.app.config.update({
+            'DATA_REFRESH': True,
+            'DATA_REFRESH_INTERVAL': 0.01,
+        })
+        refresher = backends.start_refresher()
+        try:
+            self.assertIs(backends.start_refresher(), refresher)
+            first = utils.get_presence()
+            with open(self.csv_path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-13,08:00:00,16:00:00\n')
+            for dummy in range(500):
+                if utils.get_presence() is not first:
+                    break
+                time.sleep(0.01)
+            self.assertIn(12, utils.get_presence())
+
+            # requests don't look at the file while it's being watched
+            os.unlink(self.csv_path)
+            self.assertIn(12, utils.get_presence())
+        finally:
+            refresher.stop()
+            main.app.config.update({'DATA_REFRESH': False})
+        self.assertFalse(refresher.is_alive())
+        self.assertRaises(OSError, utils.get_presence)
+
+
+class PresenceAnalyzerSnapshotTestCase(unittest.TestCase):
+
+    """
+    Binary snapshot tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to a temporary file.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        self.snap_path = snapshot.snapshot_path(self.csv_path)
+        shutil.copy(TEST_DATA_CSV, self.csv_path)
+        main.app.config.update({'DATA_CSV': self.csv_path})
+        backends.DATA_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+        main.app.config.pop('DATA_SNAPSHOT', None)
+        backends.DATA_CACHE.clear()
+
+    def test_round_trip(self):
+        """
+        Test that store read from snapshot equals the written one.
+        """
+        written = snapshot.build_snapshot(self.csv_path)
+        read = snapshot.read_snapshot(
+            self.snap_path, snapshot.source_signature(self.csv_path)
+        )
+        self.assertEqual(read.users, written.users)
+        self.assertEqual(read.days, written.days)
+        self.assertEqual(read.starts, written.starts)
+        self.assertEqual(read.ends, written.ends)
+        self.assertEqual(read.offsets, written.offsets)
+
+    def test_out_of_date(self):
+        """
+        Test that snapshot of changed CSV file is rejected.
+        """
+        snapshot.build_snapshot(self.csv_path)
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,08:00:00,16:00:00\n')
+        self.assertRaises(
+            snapshot.SnapshotError, snapshot.read_snapshot,
+            self.snap_path, snapshot.source_signature(self.csv_path),
+        )
+        self.assertIn(12, snapshot.load_store(self.csv_path))
+        self.assertIn(12, snapshot.read_snapshot(self.snap_path))
+
+    def test_invalid(self):
+        """
+        Test that missing, foreign and truncated files are rejected.
+        """
+        self.assertRaises(
+            snapshot.SnapshotError, snapshot.read_snapshot, self.snap_path
+        )
+        snapshot.build_snapshot(self.csv_path)
+        with open(self.snap_path, 'rb') as snapfile:
+            content = snapfile.read()
+        for broken in (b'', b'X' + content[1:], content[:-1]):
+            with open(self.snap_path, 'wb') as snapfile:
+                snapfile.write(broken)
+            self.assertRaises(
+                snapshot.SnapshotError, snapshot.read_snapshot,
+                self.snap_path,
+            )
+
+    def test_get_data_uses_snapshot(self):
+        """
+        Test that get_data loads records from up to date snapshot.
+        """
+        main.app.config.update({'DATA_SNAPSHOT': True})
+        os.utime(self.csv_path, (1381000000, 1381000000))
+        expected = utils.get_data()
+        self.assertTrue(os.path.exists(self.snap_path))
+        # same size and mtime, but garbage content
+        stat = os.stat(self.csv_path)
+        with open(self.csv_path, 'r+') as csvfile:
+            csvfile.write('x' * stat.st_size)
+        os.utime(self.csv_path, (1381000000, 1381000000))
+        backends.DATA_CACHE.clear()
+        self.assertEqual(utils.get_data(), expected)
+
+
+class PresenceAnalyzerDataDirTestCase(unittest.TestCase):
+
+    """
+    Data directory loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, create directory with two monthly files.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.write('2013-09.csv', [
+            '10,2013-09-10,09:00:00,17:00:00',
+            '11,2013-09-30,09:00:00,17:00:00',
+        ])
+        self.write('2013-10.csv', [
+            '10,2013-10-01,08:00:00,16:00:00',
+            '11,2013-09-30,10:00:00,12:00:00',
+        ])
+        backends.DATA_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+        main.app.config.pop('DATA_DIR', None)
+        backends.DATA_CACHE.clear()
+
+    def write(self, name, lines):
+        """
+        Writes CSV file with given lines to the directory.
+        """
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as csvfile:
+            csvfile.write('user_id,date,start,end\n')
+            csvfile.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_load_directory(self):
+        """
+        Test loading all files, later file wins on conflicts.
+        """
+        presence = backends.load_presence(self.tmpdir)
+        self.assertEqual(presence.user_ids(), [10, 11])
+        self.assertEqual(len(presence.store), 3)
+        self.assertEqual(presence.data[11], {
+            datetime.date(2013, 9, 30): {
+                'start': datetime.time(10, 0, 0),
+                'end': datetime.time(12, 0, 0),
+            },
+        })
+        self.assertEqual(presence.weekday_stats(10)[1].count, 2)
+        self.assertEqual(sorted(presence.source), [
+            os.path.join(self.tmpdir, name)
+            for name in ('2013-09.csv', '2013-10.csv')
+        ])
+
+    def test_reload_changed_files(self):
+        """
+        Test that only new and changed files are parsed again.
+        """
+        presence = backends.load_presence(self.tmpdir)
+        september = os.path.join(self.tmpdir, '2013-09.csv')
+        october = os.path.join(self.tmpdir, '2013-10.csv')
+        signature = backends.file_signature(self.tmpdir)
+        path = self.write('2013-11.csv', ['12,2013-11-04,09:00:00,17:00:00'])
+        self.assertNotEqual(backends.file_signature(self.tmpdir), signature)
+        reloaded = backends.load_presence(self.tmpdir, presence)
+        self.assertEqual(reloaded.user_ids(), [10, 11, 12])
+        self.assertIs(reloaded.source[september][1],
+                      presence.source[september][1])
+        self.assertIs(reloaded.source[october][1],
+                      presence.source[october][1])
+
+        os.remove(path)
+        self.write('2013-10.csv', ['10,2013-10-01,08:00:00,16:00:00'])
+        os.utime(october, (1381000000, 1381000000))
+        reloaded = backends.load_presence(self.tmpdir, reloaded)
+        self.assertEqual(reloaded.user_ids(), [10, 11])
+        self.assertEqual(reloaded.store.user_rows(11).next()[1], 32400)
+        self.assertIs(reloaded.source[september][1],
+                      presence.source[september][1])
+
+    def test_parallel_parsing(self):
+        """
+        Test that files parsed in a process pool give same stores.
+        """
+        paths = datadir.list_files(self.tmpdir)
+        for serial, parallel in zip(
+                datadir.parse_files(paths, workers=1),
+                datadir.parse_files(paths, workers=2)):
+            self.assertEqual(serial.offsets, parallel.offsets)
+            self.assertEqual(serial.starts, parallel.starts)
+
+    def test_views(self):
+        """
+        Test that DATA_DIR takes precedence over DATA_CSV.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV, 'DATA_DIR': self.tmpdir,
+        })
+        client = main.app.test_client()
+        data = json.loads(client.get('/api/v1/users').data)
+        self.assertEqual([user['user_id'] for user in data], [10, 11])
+        data = json.loads(client.get('/api/v1/presence_weekday/11').data)
+        self.assertEqual(data[1], ['Mon', 7200])
+
+
+class PresenceAnalyzerDatabaseTestCase(unittest.TestCase):
+
+    """
+    SQLite storage engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, create temporary directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.sqlite')
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_weekday_stats(self):
+        """
+        Test SQL aggregation against aggregation engine.
+        """
+        presence_db = database.import_csv(self.path, [SAMPLE_DATA_CSV], '1')
+        presence = backends.load_presence(SAMPLE_DATA_CSV)
+        self.assertEqual(presence_db.user_ids(), presence.user_ids())
+        self.assertEqual(len(presence_db), len(presence.store))
+        self.assertEqual(presence_db.last_day(), presence.last_day)
+        first = datetime.date(2013, 3, 1)
+        last = datetime.date(2013, 5, 31)
+        for user_id in presence.user_ids()[:10]:
+            self.assertEqual(
+                presence_db.weekday_stats(user_id),
+                presence.weekday_stats(user_id),
+            )
+            self.assertEqual(
+                presence_db.weekday_stats(user_id, first, last),
+                presence.weekday_stats(user_id, first, last),
+            )
+        self.assertEqual(presence_db.weekday_stats(12345)[0].count, 0)
+        self.assertEqual(presence_db.to_dict(), presence.data)
+
+    def test_reuse(self):
+        """
+        Test that database is rebuilt only when data changes.
+        """
+        presence_db = database.open_database(
+            self.path, [TEST_DATA_CSV], 'a'
+        )
+        self.assertEqual(presence_db.meta('signature'), 'a')
+        os.utime(self.path, (1381000000, 1381000000))
+        database.open_database(self.path, [TEST_DATA_CSV], 'a')
+        self.assertEqual(os.stat(self.path).st_mtime, 1381000000)
+        presence_db = database.open_database(
+            self.path, [TEST_DATA_CSV], 'b'
+        )
+        self.assertEqual(presence_db.meta('signature'), 'b')
+        self.assertEqual(presence_db.user_ids(), [10, 11])
+
+    def test_later_file_wins(self):
+        """
+        Test that records of later files replace earlier ones.
+        """
+        path = os.path.join(self.tmpdir, 'update.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,10:00:00,11:00:00\n')
+        presence_db = database.import_csv(
+            self.path, [TEST_DATA_CSV, path], '1'
+        )
+        self.assertEqual(
+            list(presence_db.user_rows(10))[0],
+            (datetime.date(2013, 9, 10), 36000, 39600),
+        )
+
+    def test_connection_per_thread(self):
+        """
+        Test that every thread gets its own connection.
+        """
+        presence_db = database.import_csv(self.path, [TEST_DATA_CSV], '1')
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(presence_db.connection())
+        )
+        thread.start()
+        thread.join()
+        self.assertIs(presence_db.connection(), presence_db.connection())
+        self.assertIsNot(presence_db.connection(), connections[0])
+        presence_db.close()
+        self.assertEqual(presence_db.user_ids(), [10, 11])
+
+
+class PresenceAnalyzerSharedTestCase(unittest.TestCase):
+
+    """
+    Shared memory segments tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to a temporary directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        self.directory = os.path.join(self.tmpdir, 'shared')
+        shutil.copy(SAMPLE_DATA_CSV, self.csv_path)
+        main.app.config.update({
+            'DATA_CSV': self.csv_path,
+            'STORAGE_BACKEND': 'shared',
+            'SHARED_DIR': self.directory,
+        })
+        backends.DATA_CACHE.clear()
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'STORAGE_BACKEND': 'memory',
+            'SHARED_DIR': None,
+        })
+        backends.DATA_CACHE.clear()
+        backends.BACKENDS['shared'].clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """
+        Test that mapped segment gives same results as parsed data.
+        """
+        presence = backends.load_presence(self.csv_path)
+        path = shared.publish(self.directory, presence)
+        generation, mapped_store, weekdays, prefix, sketches, signature = \
+            shared.read_segment(path)
+        self.assertEqual(generation, 1)
+        self.assertEqual(signature, presence.signature)
+        self.assertEqual(weekdays, presence.weekdays)
+        self.assertEqual(
+            dict((user_id, list(sketch)) for user_id, sketch in
+                 sketches.items()),
+            dict((user_id, list(sketch)) for user_id, sketch in
+                 presence.sketches.items()),
+        )
+        self.assertEqual(mapped_store.offsets, presence.store.offsets)
+        self.assertEqual(list(mapped_store.ends), list(presence.store.ends))
+        day = datetime.date(2013, 6, 1).toordinal()
+        for user_id in presence.user_ids():
+            for window in ((None, None), (day, None), (day - 90, day)):
+                self.assertEqual(
+                    engine.window_stats(prefix[user_id], *window),
+                    engine.window_stats(presence.prefix[user_id], *window),
+                )
+
+    def test_generations(self):
+        """
+        Test that new generations replace current one.
+        """
+        # first reader publishes the data
+        presence = utils.get_presence()
+        self.assertIsNone(backends.publish_data(self.directory, self.csv_path))
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write('12345,2013-09-10,09:00:00,17:00:00\n')
+        for generation in (2, 3):
+            os.utime(self.csv_path, (1381000000 + generation,) * 2)
+            self.assertEqual(
+                backends.publish_data(self.directory, self.csv_path),
+                os.path.join(
+                    self.directory, 'presence-{0:08d}.seg'.format(generation)
+                ),
+            )
+        self.assertEqual(sorted(
+            name for name in os.listdir(self.directory)
+            if name.endswith('.seg')
+        ), ['presence-00000002.seg', 'presence-00000003.seg'])
+        # old mapping stays valid
+        self.assertNotIn(12345, presence)
+        self.assertEqual(presence.weekday_stats(10), backends.load_presence(
+            SAMPLE_DATA_CSV
+        ).weekday_stats(10))
+        self.assertIn(12345, utils.get_presence())
+
+    def test_publisher_lock(self):
+        """
+        Test that only one publisher writes segments.
+        """
+        lock = shared.try_lock(self.directory)
+        self.assertIsNotNone(lock)
+        publisher = backends.Publisher(
+            backends.DATA_CACHE, self.csv_path, 60, self.directory
+        )
+        self.assertIsNone(publisher.refresh())
+        self.assertIsNone(shared.current_segment(self.directory))
+        shared.unlock(lock)
+        self.assertIsNotNone(publisher.refresh())
+        self.assertIsNone(shared.try_lock(self.directory))
+        publisher.start()
+        publisher.stop()
+        lock = shared.try_lock(self.directory)
+        self.assertIsNotNone(lock)
+        shared.unlock(lock)
+
+
+class PresenceAnalyzerUserIndexTestCase(unittest.TestCase):
+
+    """
+    Sidecar user index tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, copy test data to a temporary directory.
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.tmpdir, 'data.csv')
+        shutil.copy(SAMPLE_DATA_CSV, self.csv_path)
+
+    def tearDown(self):
+        """
+        Get rid of temporary files after each test.
+        """
+        shutil.rmtree(self.tmpdir)
+
+    def test_scan_ranges(self):
+        """
+        Test that consecutive lines of a user form one range.
+        """
+        csvfile = StringIO(
+            b'user_id,date,start,end\n'
+            b'10,2013-09-10,09:00:00,17:00:00\n'
+            b'10,2013-09-11,09:00:00,17:00:00\n'
+            b'11,2013-09-12,09:00:00,17:00:00\n'
+            b'10,2013-09-09,09:00:00,17:00:00\n'
+        )
+        ranges, summaries = userindex.scan_ranges(csvfile)
+        self.assertEqual(ranges, {10: [(23, 64), (119, 32)], 11: [(87, 32)]})
+        self.assertEqual(summaries, {
+            10: directory.UserSummary(
+                datetime.date(2013, 9, 9).toordinal(),
+                datetime.date(2013, 9, 11).toordinal(),
+                3,
+            ),
+            11: directory.UserSummary(
+                datetime.date(2013, 9, 12).toordinal(),
+                datetime.date(2013, 9, 12).toordinal(),
+                1,
+            ),
+        })
+
+    def test_read_user(self):
+        """
+        Test that user parsed from its ranges equals the whole file parse.
+        """
+        ranges, summaries = userindex.load_index(self.csv_path)
+        self.assertTrue(os.path.exists(userindex.index_path(self.csv_path)))
+        with open(self.csv_path) as csvfile:
+            full = store.PresenceStore.from_rows(ingest.iter_rows(csvfile))
+        self.assertItemsEqual(ranges.keys(), full.user_ids())
+        self.assertEqual(summaries, directory.build_user_summaries(full))
+        for user_id in full.user_ids():
+            user = userindex.read_user(self.csv_path, user_id, ranges[user_id])
+            self.assertEqual(user.user_ids(), [user_id])
+            self.assertEqual(
+                list(user.user_rows(user_id)), list(full.user_rows(user_id))
+            )
+
+    def test_rebuild(self):
+        """
+        Test that index is rebuilt when CSV file is modified.
+        """
+        path = userindex.index_path(self.csv_path)
+        ranges, dummy = userindex.load_index(self.csv_path)
+        self.assertEqual(userindex.read_index(path), (ranges, dummy))
+        with open(self.csv_path, 'a') as csvfile:
+            csvfile.write(b'1,2014-01-02,09:00:00,10:00:00\n')
+        mtime = os.path.getmtime(self.csv_path) + 10
+        os.utime(self.csv_path, (mtime, mtime))
+        with self.assertRaises(userindex.UserIndexError):
+            userindex.read_index(
+                path, snapshot.source_signature(self.csv_path)
+            )
+        ranges, summaries = userindex.load_index(self.csv_path)
+        self.assertIn(1, ranges)
+        self.assertEqual(
+            summaries[1].last, datetime.date(2014, 1, 2).toordinal()
+        )
+        self.assertEqual(
+            userindex.read_index(
+                path, snapshot.source_signature(self.csv_path)
+            ),
+            (ranges, summaries),
+        )
+
+    def test_backend_parity(self):
+        """
+        Test that indexed backend serves same users as the other backends.
+        """
+        with open(self.csv_path, 'w') as csvfile:
+            csvfile.write(
+                b'user_id,date,start,end\n'
+                b'10,2013-09-10,09:00:00,17:00:00\n'
+                b'10,2013-09-10,10:00:00,18:00:00\n'
+                b'10,2013-09-11,09:00:00,25:00:00\n'
+                b'11,2013-09-12,09:00:00,17:00:00\n'
+                b'12,2013-09-13,09:00:00,99:99:99\n'
+                b'3000000000,2013-09-13,09:00:00,17:00:00\n'
+                b'10,2013-09-09,08:00:00,16:00:00\n'
+                b'11,2013-09-16,09:00:00,17:00:00\n'
+            )
+        self.addCleanup(main.app.config.update, {
+            'DATA_CSV': TEST_DATA_CSV, 'STORAGE_BACKEND': 'memory',
+            'DATA_SQLITE': None, 'DATA_INDEX': None,
+        })
+        self.addCleanup(utils.RESPONSE_CACHE.clear)
+        main.app.config.update({
+            'DATA_CSV': self.csv_path,
+            'DATA_SQLITE': os.path.join(self.tmpdir, 'data.sqlite'),
+            'DATA_INDEX': os.path.join(self.tmpdir, 'data.idx'),
+        })
+        client = main.app.test_client()
+        urls = (
+            '/api/v1/users', '/api/v1/presence_start_end/10',
+            '/api/v1/presence_start_end/11', '/api/v1/mean_time_weekday/12',
+        )
+        responses = {}
+        for backend in ('memory', 'sqlite', 'indexed'):
+            main.app.config['STORAGE_BACKEND'] = backend
+            backends.BACKENDS[backend].clear()
+            self.addCleanup(backends.BACKENDS[backend].clear)
+            utils.RESPONSE_CACHE.clear()
+            responses[backend] = [
+                (resp.status_code, resp.data)
+                for resp in (client.get(url) for url in urls)
+            ]
+        self.assertEqual(responses['memory'][3][0], 404)
+        self.assertEqual(
+            [user['user_id'] for user in
+             json.loads(responses['memory'][0][1])],
+            [10, 11],
+        )
+        self.assertEqual(json.loads(responses['memory'][0][1])[0], {
+            'user_id': 10, 'name': 'User 10', 'first_seen': '2013-09-09',
+            'last_seen': '2013-09-10', 'days': 2,
+        })
+        self.assertEqual(responses['sqlite'], responses['memory'])
+        self.assertEqual(responses['indexed'], responses['memory'])
+
+    def test_user_cache(self):
+        """
+        Test that parsed users are evicted in LRU order.
+        """
+        ranges, summaries = userindex.load_index(self.csv_path)
+        index = userindex.UserIndex(self.csv_path, ranges, summaries, 2)
+        first, second, third = index.user_ids()[:3]
+        self.assertIs(index.user_store(first), index.user_store(first))
+        index.user_store(second)
+        index.user_store(first)
+        index.user_store(third)
+        self.assertEqual(index.stats(), {
+            'hits': 2, 'misses': 3, 'evictions': 1, 'users': 2,
+        })
+        index.user_store(first)
+        self.assertEqual(index.stats()['hits'], 3)
+        self.assertNotIn(0, index)
+
 
 def suite():
     """
@@ -289,7 +2566,34 @@ def suite():
     """
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerSQLiteViewsTestCase)
+    )
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerIndexedViewsTestCase)
+    )
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerSharedViewsTestCase)
+    )
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerConditionalTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerResponseCacheTestCase)
+    )
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerEncodingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerMetricsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerProfilingTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerIngestTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerGeneratorTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerEngineTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSketchTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDataCacheTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSnapshotTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDataDirTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDatabaseTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerSharedTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUserIndexTestCase))
     return base_suite
 
 
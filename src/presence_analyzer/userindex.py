@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Sidecar index of byte ranges of every user in a CSV file.
+
+The index is built in one scan of the file and stored next to it, so
+records of a single user are loaded by seeking to and parsing only its
+ranges. Consecutive lines of a user form one range, exports grouped by user
+give a single range per user. Index file consists of a header followed by
+little-endian ranges sorted by user:
+
+    header    - magic, format version, source CSV size and mtime, number of
+                ranges and users,
+    ranges    - user_id, offset and length of every range,
+    summaries - user_id, ordinals of first and last date and number of
+                days of every user.
+"""
+
+import os
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+
+from directory import UserSummary
+from ingest import iter_rows, parse_line
+from snapshot import source_signature
+from store import PresenceStore
+
+import logging
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+MAGIC = 'PRESIDX\0'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<8sIIqdqq')
+# user ids are validated by ingest.parse_line to fit C int
+RANGE = struct.Struct('<iqq')
+SUMMARY = struct.Struct('<iiii')
+SUFFIX = '.idx'
+
+
+class UserIndexError(Exception):
+    """
+    Index file is missing, invalid or out of date.
+    """
+
+
+def index_path(csv_path):
+    """
+    Returns path of index stored next to given CSV file.
+    """
+    return csv_path + SUFFIX
+
+
+def scan_ranges(csvfile):
+    """
+    Scans CSV file, returns (ranges, summaries).
+
+    `ranges` maps user_id to list of (offset, length) of its lines and
+    `summaries` maps it to UserSummary of its distinct dates. Lines are
+    validated by the same parser as iter_rows, so only users and lines
+    which the other backends load are indexed.
+    """
+    ranges = {}
+    days = {}
+    dates = {}
+    times = {}
+    current = None
+    offset = 0
+    for line in csvfile:
+        try:
+            row = parse_line(line, dates, times)
+        except (ValueError, TypeError):
+            row = None
+        if row is not None:
+            user_id = row[0]
+            if current is not None and current[0] == user_id and \
+                    current[1] + current[2] == offset:
+                current[2] += len(line)
+            else:
+                current = [user_id, offset, len(line)]
+                ranges.setdefault(user_id, []).append(current)
+            days.setdefault(user_id, set()).add(row[1])
+        offset += len(line)
+    for user_id, user_ranges in ranges.iteritems():
+        ranges[user_id] = [(start, length) for dummy, start, length
+                           in user_ranges]
+    return ranges, dict(
+        (user_id, UserSummary(
+            min(user_days).toordinal(), max(user_days).toordinal(),
+            len(user_days),
+        ))
+        for user_id, user_days in days.iteritems()
+    )
+
+
+def write_index(path, ranges, summaries, source):
+    """
+    Atomically writes index file.
+
+    `source` is (size, mtime) of the CSV file ranges were scanned from.
+    """
+    entries = sorted(
+        (user_id, start, length)
+        for user_id, user_ranges in ranges.iteritems()
+        for start, length in user_ranges
+    )
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(
+            dir=directory, prefix='.index-', delete=False) as indexfile:
+        try:
+            indexfile.write(HEADER.pack(
+                MAGIC, FORMAT_VERSION, 0, source[0], source[1],
+                len(entries), len(summaries),
+            ))
+            for entry in entries:
+                indexfile.write(RANGE.pack(*entry))
+            for user_id in sorted(summaries):
+                indexfile.write(SUMMARY.pack(user_id, *summaries[user_id]))
+        except Exception:
+            os.unlink(indexfile.name)
+            raise
+    os.rename(indexfile.name, path)
+
+
+def read_index(path, source=None):
+    """
+    Reads index file, returns (ranges, summaries).
+
+    When `source` (size, mtime) is given UserIndexError is raised if it
+    doesn't match CSV file recorded in the header.
+    """
+    try:
+        with open(path, 'rb') as indexfile:
+            data = indexfile.read()
+    except (IOError, OSError) as error:
+        raise UserIndexError('Cannot read {0}: {1}'.format(path, error))
+    if len(data) < HEADER.size:
+        raise UserIndexError('Truncated index {0}'.format(path))
+    magic, version, dummy, size, mtime, count, users = \
+        HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise UserIndexError('Unsupported index {0}'.format(path))
+    if source is not None and (size, mtime) != tuple(source):
+        raise UserIndexError('Index {0} is out of date'.format(path))
+    summary_offset = HEADER.size + count * RANGE.size
+    if len(data) != summary_offset + users * SUMMARY.size:
+        raise UserIndexError('Truncated index {0}'.format(path))
+    ranges = {}
+    for offset in xrange(HEADER.size, summary_offset, RANGE.size):
+        user_id, start, length = RANGE.unpack_from(data, offset)
+        ranges.setdefault(user_id, []).append((start, length))
+    summaries = {}
+    for offset in xrange(summary_offset, len(data), SUMMARY.size):
+        summary = SUMMARY.unpack_from(data, offset)
+        summaries[summary[0]] = UserSummary(*summary[1:])
+    return ranges, summaries
+
+
+def build_index(csv_path, path=None):
+    """
+    Scans CSV file and writes its index, returns (ranges, summaries).
+    """
+    source = source_signature(csv_path)
+    with open(csv_path, 'rb') as csvfile:
+        ranges, summaries = scan_ranges(csvfile)
+    write_index(path or index_path(csv_path), ranges, summaries, source)
+    return ranges, summaries
+
+
+def load_index(csv_path, path=None):
+    """
+    Returns (ranges, summaries) of CSV file, using its index when up to date.
+
+    Missing index, or index built before CSV was modified, is rebuilt.
+    """
+    path = path or index_path(csv_path)
+    try:
+        return read_index(path, source_signature(csv_path))
+    except UserIndexError as error:
+        log.info('Rebuilding user index: %s', error)
+    try:
+        return build_index(csv_path, path)
+    except (IOError, OSError):
+        log.warning('Cannot write user index %s', path, exc_info=True)
+        with open(csv_path, 'rb') as csvfile:
+            return scan_ranges(csvfile)
+
+
+def read_user(csv_path, user_id, ranges):
+    """
+    Parses byte ranges of CSV file, returns PresenceStore of given user.
+    """
+    with open(csv_path, 'rb') as csvfile:
+        lines = []
+        for start, length in ranges:
+            csvfile.seek(start)
+            lines.extend(csvfile.read(length).splitlines(True))
+    return PresenceStore.from_rows(
+        row for row in iter_rows(lines) if row[0] == user_id
+    )
+
+
+class UserIndex(object):
+    """
+    On-demand access to records of single users of a CSV file.
+
+    Parsed users are kept in LRU cache of at most `size` users, so memory
+    stays flat regardless of size of the file.
+    """
+
+    def __init__(self, csv_path, ranges, summaries, size):
+        self.csv_path = csv_path
+        self.ranges = ranges
+        self.summaries = summaries
+        self.size = size
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __contains__(self, user_id):
+        return user_id in self.ranges
+
+    def user_ids(self):
+        """
+        Returns sorted list of all user ids.
+        """
+        return sorted(self.ranges)
+
+    def user_store(self, user_id):
+        """
+        Returns PresenceStore with records of given user.
+        """
+        with self._lock:
+            store = self._users.pop(user_id, None)
+            if store is not None:
+                self._users[user_id] = store
+                self._stats['hits'] += 1
+                return store
+            self._stats['misses'] += 1
+        store = read_user(self.csv_path, user_id, self.ranges[user_id])
+        with self._lock:
+            self._users[user_id] = store
+            while len(self._users) > self.size:
+                self._users.popitem(last=False)
+                self._stats['evictions'] += 1
+        return store
+
+    def stats(self):
+        """
+        Returns counters of parsed users cache.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._users)
+        return stats
@@ -3,40 +3,325 @@
 Helper functions used in views.
 """
 
-import csv
-from json import dumps
-from functools import wraps
-from datetime import datetime
+import calendar
+import threading
+from collections import OrderedDict
+from hashlib import md5
+from functools import partial, wraps
 
-from flask import Response
+from flask import Response, g, has_request_context, request
 
+from backends import TEAMS_CACHE, TeamMapping, backend_path, data_cache
+from encoding import encode, get_encoder, gzip_compress
 from main import app
+from metrics import REGISTRY, timed
+from profiling import PROFILING_KEY
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-def jsonify(function):
+def conditional(function=None, teams=False):
+    """
+    Adds ETag, Last-Modified and Cache-Control headers to view's response.
+
+    Validators are based on version of presence data (and team mapping
+    when `teams` is set) and request arguments, so conditional GET
+    requests are answered with 304 without running the view.
+    """
+    if function is None:
+        return partial(conditional, teams=teams)
+
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return function(*args, **kwargs)
+
+        version, modified = data_version(teams)
+        etag = md5('|'.join([
+            version,
+            request.endpoint or '',
+            repr(sorted(kwargs.items())),
+            request.query_string,
+            # compressed and plain responses are different entities
+            'gzip' if accepts_gzip() else '',
+        ])).hexdigest()
+        if is_not_modified(etag, modified):
+            response = Response(status=304)
+        else:
+            response = app.make_response(function(*args, **kwargs))
+        response.set_etag(etag)
+        if gzip_level():
+            response.vary.add('Accept-Encoding')
+        response.last_modified = modified
+        response.cache_control.max_age = app.config.get('CACHE_MAX_AGE', 0)
+        return response
+    return inner
+
+
+def is_not_modified(etag, last_modified):
+    """
+    Checks whether client's cached response is still valid.
+    """
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if request.if_modified_since:
+        since = calendar.timegm(request.if_modified_since.utctimetuple())
+        return calendar.timegm(last_modified.utctimetuple()) <= since
+    return False
+
+
+def jsonify(function=None, teams=False):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Serialized responses are kept in RESPONSE_CACHE until presence data
+    (and team mapping when `teams` is set) changes, unless endpoint is
+    listed in RESPONSE_CACHE_EXCLUDE. Bodies of at least GZIP_MIN_SIZE bytes
+    are compressed for clients accepting gzip, compressed bodies are cached
+    as well.
     """
+    if function is None:
+        return partial(jsonify, teams=teams)
+
+    @conditional(teams=teams)
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        max_bytes = app.config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE)
+        use_cache = (
+            max_bytes > 0 and
+            request.endpoint not in app.config.get(
+                'RESPONSE_CACHE_EXCLUDE', ()
+            ) and
+            # profiled requests have to run the view
+            PROFILING_KEY not in request.environ
         )
+        compress = accepts_gzip()
+        body = None
+        if use_cache:
+            version = data_version(teams)[0]
+            key = (
+                request.endpoint,
+                tuple(sorted(kwargs.items())),
+                request.query_string,
+            )
+            # one hit or miss per request, compressed variant is looked up
+            # only after its plain body
+            body = RESPONSE_CACHE.get(key, version)
+            if body is not None and compress:
+                compressed = RESPONSE_CACHE.get(
+                    key + ('gzip',), version, count=False
+                )
+                if compressed is not None:
+                    return gzip_response(compressed)
+        if body is None:
+            with timed('aggregation'):
+                result = function(*args, **kwargs)
+            with timed('serialization'):
+                body = encode(result, json_encoder())
+            if use_cache:
+                RESPONSE_CACHE.set(key, version, body, max_bytes)
+        if compress and len(body) >= app.config.get(
+                'GZIP_MIN_SIZE', GZIP_MIN_SIZE):
+            with timed('compression'):
+                body = gzip_compress(body, gzip_level())
+            if use_cache:
+                RESPONSE_CACHE.set(key + ('gzip',), version, body, max_bytes)
+            return gzip_response(body)
+        return Response(body, mimetype='application/json')
     return inner
 
 
+def json_encoder():
+    """
+    Returns JSON encoder selected by JSON_ENCODER.
+    """
+    return get_encoder(app.config.get('JSON_ENCODER'))
+
+
+def gzip_level():
+    """
+    Returns configured compression level, 0 when compression is disabled.
+    """
+    return app.config.get('GZIP_LEVEL', GZIP_LEVEL)
+
+
+def accepts_gzip():
+    """
+    Checks whether response to current request may be compressed.
+    """
+    return bool(gzip_level()) and request.accept_encodings['gzip'] > 0
+
+
+def gzip_response(body):
+    """
+    Creates a response with compressed JSON body.
+    """
+    response = Response(body, mimetype='application/json')
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+class ResponseCache(object):
+    """
+    LRU cache of serialized responses bounded by their total size.
+
+    Entries are bound to version of presence data, all of them are dropped
+    as soon as a different version is seen.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self.size = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _check_version(self, version):
+        """
+        Drops all entries if data version has changed.
+        """
+        if version != self._version:
+            self._entries.clear()
+            self.size = 0
+            self._version = version
+
+    def get(self, key, version, count=True):
+        """
+        Returns cached body or None.
+
+        Lookups of variants of an already counted entry pass `count=False`
+        to leave hit and miss counters alone.
+        """
+        with self._lock:
+            self._check_version(version)
+            body = self._entries.pop(key, None)
+            if body is None:
+                if count:
+                    self._stats['misses'] += 1
+                return None
+            self._entries[key] = body
+            if count:
+                self._stats['hits'] += 1
+            return body
+
+    def set(self, key, version, body, max_bytes):
+        """
+        Stores body, evicting least recently used entries above max_bytes.
+        """
+        if len(body) > max_bytes:
+            return
+        with self._lock:
+            self._check_version(version)
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > max_bytes:
+                dummy, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        """
+        Returns counters, hit rate and memory used by cached bodies.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self.size
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / requests if requests else 0
+        return stats
+
+    def clear(self):
+        """
+        Drops all entries and resets counters.
+        """
+        with self._lock:
+            self._check_version(None)
+            for name in self._stats:
+                self._stats[name] = 0
+
+
+def get_presence():
+    """
+    Returns PresenceData snapshot of DATA_DIR or DATA_CSV.
+
+    Data is parsed once and cached until it changes on disk. Within
+    a request the same snapshot is returned on every call.
+    """
+    if not has_request_context():
+        return data_cache().get(backend_path())
+    presence = getattr(g, 'presence', None)
+    if presence is None:
+        presence = g.presence = data_cache().get(backend_path())
+    return presence
+
+
+def get_teams():
+    """
+    Returns TeamMapping read from TEAMS_CSV or None when it isn't set.
+
+    Within a request the same mapping is returned on every call.
+    """
+    path = app.config.get('TEAMS_CSV')
+    if not path:
+        return None
+    if not has_request_context():
+        return _teams_mapping(path)
+    teams = getattr(g, 'teams', None)
+    if teams is None:
+        teams = g.teams = _teams_mapping(path)
+    return teams
+
+
+def _teams_mapping(path):
+    """
+    Returns cached TeamMapping, empty when the file can't be read.
+
+    Missing file is reported once and gives the same empty mapping until
+    the file can be read again.
+    """
+    try:
+        teams = TEAMS_CACHE.get(path)
+    except (IOError, OSError) as error:
+        teams = MISSING_TEAMS.get(path)
+        if teams is None:
+            log.warning('Cannot read teams from %s: %s', path, error)
+            teams = MISSING_TEAMS[path] = TeamMapping({})
+        return teams
+    MISSING_TEAMS.pop(path, None)
+    return teams
+
+
+def data_version(teams=False):
+    """
+    Returns (version, modified) of presence data served by current
+    request, combined with team mapping when `teams` is set.
+    """
+    presence = get_presence()
+    teams = get_teams() if teams else None
+    if teams is None:
+        return presence.version, presence.modified
+    return (
+        '{0}-{1}'.format(presence.version, teams.version),
+        max(presence.modified, teams.modified),
+    )
+
+
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Returns presence data of current snapshot grouped by user_id.
 
-    It creates structure like this:
+    It's a structure like this:
     data = {
         'user_id': {
             datetime.date(2013, 10, 1): {
@@ -50,24 +335,50 @@ def get_data():
         }
     }
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    return get_presence().data
+
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
+RESPONSE_CACHE = ResponseCache()
+# empty TeamMapping of every TEAMS_CSV path which couldn't be read
+MISSING_TEAMS = {}
+# default limit of RESPONSE_CACHE, in bytes
+RESPONSE_CACHE_SIZE = 16 * 1024 * 1024
+# default compression level and smallest body worth compressing, in bytes
+GZIP_LEVEL = 6
+GZIP_MIN_SIZE = 1024
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
-    return data
+
+@REGISTRY.register
+def cache_metrics():
+    """
+    Exposes statistics of data and response caches.
+    """
+    data_stats = data_cache().stats()
+    response_stats = RESPONSE_CACHE.stats()
+    return [
+        (
+            'presence_data_cache_total', 'counter',
+            'Lookups of parsed presence data by result.',
+            [((('result', name),), value)
+             for name, value in sorted(data_stats.items())],
+        ),
+        (
+            'presence_response_cache_total', 'counter',
+            'Lookups of cached responses by result.',
+            [((('result', name),), response_stats[name])
+             for name in ('hits', 'misses', 'evictions')],
+        ),
+        (
+            'presence_response_cache_bytes', 'gauge',
+            'Memory used by cached responses.',
+            [((), response_stats['bytes'])],
+        ),
+        (
+            'presence_response_cache_entries', 'gauge',
+            'Number of cached responses.',
+            [((), response_stats['entries'])],
+        ),
+    ]
 
 
 def group_by_weekday(items):
@@ -118,3 +429,10 @@ def mean(items):
     Calculates arithmetic mean. Returns zero for empty lists.
     """
     return float(sum(items)) / len(items) if len(items) > 0 else 0
+
+
+def average(total, count):
+    """
+    Calculates arithmetic mean from precomputed sum. Returns zero for no items.
+    """
+    return float(total) / count if count > 0 else 0
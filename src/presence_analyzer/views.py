@@ -3,18 +3,24 @@
 Defines views.
 """
 
-from flask import redirect, abort
+from flask import Response, abort, redirect, request
 import calendar
 import datetime
 
+from encoding import TableFormat, encode, gzip_stream
+from engine import MINUTES, GroupStats, merge_group_stats
 from main import app
+from metrics import REGISTRY
+from sketch import QUANTILES
 from utils import (
-    get_data,
-    group_by_start_end,
-    group_by_weekday,
+    accepts_gzip,
+    average,
+    conditional,
+    get_presence,
+    get_teams,
+    gzip_level,
+    json_encoder,
     jsonify,
-    mean,
-    seconds_since_midnight
 )
 
 import logging
@@ -29,17 +35,222 @@ def mainpage():
     return redirect('/static/presence_weekday.html')
 
 
+USERS_ARGS = ('prefix', 'limit', 'offset', 'cursor')
+
+
 @app.route('/api/v1/users', methods=['GET'])
 @jsonify
 def users_view():
     """
     Users listing for dropdown.
+
+    Without parameters all users are listed. Optional `prefix` limits them
+    to users whose name or id starts with it, `limit`, `offset` and
+    `cursor` (user_id the previous page ended with) select a page. Pages
+    are returned with `total` number of matching users and `next` cursor.
     """
-    data = get_data()
-    return [
-        {'user_id': i, 'name': 'User {0}'.format(str(i))}
-        for i in data.keys()
-    ]
+    directory = get_presence().directory
+    if not any(name in request.args for name in USERS_ARGS):
+        return directory.entries
+    entries, total, next_cursor = directory.page(
+        request.args.get('prefix'),
+        int_arg('offset') or 0,
+        int_arg('limit', minimum=1),
+        int_arg('cursor'),
+    )
+    return {'users': entries, 'total': total, 'next': next_cursor}
+
+
+def int_arg(name, minimum=0):
+    """
+    Returns optional integer parameter of at least `minimum`, None when
+    it's not given. Invalid values abort the request with 400.
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = minimum - 1
+    if value < minimum:
+        log.debug('Invalid %s: %s', name, request.args.get(name))
+        abort(400)
+    return value
+
+
+MEAN_TIME_WEEKDAY = TableFormat(calendar.day_abbr, 1)
+PRESENCE_WEEKDAY = TableFormat(
+    calendar.day_abbr, 1, header=('Weekday', 'Presence (s)')
+)
+PRESENCE_START_END = TableFormat(calendar.day_abbr, 2)
+QUANTILES_TABLE = TableFormat(calendar.day_abbr, len(QUANTILES))
+GROUP_TABLE = TableFormat(calendar.day_abbr, 5, header=(
+    'Weekday', 'Mean presence (s)', 'Mean start (s)', 'Mean end (s)',
+    'Users', 'Days',
+))
+COMPARE_TABLE = TableFormat(
+    calendar.day_abbr, 2, header=('Weekday', 'User', 'Company')
+)
+COMPARE_TEAM_TABLE = TableFormat(
+    calendar.day_abbr, 3, header=('Weekday', 'User', 'Team', 'Company')
+)
+EMPTY_GROUP = [GroupStats(0, 0, 0, 0, 0)] * 7
+OCCUPANCY_BUCKETS = (1, 5, 10, 15, 30, 60)
+# table formats of occupancy buckets, compiled on first use
+OCCUPANCY_FORMATS = {}
+# position of median in WeekdayQuantiles fields
+MEDIAN = QUANTILES.index(0.5)
+STATISTICS = ('mean', 'median')
+
+
+def mean_time_weekday(weekdays):
+    """
+    Builds mean presence time table from user's WeekdayStats.
+    """
+    return MEAN_TIME_WEEKDAY.table(
+        (average(stats.presence, stats.count),) for stats in weekdays
+    )
+
+
+def presence_weekday(weekdays):
+    """
+    Builds total presence time table from user's WeekdayStats.
+    """
+    return PRESENCE_WEEKDAY.table((stats.presence,) for stats in weekdays)
+
+
+def presence_start_end(weekdays):
+    """
+    Builds mean start and end time table from user's WeekdayStats.
+    """
+    return PRESENCE_START_END.table(
+        (average(stats.start, stats.count), average(stats.end, stats.count))
+        for stats in weekdays
+    )
+
+
+def median_time_weekday(quantiles):
+    """
+    Builds median presence time table from user's WeekdayQuantiles.
+    """
+    return MEAN_TIME_WEEKDAY.table(
+        (weekday.presence[MEDIAN],) for weekday in quantiles
+    )
+
+
+def median_start_end(quantiles):
+    """
+    Builds median start and end time table from user's WeekdayQuantiles.
+    """
+    return PRESENCE_START_END.table(
+        (weekday.start[MEDIAN], weekday.end[MEDIAN]) for weekday in quantiles
+    )
+
+
+def group_table(weekdays):
+    """
+    Builds table of mean times, number of users and of days they were
+    present from GroupStats.
+    """
+    return GROUP_TABLE.table((
+        average(stats.presence, stats.count),
+        average(stats.start, stats.count),
+        average(stats.end, stats.count),
+        stats.users,
+        stats.count,
+    ) for stats in weekdays)
+
+
+def occupancy_format(bucket):
+    """
+    Returns TableFormat of occupancy with rows of `bucket` minutes.
+    """
+    table_format = OCCUPANCY_FORMATS.get(bucket)
+    if table_format is None:
+        table_format = OCCUPANCY_FORMATS[bucket] = TableFormat(
+            [
+                '{0:02d}:{1:02d}'.format(*divmod(minute, 60))
+                for minute in range(0, MINUTES, bucket)
+            ],
+            7, header=['Time'] + list(calendar.day_abbr),
+        )
+    return table_format
+
+
+def occupancy_table(occupancy, bucket):
+    """
+    Builds table of mean number of users present in every bucket of
+    minutes, with a column per weekday.
+    """
+    columns = []
+    for minutes, dates in zip(occupancy.minutes, occupancy.dates):
+        scale = float(bucket * dates) if dates else 0
+        columns.append([
+            round(sum(minutes[start:start + bucket]) / scale, 2)
+            if scale else 0
+            for start in range(0, MINUTES, bucket)
+        ])
+    return occupancy_format(bucket).table(zip(*columns))
+
+
+def statistic_arg():
+    """
+    Returns statistic selected by optional `stat` parameter, mean by
+    default. Unknown statistics abort the request with 400.
+    """
+    statistic = request.values.get('stat') or 'mean'
+    if statistic not in STATISTICS:
+        log.debug('Invalid statistic: %s', statistic)
+        abort(400)
+    return statistic
+
+
+def date_range_args(presence):
+    """
+    Returns (first, last) dates from optional `from`, `to` and `weeks`.
+
+    Dates are given as YYYY-MM-DD and both bounds are inclusive. `weeks`
+    selects a rolling window of that many weeks ending at `to` or the latest
+    day in data and can't be combined with `from`. Invalid values abort
+    the request with 400.
+    """
+    bounds = []
+    for name in ('from', 'to'):
+        value = request.values.get(name)
+        if not value:
+            bounds.append(None)
+            continue
+        try:
+            bounds.append(
+                datetime.datetime.strptime(value, '%Y-%m-%d').date()
+            )
+        except ValueError:
+            log.debug('Invalid %s date: %s', name, value)
+            abort(400)
+    first, last = bounds
+
+    weeks = request.values.get('weeks')
+    if weeks:
+        if first is not None or not weeks.isdigit() or not int(weeks):
+            log.debug('Invalid weeks: %s', weeks)
+            abort(400)
+        last = last or presence.last_day
+        if last is not None:
+            try:
+                first = last - datetime.timedelta(days=int(weeks) * 7 - 1)
+            except OverflowError:
+                # window starting before the first representable date
+                log.debug('Invalid weeks: %s', weeks)
+                abort(400)
+    return first, last
+
+
+METRICS = {
+    'mean_time_weekday': mean_time_weekday,
+    'presence_weekday': presence_weekday,
+    'presence_start_end': presence_start_end,
+}
 
 
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
@@ -47,18 +258,21 @@ def users_view():
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    With `stat=median` medians are returned instead.
     """
-    data = get_data()
-    if user_id not in data:
+    presence = get_presence()
+    if user_id not in presence:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-    return result
+    if statistic_arg() == 'median':
+        return median_time_weekday(
+            presence.weekday_quantiles(user_id, *date_range_args(presence))
+        )
+    return mean_time_weekday(
+        presence.weekday_stats(user_id, *date_range_args(presence))
+    )
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -67,19 +281,14 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    presence = get_presence()
+    if user_id not in presence:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
-
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+    return presence_weekday(
+        presence.weekday_stats(user_id, *date_range_args(presence))
+    )
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -87,18 +296,228 @@ def presence_weekday_view(user_id):
 def presence_start_end_view(user_id):
     """
     Returns start and end time of given user grouped by weekday.
+
+    Times are means, with `stat=median` medians are returned instead.
     """
-    data = get_data()
-    if user_id not in data:
+    presence = get_presence()
+    if user_id not in presence:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    start_end_weekdays = group_by_start_end(data[user_id])
-    result = [(
-        calendar.day_abbr[weekday],
-        mean(start_end_weekdays[weekday]['start']),
-        mean(start_end_weekdays[weekday]['end']))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    if statistic_arg() == 'median':
+        return median_start_end(
+            presence.weekday_quantiles(user_id, *date_range_args(presence))
+        )
+    return presence_start_end(
+        presence.weekday_stats(user_id, *date_range_args(presence))
+    )
+
+
+@app.route('/api/v1/presence_quantiles/<int:user_id>', methods=['GET'])
+@jsonify
+def presence_quantiles_view(user_id):
+    """
+    Returns 10th, 50th and 90th percentiles of start time, end time and
+    presence time of given user grouped by weekday.
+    """
+    presence = get_presence()
+    if user_id not in presence:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    quantiles = presence.weekday_quantiles(
+        user_id, *date_range_args(presence)
+    )
+    result = {'quantiles': QUANTILES}
+    for field in ('start', 'end', 'presence'):
+        result[field] = QUANTILES_TABLE.table(
+            getattr(weekday, field) for weekday in quantiles
+        )
     return result
+
+
+@app.route('/api/v1/teams', methods=['GET'])
+@jsonify(teams=True)
+def teams_view():
+    """
+    Teams listing with number of their members.
+    """
+    teams = get_teams()
+    if teams is None:
+        return []
+    members = {}
+    for team in teams.teams.itervalues():
+        members[team] = members.get(team, 0) + 1
+    return [
+        {'team': team, 'users': members[team]} for team in teams.names()
+    ]
+
+
+@app.route('/api/v1/company/weekday', methods=['GET'])
+@jsonify(teams=True)
+def company_weekday_view():
+    """
+    Returns mean times and headcount of all users grouped by weekday.
+
+    Optional `team` limits statistics to members of that team, `from`,
+    `to` and `weeks` limit them to a date range.
+    """
+    presence = get_presence()
+    teams = get_teams()
+    groups = presence.group_stats(teams, *date_range_args(presence))
+    team = request.values.get('team')
+    if team is None:
+        return group_table(merge_group_stats(groups.itervalues()))
+    if teams is None or team not in teams.names():
+        log.debug('Team %s not found!', team)
+        abort(404)
+    return group_table(groups.get(team, EMPTY_GROUP))
+
+
+@app.route('/api/v1/teams/weekday', methods=['GET'])
+@jsonify(teams=True)
+def teams_weekday_view():
+    """
+    Returns mean times and headcount of every team grouped by weekday.
+    """
+    presence = get_presence()
+    teams = get_teams()
+    if teams is None:
+        return {}
+    groups = presence.group_stats(teams, *date_range_args(presence))
+    return dict(
+        (team, group_table(groups.get(team, EMPTY_GROUP)))
+        for team in teams.names()
+    )
+
+
+@app.route('/api/v1/company/compare/<int:user_id>', methods=['GET'])
+@jsonify(teams=True)
+def company_compare_view(user_id):
+    """
+    Compares mean presence time of given user with company average, and
+    with average of user's team if there is one, grouped by weekday.
+    """
+    presence = get_presence()
+    if user_id not in presence:
+        log.debug('User %s not found!', user_id)
+        abort(404)
+
+    first, last = date_range_args(presence)
+    teams = get_teams()
+    groups = presence.group_stats(teams, first, last)
+    columns = [
+        [average(stats.presence, stats.count) for stats in weekdays]
+        for weekdays in (
+            presence.weekday_stats(user_id, first, last),
+            merge_group_stats(groups.itervalues()),
+        )
+    ]
+    team = teams.teams.get(user_id) if teams is not None else None
+    if team is None:
+        return COMPARE_TABLE.table(zip(*columns))
+    columns.insert(1, [
+        average(stats.presence, stats.count)
+        for stats in groups.get(team, EMPTY_GROUP)
+    ])
+    return COMPARE_TEAM_TABLE.table(zip(*columns))
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Returns mean number of users present in every part of the day by
+    weekday.
+
+    Optional `bucket` gives length of parts in minutes, 15 by default.
+    `from`, `to` and `weeks` limit statistics to a date range.
+    """
+    bucket = request.values.get('bucket', '15')
+    if not bucket.isdigit() or int(bucket) not in OCCUPANCY_BUCKETS:
+        log.debug('Invalid bucket: %s', bucket)
+        abort(400)
+    presence = get_presence()
+    return occupancy_table(
+        presence.occupancy(*date_range_args(presence)), int(bucket)
+    )
+
+
+def split_values(name):
+    """
+    Returns values of repeated and/or comma separated request parameter.
+    """
+    return [
+        value
+        for param in request.values.getlist(name)
+        for value in param.split(',')
+        if value
+    ]
+
+
+@app.route('/api/v2/stats', methods=['GET', 'POST'])
+@conditional
+def stats_view():
+    """
+    Returns several statistics of many users in one streamed response.
+
+    Optional `user_id` and `metric` parameters (repeated or comma separated)
+    select users and statistics, by default all of them are returned.
+    Optional `from`, `to` and `weeks` limit statistics to a date range,
+    see date_range_args. Response is compressed for clients accepting gzip.
+    """
+    try:
+        user_ids = [int(value) for value in split_values('user_id')]
+    except ValueError:
+        abort(400)
+    metrics = split_values('metric') or sorted(METRICS)
+    if not set(metrics) <= set(METRICS):
+        abort(400)
+
+    presence = get_presence()
+    first, last = date_range_args(presence)
+    if not user_ids:
+        user_ids = presence.user_ids()
+    encoder = json_encoder()
+
+    def generate():
+        """
+        Yields JSON document one user at a time.
+        """
+        yield '{{"metrics": {0}, "users": ['.format(encoder(metrics))
+        missing = []
+        separator = ''
+        for user_id in user_ids:
+            if user_id not in presence:
+                missing.append(user_id)
+                continue
+            weekdays = presence.weekday_stats(user_id, first, last)
+            # tables are encoded by their templates
+            yield '{0}{{"user_id": {1}, {2}}}'.format(
+                separator, user_id, ', '.join(
+                    '"{0}": {1}'.format(
+                        metric, encode(METRICS[metric](weekdays), encoder)
+                    )
+                    for metric in metrics
+                )
+            )
+            separator = ', '
+        yield '], "missing": {0}}}'.format(encoder(missing))
+
+    if accepts_gzip():
+        response = Response(
+            gzip_stream(generate(), gzip_level()), mimetype='application/json'
+        )
+        response.headers['Content-Encoding'] = 'gzip'
+        return response
+    return Response(generate(), mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns request and hot-path metrics in Prometheus text format.
+    """
+    return Response(
+        REGISTRY.render(), mimetype='text/plain; version=0.0.4'
+    )